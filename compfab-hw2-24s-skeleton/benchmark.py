@@ -0,0 +1,217 @@
+from material import Material, LinearElastic, NeoHookean
+from tet_mesh import TetMesh, tet_mesh_cuboid
+from fem import StaticFEM
+
+from numpy import ndarray as array
+from typing import Callable, List, Tuple
+
+import os
+import time
+import argparse
+import numpy as np
+
+
+# Material parameters (Young's modulus and Poisson's ratio), same as `main.py`
+E, nu = 10000000, 0.45
+
+
+def random_deformation_gradients(num_elements: int, scale: float=0.05, seed: int=0) -> array:
+    '''
+    Generate a batch of random deformation gradients around the identity. A small `scale` keeps
+    det(F) positive so that the Neo-Hookean model is well defined.
+    '''
+    rng = np.random.default_rng(seed)
+    return np.eye(3) + rng.uniform(-scale, scale, size=(num_elements, 3, 3))
+
+
+def time_function(func: Callable[[], object], repeats: int=3) -> float:
+    '''
+    Return the best wall time of `repeats` calls to `func` in seconds.
+    '''
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_material(material: Material, sizes: List[int], max_loop_elements: int=100000):
+    '''
+    Compare the throughput (elements per second) of per-element and batched material model
+    evaluation.
+
+    Params:
+        * `material: Material`       - the material model to benchmark
+        * `sizes: List[int]`         - numbers of elements to test
+        * `max_loop_elements: int`   - the per-element loop only runs on the first
+                                       `max_loop_elements` elements, since its throughput does not
+                                       depend on the batch size
+    '''
+    print(f'------------ Benchmark: material {material.type} ------------')
+    print(f'{"function":<20} {"#elements":>10} {"loop (elem/s)":>15} {"batch (elem/s)":>15} '
+          f'{"speedup":>8}')
+
+    # Per-element and batched functions to compare
+    functions = [
+        ('energy_density', material.energy_density, material.energy_density_batch),
+        ('stress_tensor', material.stress_tensor, material.stress_tensor_batch),
+        ('stress_differential', material.stress_differential, material.stress_differential_batch),
+    ]
+
+    for num_elements in sizes:
+        F = random_deformation_gradients(num_elements)
+        F_loop = F[:max_loop_elements]
+
+        for name, func, func_batch in functions:
+            # Measure throughput in elements per second
+            t_loop = time_function(lambda: [func(Ft) for Ft in F_loop], repeats=1)
+            t_batch = time_function(lambda: func_batch(F))
+            loop_rate = F_loop.shape[0] / t_loop
+            batch_rate = num_elements / t_batch
+
+            print(f'{name:<20} {num_elements:>10} {loop_rate:>15.4g} {batch_rate:>15.4g} '
+                  f'{batch_rate / loop_rate:>7.1f}x')
+
+
+def _unfused_evaluate_batch(material: Material, F: array) -> Tuple[array, array, array]:
+    '''
+    Reference for `benchmark_fused`: compute the energy densities, stress tensors and stress
+    differentials by separate batched computations that share no intermediate results. For the
+    Neo-Hookean model, this is the per-quantity batched code before `evaluate_batch` was fused,
+    since its batch methods now go through the fused path.
+    '''
+    if not isinstance(material, NeoHookean):
+        return (material.energy_density_batch(F), material.stress_tensor_batch(F),
+                material.stress_differential_batch(F))
+
+    # Constants
+    num_elements = F.shape[0]
+    dim, dim2 = F.shape[-1], F.shape[-1] ** 2
+    mu, lm = material.mu, material.lm
+
+    # Energy densities
+    I1 = np.einsum('tij,tij->t', F, F)
+    logJ = np.log(np.linalg.det(F))
+    W = 0.5 * mu * (I1 - dim - 2 * logJ) + 0.5 * lm * logJ ** 2
+
+    # Stress tensors
+    F_invT = np.linalg.inv(F).transpose(0, 2, 1)
+    logJ = np.log(np.linalg.det(F)).reshape(-1, 1, 1)
+    P = mu * (F - F_invT) + lm * logJ * F_invT
+
+    # Stress differentials, transposing the axes (j, i, s, k) of D3 to (s, i, j, k)
+    F_invT_vec = np.linalg.inv(F).reshape(num_elements, dim2)
+    F_invT_outer = F_invT_vec[:, :, None] * F_invT_vec[:, None, :]
+    coeff = lm * np.log(np.linalg.det(F)) - mu
+    D3 = -coeff.reshape(-1, 1, 1, 1, 1) * F_invT_outer.reshape(-1, dim, dim, dim, dim)
+    D3 = D3.transpose(0, 3, 2, 1, 4).reshape(num_elements, dim2, dim2)
+    dP_dF = mu * np.eye(dim2) + lm * F_invT_outer + D3
+
+    return W, P, dP_dF
+
+
+def benchmark_fused(material: Material, sizes: List[int]):
+    '''
+    Compare the throughput (elements per second) of computing the energy densities, stress
+    tensors and stress differentials by separate unfused batched computations (see
+    `_unfused_evaluate_batch`) and by one fused call, and the cost of projecting the stress
+    differentials to positive semi-definite matrices.
+
+    Params:
+        * `material: Material` - the material model to benchmark
+        * `sizes: List[int]`   - numbers of elements to test
+    '''
+    print(f'------------ Benchmark: fused evaluation, material {material.type} ------------')
+    print(f'{"#elements":>10} {"unfused (elem/s)":>18} {"fused (elem/s)":>15} {"speedup":>8} '
+          f'{"fused+SPD (elem/s)":>19}')
+
+    for num_elements in sizes:
+        F = random_deformation_gradients(num_elements)
+
+        unfused_rate = num_elements / time_function(lambda: _unfused_evaluate_batch(material, F))
+        fused_rate = num_elements / time_function(lambda: material.evaluate_batch(F))
+        spd_rate = num_elements / time_function(
+            lambda: material.evaluate_batch(F, spd_projection=True), repeats=1)
+
+        print(f'{num_elements:>10} {unfused_rate:>18.4g} {fused_rate:>15.4g} '
+              f'{fused_rate / unfused_rate:>7.1f}x {spd_rate:>19.4g}')
+
+
+def cuboid_with_elements(num_elements: int, cube_size: float=0.025) -> TetMesh:
+    '''
+    Create a cube-shaped cuboid tet mesh with roughly `num_elements` tet elements (5 per cube).
+    '''
+    n = max(int(round((num_elements / 5) ** (1 / 3))), 1) + 1
+    return tet_mesh_cuboid(n, n, n, cube_size)
+
+
+def benchmark_scaling(material: Material, mesh: TetMesh, num_workers: List[int]):
+    '''
+    Measure the parallel scaling of stiffness matrix assembly and elastic force evaluation over
+    the number of worker threads.
+
+    Params:
+        * `material: Material`      - the material model to benchmark
+        * `mesh: TetMesh`           - the tet mesh to benchmark on
+        * `num_workers: List[int]`  - numbers of worker threads to test
+    '''
+    num_elements = mesh.elements.shape[0]
+    print(f'------------ Benchmark: parallel scaling, material {material.type}, '
+          f'{num_elements} elements ------------')
+    print(f'{"#workers":>8} {"assembly (s)":>13} {"speedup":>8} {"force (s)":>10} {"speedup":>8}')
+
+    # Evaluate at a slightly deformed shape
+    rng = np.random.default_rng(0)
+    V = mesh.vertices
+    vertices = V + rng.uniform(-1e-4, 1e-4, size=V.shape) * (V.max() - V.min())
+
+    base_times = None
+    for workers in num_workers:
+        fem = StaticFEM(mesh, material, num_workers=workers)
+        times = (time_function(lambda: fem.stiffness_matrix(vertices)),
+                 time_function(lambda: fem.elastic_force(vertices)))
+        base_times = base_times or times
+
+        print(f'{workers:>8} {times[0]:>13.4g} {base_times[0] / times[0]:>7.2f}x '
+              f'{times[1]:>10.4g} {base_times[1] / times[1]:>7.2f}x')
+
+
+def main():
+    '''
+    Main routine.
+    '''
+    # Command line argument parser
+    parser = argparse.ArgumentParser(description='Performance benchmark of the FEM components')
+    parser.add_argument('-n', '--max-elements', type=int, default=1000000,
+                        help='Largest number of elements to test (tests powers of 10 from 10^3)')
+    parser.add_argument('-l', '--max-loop-elements', type=int, default=100000,
+                        help='Max. number of elements evaluated by the per-element loop')
+    parser.add_argument('-w', '--max-workers', type=int, default=os.cpu_count() or 1,
+                        help='Max. number of worker threads in the parallel scaling benchmark')
+    parser.add_argument('-s', '--scaling-elements', type=int, default=200000,
+                        help='Approximate number of elements in the parallel scaling benchmark')
+
+    # Process arguments
+    args = parser.parse_args()
+
+    sizes = [10 ** p for p in range(3, 7) if 10 ** p <= args.max_elements]
+
+    # Numbers of workers in the scaling benchmark (powers of 2 and the max.)
+    max_workers = args.max_workers
+    num_workers = [2 ** p for p in range(max_workers.bit_length()) if 2 ** p < max_workers]
+    num_workers.append(max_workers)
+
+    # Run material model benchmarks
+    for material in (LinearElastic(E, nu), NeoHookean(E, nu)):
+        benchmark_material(material, sizes, args.max_loop_elements)
+        benchmark_fused(material, sizes)
+
+    # Run parallel scaling benchmarks
+    mesh = cuboid_with_elements(args.scaling_elements)
+    for material in (LinearElastic(E, nu), NeoHookean(E, nu)):
+        benchmark_scaling(material, mesh, num_workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+from material import Material, LinearElastic, NeoHookean
+from tet_mesh import TetMesh, tet_mesh_cuboid, tet_mesh_from_file
+from fem import StaticFEM
+from linear_solver import LINEAR_SOLVERS
+from main import boundary_conditions, cube_size, E, nu
+from benchmark import cuboid_with_elements, time_function
+from stiffness_io import load_stiffness_matrix, compare_stiffness_matrices
+
+from numpy import ndarray as array
+from contextlib import redirect_stdout
+from typing import Dict, List, Optional, Tuple
+
+import os
+import io
+import sys
+import csv
+import time
+import argparse
+import numpy as np
+
+
+# Data folder with the spot mesh and the reference results
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'assignment2')
+
+# Columns of the output CSV file
+CSV_FIELDS = [
+    'label', 'mesh', 'material', 'solver', 'elements', 'vertices', 'setup_time', 'assembly_time',
+    'assembly_rate', 'linear_time', 'linear_iterations', 'newton_time', 'newton_iterations',
+    'newton_linear_iterations', 'newton_converged', 'K_error', 'U_error', 'peak_memory',
+]
+
+
+def spot_boundary_conditions(vertices: array, external_force: array) -> Tuple[array, array]:
+    '''
+    Boundary conditions of the spot mesh for benchmarking. Vertices in the bottom 5% of the
+    height (the hooves) are fixed, and `external_force` is applied to vertices in the top 5%.
+    '''
+    h = vertices[:, 2] - vertices[:, 2].min()
+    bc = h < h.max() * 0.05
+
+    f_ext = np.zeros_like(vertices)
+    f_ext[h > h.max() * 0.95] = external_force
+
+    return f_ext, bc
+
+
+def read_stl_vertices(file_name: str) -> array:
+    '''
+    Read the triangle vertices of an ASCII STL file as an (F x 3 x 3) array.
+    '''
+    with open(file_name) as f:
+        vertices = [line.split()[1:] for line in f if line.lstrip().startswith('vertex')]
+    return np.array(vertices, dtype=float).reshape(-1, 3, 3)
+
+
+def check_reference(fem: StaticFEM, U: array, bc: array,
+                    name: str) -> Tuple[Optional[float], Optional[float]]:
+    '''
+    Compare the reduced stiffness matrix at the rest shape and the deformed mesh against the
+    references in `data/assignment2/std` (written by `main.py`), if they exist.
+
+    Return value:
+        * `K_error: float` - max. error of K relative to the largest entry of the reference
+        * `U_error: float` - max. vertex position error relative to the bounding box diagonal
+    '''
+    material_type = fem.material.type
+    K_file = os.path.join(DATA_DIR, 'std', f'K_{name}_{material_type}.txt')
+    stl_file = os.path.join(DATA_DIR, 'std', f'deformed_{name}_{material_type}.stl')
+
+    K_error, U_error = None, None
+    V = fem.mesh.vertices
+
+    if os.path.isfile(K_file):
+        result = compare_stiffness_matrices(fem.stiffness_matrix(V, bc),
+                                            load_stiffness_matrix(K_file))
+        K_error = result.get('max_rel_error', np.inf)
+
+    if os.path.isfile(stl_file):
+        triangles_ref = read_stl_vertices(stl_file)
+        triangles = fem.mesh.with_vertices(V + U).triangles()
+        if triangles.shape == triangles_ref.shape:
+            bbox_diagonal = np.linalg.norm(V.max(axis=0) - V.min(axis=0))
+            U_error = float(np.abs(triangles - triangles_ref).max() / bbox_diagonal)
+        else:
+            U_error = np.inf
+
+    return K_error, U_error
+
+
+def benchmark_case(mesh: TetMesh, mesh_name: str, material: Material, f_ext: array, bc: array,
+                   solver: str='cg', run_newton: bool=True, verbose: bool=False) -> Dict:
+    '''
+    Benchmark the FEM solver on a test case.
+
+    Params:
+        * `mesh: TetMesh`         - the tet mesh
+        * `mesh_name: str`        - name of the test case, which locates the reference results
+        * `material: Material`    - the material model
+        * `f_ext: array`          - (Nxd) external forces
+        * `bc: array`             - (N) the boundary condition mask
+        * `solver: str`           - the linear solver
+        * `run_newton: bool`      - whether to time Newton's method
+        * `verbose: bool`         - print the solver output
+
+    Return value:
+        * `row: Dict` - a row of the output CSV file (see `CSV_FIELDS`)
+    '''
+    # Solver output is hidden unless verbose
+    stdout = sys.stdout if verbose else io.StringIO()
+    V = mesh.vertices
+
+    with redirect_stdout(stdout):
+        fem = StaticFEM(mesh, material, solver)
+
+        # Full stiffness matrix assembly at the rest shape
+        assembly_time = time_function(lambda: fem.stiffness_matrix(V))
+
+        # Linear solve
+        U_linear, linear_stats = fem.solve_linear(f_ext, bc, return_stats=True)
+
+        # Newton's method
+        newton_stats = None
+        if run_newton:
+            U_newton, newton_stats = fem.solve_newton(f_ext, bc, return_stats=True)
+
+        # Compare the result of `main.py` against the references
+        U = U_linear if material.type == 'linear' else U_newton if run_newton else None
+        K_error, U_error = check_reference(fem, U, bc, mesh_name) if U is not None else \
+            (None, None)
+
+    num_elements = mesh.elements.shape[0]
+    row = {
+        'mesh': mesh_name,
+        'material': material.type,
+        'solver': solver,
+        'elements': num_elements,
+        'vertices': V.shape[0],
+        'setup_time': fem.setup_stats.total_time,
+        'assembly_time': assembly_time,
+        'assembly_rate': num_elements / assembly_time,
+        'linear_time': linear_stats.total_time,
+        'linear_iterations': linear_stats.linear_iterations,
+        'K_error': K_error,
+        'U_error': U_error,
+        'peak_memory': (newton_stats or linear_stats).peak_memory,
+    }
+    if newton_stats is not None:
+        row.update({
+            'newton_time': newton_stats.total_time,
+            'newton_iterations': newton_stats.info['iterations'],
+            'newton_linear_iterations': newton_stats.linear_iterations,
+            'newton_converged': newton_stats.info['converged'],
+        })
+
+    return row
+
+
+def write_rows(file_name: str, rows: List[Dict]):
+    '''
+    Append benchmark results to a CSV file, writing the header if the file is new.
+    '''
+    new_file = not os.path.isfile(file_name)
+    with open(file_name, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+        if new_file:
+            writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    '''
+    Main routine.
+    '''
+    # Command line argument parser
+    parser = argparse.ArgumentParser(description='Benchmark of the FEM solver over cuboid and '
+                                                 'real meshes')
+    parser.add_argument('-n', '--max-elements', type=int, default=1000000,
+                        help='Largest number of cuboid elements to test (tests powers of 10 from '
+                             '10^2)')
+    parser.add_argument('--max-newton-elements', type=int, default=None,
+                        help="Largest number of cuboid elements to run Newton's method on "
+                             '(defaults to --max-elements)')
+    parser.add_argument('-s', '--solver', default='cg', choices=list(LINEAR_SOLVERS),
+                        help='Linear solver for FEM (default to cg)')
+    parser.add_argument('-f', '--test-force', default='0,0,-50',
+                        help='The external force on cuboids (e.g., 0,0,-50)')
+    parser.add_argument('--spot-force', default='0,0,-1',
+                        help='The external force on the top vertices of spot (e.g., 0,0,-1)')
+    parser.add_argument('-o', '--output', default='benchmark_fem.csv',
+                        help='Output CSV file, where results are appended')
+    parser.add_argument('-l', '--label', default=time.strftime('%Y-%m-%d %H:%M:%S'),
+                        help='Label of this run in the output, e.g., a version name')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print the solver output')
+
+    # Process arguments
+    args = parser.parse_args()
+
+    sizes = [10 ** p for p in range(2, 7) if 10 ** p <= args.max_elements]
+    max_newton_elements = args.max_newton_elements or args.max_elements
+    test_force = np.array([float(c) for c in args.test_force.split(',')])
+    spot_force = np.array([float(c) for c in args.spot_force.split(',')])
+
+    # Test cases: the reference cuboid of `main.py`, cube-shaped cuboids of increasing sizes,
+    # and the spot mesh
+    cases = [('4x2x2', lambda: tet_mesh_cuboid(4, 2, 2, cube_size))]
+    for size in sizes:
+        cases.append((f'cuboid_{size}', lambda size=size: cuboid_with_elements(size, cube_size)))
+    cases.append(('spot', lambda: tet_mesh_from_file(
+        os.path.join(DATA_DIR, 'spot_tetmesh.dat'), max_size=cube_size * 10)))
+
+    print(f'{"mesh":<16} {"material":<10} {"#elements":>10} {"assembly (s)":>13} '
+          f'{"linear (s)":>11} {"newton (s)":>11} {"K error":>9} {"U error":>9}')
+
+    for name, create_mesh in cases:
+        mesh = create_mesh()
+        V = mesh.vertices
+        if name == 'spot':
+            f_ext, bc = spot_boundary_conditions(V, spot_force)
+        else:
+            f_ext, bc = boundary_conditions(V, test_force, tolerance=cube_size * 0.5)
+
+        run_newton = name == 'spot' or mesh.elements.shape[0] <= max_newton_elements
+
+        rows = []
+        for material in (LinearElastic(E, nu), NeoHookean(E, nu)):
+            row = benchmark_case(mesh, name, material, f_ext, bc, args.solver, run_newton,
+                                 args.verbose)
+            row['label'] = args.label
+            rows.append(row)
+
+            def fmt(key: str, width: int) -> str:
+                value = row.get(key)
+                return f'{"-":>{width}}' if value is None else f'{value:>{width}.3g}'
+
+            print(f'{name:<16} {material.type:<10} {row["elements"]:>10} '
+                  f'{fmt("assembly_time", 13)} {fmt("linear_time", 11)} '
+                  f'{fmt("newton_time", 11)} {fmt("K_error", 9)} {fmt("U_error", 9)}')
+
+        # Save the results after each mesh in case the benchmark is interrupted
+        write_rows(args.output, rows)
+
+    print(f"Benchmark results saved to '{args.output}'")
+
+
+if __name__ == '__main__':
+    main()
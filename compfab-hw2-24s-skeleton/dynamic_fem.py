@@ -0,0 +1,419 @@
+from tet_mesh import TetMesh, tet_mesh_cuboid
+from material import Material, LinearElastic, NeoHookean
+from fem import StaticFEM, StiffnessOperator
+from linear_solver import LINEAR_SOLVERS, LinearSolver, create_linear_solver
+
+from numpy import ndarray as array
+from scipy.sparse import spmatrix
+from scipy.sparse.linalg import LinearOperator
+from typing import Callable, Optional, Type, Tuple, Union
+
+import os
+import argparse
+import numpy as np
+
+
+# Implicit time integration schemes
+INTEGRATORS = ('euler', 'newmark')
+
+
+class MassShiftedOperator(LinearOperator):
+    '''
+    Matrix-free system matrix of implicit time steps, A = K + diag(m), where K is a stiffness
+    operator and m is the (scaled) lumped mass of each coordinate.
+    '''
+    def __init__(self, K: StiffnessOperator, mass_shift: array):
+        super().__init__(np.float64, K.shape)
+        self.K = K
+        self.mass_shift = mass_shift
+
+    def _matmat(self, X: array) -> array:
+        return self.K.matmat(X) + self.mass_shift[:, None] * X
+
+    def _matvec(self, x: array) -> array:
+        return self.K.matvec(x) + self.mass_shift * x
+
+    def _adjoint(self) -> LinearOperator:
+        # The operator is symmetric
+        return self
+
+    def diagonal(self) -> array:
+        return self.K.diagonal() + self.mass_shift
+
+
+class DynamicFEM(StaticFEM):
+    '''
+    Dynamic analysis using the finite element method (FEM) and implicit time integration.
+    '''
+    def __init__(self, mesh: TetMesh, material: Type[Material], density: float=1000.0,
+                 time_step: float=1e-3, integrator: str='newmark', newmark_beta: float=0.25,
+                 newmark_gamma: float=0.5, **kwargs):
+        '''
+        The constructor takes as input a tet mesh (`mesh`), a material model (`material`), the
+        mass density of the material (`density`, in kg/m^3) and the time step size (`time_step`,
+        in seconds). Other keyword arguments are passed to `StaticFEM`.
+
+        `integrator` selects the time integration scheme:
+            * 'euler'   - implicit (backward) Euler, which is first-order accurate and damps out
+                          high frequencies. It is the most robust choice for large time steps.
+            * 'newmark' - the Newmark-beta method with parameters `newmark_beta` and
+                          `newmark_gamma`. The default (1/4, 1/2) is the average acceleration
+                          method, which is second-order accurate, unconditionally stable and
+                          does not damp vibrations of linear elastic solids.
+
+        The mass matrix is lumped, i.e., each tet element distributes its mass equally to its
+        vertices, so that it is diagonal.
+        '''
+        super().__init__(mesh, material, **kwargs)
+
+        # Check input validity
+        assert density > 0, 'The density must be positive'
+        assert time_step > 0, 'The time step size must be positive'
+        assert 0 < newmark_beta <= 0.5 and 0 < newmark_gamma <= 1, \
+            'The Newmark parameters must satisfy 0 < beta <= 1/2 and 0 < gamma <= 1'
+        if integrator not in INTEGRATORS:
+            raise ValueError(f"Unknown integrator '{integrator}', should be one of "
+                             f"{list(INTEGRATORS)}")
+
+        self.density = density
+        self.time_step = time_step
+        self.integrator = integrator
+        self.newmark_beta = newmark_beta
+        self.newmark_gamma = newmark_gamma
+
+        # Lumped vertex masses
+        self.masses = self.lumped_masses(density)
+
+        # Positions of diagonal entries in the data array of the reduced stiffness matrix, cached
+        # together with its index array
+        self.diagonal_cache = None
+
+        # Information of the last simulation
+        self.dynamics_info = None
+
+    def gravity_forces(self, gravity: array=(0.0, 0.0, -9.81)) -> array:
+        '''
+        Compute the (Nxd) gravitational forces on all vertices given the gravitational
+        acceleration `gravity` (d).
+        '''
+        return self.masses[:, None] * np.asarray(gravity, dtype=np.float64)
+
+    def diagonal_positions(self, K: spmatrix) -> array:
+        '''
+        Return the positions of the diagonal entries of the CSC matrix `K` in its data array.
+        The result only depends on the sparsity pattern, which is cached by the index array.
+        '''
+        if self.diagonal_cache is None or self.diagonal_cache[0] is not K.indices:
+            cols = np.arange(K.shape[1]).repeat(np.diff(K.indptr))
+            self.diagonal_cache = K.indices, np.flatnonzero(K.indices == cols)
+        return self.diagonal_cache[1]
+
+    def dynamic_matrix(self, vertices: array, boundary_conditions: array,
+                       mass_shift: array) -> Union[spmatrix, MassShiftedOperator]:
+        '''
+        Compute the reduced system matrix of an implicit time step, A = K + diag(mass_shift),
+        where `mass_shift` is the lumped mass of each unconstrained coordinate divided by
+        c * h^2 (see `simulate`). A has the sparsity pattern of K and, in matrix-free mode, is
+        applied without assembly.
+        '''
+        K = self.system_matrix(vertices, boundary_conditions)
+        if self.matrix_free:
+            return MassShiftedOperator(K, mass_shift)
+
+        # The data array of K is freshly allocated, so the diagonal can be updated in place
+        # without touching the cached sparsity pattern
+        K.data[self.diagonal_positions(K)] += mass_shift
+        return K
+
+    def simulate(self, external_forces: Union[array, Callable[[float], array]],
+                 boundary_conditions: array, num_steps: int,
+                 initial_displacement: Optional[array]=None,
+                 initial_velocity: Optional[array]=None, output_file: Optional[str]=None,
+                 frame_interval: int=1,
+                 frame_callback: Optional[Callable[[int, float, array], None]]=None,
+                 solver: Union[str, LinearSolver, None]=None, max_newton_iters: int=20,
+                 max_line_search_iters: int=20, residual_tol: float=1e-4,
+                 jacobian_update_interval: int=1,
+                 return_stats: bool=False) -> Tuple[array, array]:
+        '''
+        Simulate the dynamics of the mesh by implicit time integration. Each time step solves
+        the nonlinear equation of motion
+            M * a(U) = f_ext(t) + f_el(U),    a(U) = (U - U_pred) / (c * h^2)
+        for the displacements U at the end of the step using Newton's method, where h is the time
+        step size. For implicit Euler, U_pred = U_n + h * v_n and c = 1. For Newmark, U_pred =
+        U_n + h * v_n + h^2 * (1/2 - beta) * a_n and c = beta. Each Newton iteration solves a
+        linear system with the matrix A = M / (c * h^2) + K(U).
+
+        The system matrix reuses the cached sparsity pattern of K, and the same matrix is kept
+        across Newton iterations and time steps for `jacobian_update_interval` iterations, so that
+        the linear solver reuses its preconditioner or factorization meanwhile. For the linear
+        elastic material, A is constant and only assembled once.
+
+        Instead of keeping the trajectory in memory, every `frame_interval`-th frame (including
+        the initial state) is streamed to disk and/or passed to `frame_callback`.
+
+        Params:
+            * `external_forces: array`      - (Nxd) external forces, or a function of time that
+                returns them
+            * `boundary_conditions: array`  - (N) boolean mask of fixed vertices
+            * `num_steps: int`              - number of time steps
+            * `initial_displacement: array` - (Nxd) optional initial displacements (zero by
+                default)
+            * `initial_velocity: array`     - (Nxd) optional initial velocities (zero by default)
+            * `output_file: str`            - optional '.npy' file that receives the (Nxd)
+                displacements of all frames as a (F x N x d) array, written through a memory map
+            * `frame_interval: int`         - number of time steps between saved frames
+            * `frame_callback`              - optional function called with the frame index,
+                the time and the (Nxd) displacements of each frame, e.g., to write meshes
+            * `solver`                      - optional linear solver, see `StaticFEM.solve_linear`
+            * `max_newton_iters: int`       - max. number of Newton iterations per time step
+            * `max_line_search_iters: int`  - max. number of line search iterations
+            * `residual_tol: float`         - absolute residual force tolerance of Newton's method
+            * `jacobian_update_interval: int` - number of Newton iterations between updates of
+                the system matrix (ignored for the linear elastic material)
+            * `return_stats: bool`          - also return the solver statistics
+
+        Return value:
+            * `U: array` - (Nxd) displacements at the end of the simulation
+            * `v: array` - (Nxd) velocities at the end of the simulation
+            * `stats: SolveStats` - solver statistics (only if `return_stats` is True)
+        '''
+        # Check input validity
+        assert num_steps >= 0, 'The number of time steps must be non-negative'
+        assert frame_interval >= 1, 'The frame interval must be at least 1'
+        assert max_newton_iters >= 1 and max_line_search_iters >= 1, \
+            'The iteration budgets must be at least 1'
+        assert jacobian_update_interval >= 1, 'The Jacobian update interval must be at least 1'
+
+        # Store class member data into local variables
+        V = self.mesh.vertices     # (Nx3), N = #vertices
+        dim = V.shape[1]           # d = #dimensions
+        h = self.time_step
+
+        # Get the linear solver
+        solver = self.solver if solver is None else create_linear_solver(solver)
+        if self.matrix_free:
+            self.check_matrix_free_solver(solver)
+        stats = self.start_stats('dynamics')
+
+        # Constant external forces are wrapped as a function of time
+        if callable(external_forces):
+            force_function = external_forces
+        else:
+            force_function = lambda t: external_forces
+
+        # Apply boundary conditions and set up the integrator
+        with stats.timer('slicing'):
+            active_mask = (~boundary_conditions).repeat(dim)
+            m = self.masses.repeat(dim)[active_mask]
+            c = 1.0 if self.integrator == 'euler' else self.newmark_beta
+            mass_shift = m / (c * h * h)
+
+            def reduce(X: Optional[array]) -> array:
+                return np.zeros_like(m) if X is None else X.ravel()[active_mask].copy()
+
+            U_n, v_n = reduce(initial_displacement), reduce(initial_velocity)
+
+        def vertices_at(U: array) -> array:
+            V_U = V.copy()
+            V_U.ravel()[active_mask] += U
+            return V_U
+
+        def reduced_elastic_force(U: array) -> array:
+            with stats.timer('elastic_force'):
+                return self.elastic_force(vertices_at(U)).ravel()[active_mask]
+
+        # Initial acceleration from the equation of motion (needed by Newmark only)
+        f_el = reduced_elastic_force(U_n)
+        a_n = (reduce(force_function(0.0)) + f_el) / m
+
+        # The output file holds the displacements of all frames and is written through a memory
+        # map, so the trajectory never resides in memory
+        num_frames = num_steps // frame_interval + 1
+        frames = None
+        if output_file is not None:
+            frames = np.lib.format.open_memmap(output_file, mode='w+', dtype=V.dtype,
+                                               shape=(num_frames, *V.shape))
+
+        def write_frame(frame: int, t: float, U: array):
+            with stats.timer('output'):
+                U_full = np.zeros_like(V)
+                U_full.ravel()[active_mask] = U
+                if frames is not None:
+                    frames[frame] = U_full
+                if frame_callback is not None:
+                    frame_callback(frame, t, U_full)
+
+        write_frame(0, 0.0, U_n)
+
+        self.dynamics_info = {'steps': 0, 'time': 0.0, 'newton_iterations': 0,
+                              'assemblies': 0, 'failed_steps': 0, 'converged': True}
+        stats.info = self.dynamics_info
+
+        # The system matrix is constant for linear elasticity
+        constant_matrix = self.material.type == 'linear'
+        A, A_age = None, 0
+
+        for step in range(num_steps):
+            t = (step + 1) * h
+            f_ext = reduce(force_function(t))
+
+            # Predict the displacements from the current state, which is the initial guess
+            if self.integrator == 'euler':
+                U_pred = U_n + h * v_n
+            else:
+                U_pred = U_n + h * v_n + h * h * (0.5 - self.newmark_beta) * a_n
+
+            U = U_pred.copy()
+            f_el = reduced_elastic_force(U)
+            converged = False
+
+            for it in range(max_newton_iters):
+                # Residual forces of the equation of motion
+                f_res = f_ext + f_el - mass_shift * (U - U_pred)
+                f_res_norm = np.linalg.norm(f_res)
+                if f_res_norm < residual_tol:
+                    converged = True
+                    break
+
+                # Update the system matrix if it is missing or outdated
+                if A is None or (not constant_matrix and A_age >= jacobian_update_interval):
+                    with stats.timer('assembly'):
+                        A = self.dynamic_matrix(vertices_at(U), boundary_conditions, mass_shift)
+                    A_age = 0
+                    self.dynamics_info['assemblies'] += 1
+
+                with stats.timer('solve'):
+                    dU = self.linear_solve(solver, A, f_res)
+                A_age += 1
+                self.dynamics_info['newton_iterations'] += 1
+
+                # Backtracking line search on the residual norm
+                l = 1.0
+                with stats.timer('line_search'):
+                    for _ in range(max_line_search_iters):
+                        U_l = U + dU * l
+                        f_el_l = reduced_elastic_force(U_l)
+                        f_res_l_norm = np.linalg.norm(f_ext + f_el_l - mass_shift * (U_l - U_pred))
+                        if f_res_l_norm < f_res_norm:
+                            break
+                        l *= 0.5
+
+                # Without a valid step, retry with an up-to-date system matrix unless it is
+                # already current
+                if not f_res_l_norm < f_res_norm:
+                    if constant_matrix or A_age <= 1:
+                        f_res_norm = f_res_l_norm
+                        break
+                    A_age = jacobian_update_interval
+                    continue
+
+                U, f_el = U_l, f_el_l
+
+                # Exit the loop if the residual after the update is sufficiently small, which
+                # also counts convergence on the last allowed iteration
+                f_res_norm = f_res_l_norm
+                if f_res_norm < residual_tol:
+                    converged = True
+                    break
+
+            stats.residual_history.append(float(f_res_norm))
+            if not converged:
+                self.dynamics_info['failed_steps'] += 1
+                self.dynamics_info['converged'] = False
+                print(f"Warning - Newton's method did not converge at step {step + 1} "
+                      f"(residual error = {f_res_norm:.3g})")
+                if not np.isfinite(f_res_norm):
+                    break
+
+            # Update the velocities and accelerations
+            a = (U - U_pred) / (c * h * h)
+            if self.integrator == 'euler':
+                v_n = (U - U_n) / h
+            else:
+                v_n = v_n + h * ((1 - self.newmark_gamma) * a_n + self.newmark_gamma * a)
+            U_n, a_n = U, a
+            self.dynamics_info.update(steps=step + 1, time=t)
+
+            if (step + 1) % frame_interval == 0:
+                write_frame((step + 1) // frame_interval, t, U_n)
+
+        if frames is not None:
+            frames.flush()
+            del frames
+
+        # Obtain the full-size displacements and velocities
+        U_full, v_full = np.zeros_like(V), np.zeros_like(V)
+        U_full.ravel()[active_mask] = U_n
+        v_full.ravel()[active_mask] = v_n
+
+        self.finish_stats(stats)
+        return (U_full, v_full, stats) if return_stats else (U_full, v_full)
+
+
+def main():
+    '''
+    Simulate a cuboid cantilever released from rest under gravity.
+    '''
+    # Command line argument parser
+    parser = argparse.ArgumentParser(description='Implicit dynamics of a cuboid cantilever')
+    parser.add_argument('-c', '--cuboid-size', default='20x4x4',
+                        help='The size of the cuboid (e.g., 20x4x4)')
+    parser.add_argument('-M', '--material', default='linear', choices=['linear', 'neohookean'],
+                        help='The material model (default to linear)')
+    parser.add_argument('-i', '--integrator', default='newmark', choices=list(INTEGRATORS),
+                        help='The time integration scheme (default to newmark)')
+    parser.add_argument('-s', '--solver', default='cg', choices=list(LINEAR_SOLVERS),
+                        help='Linear solver (default to cg)')
+    parser.add_argument('-n', '--num-steps', type=int, default=200, help='Number of time steps')
+    parser.add_argument('-t', '--time-step', type=float, default=1e-4,
+                        help='Time step size in seconds')
+    parser.add_argument('-r', '--density', type=float, default=1000.0,
+                        help='Mass density in kg/m^3')
+    parser.add_argument('-o', '--output', default='frames.npy',
+                        help='Output file of the displacements of all frames')
+    parser.add_argument('--frame-interval', type=int, default=1,
+                        help='Number of time steps between saved frames')
+    parser.add_argument('--stl-dir', default=None,
+                        help='Optional folder to write the surface of each frame as binary STL')
+    parser.add_argument('--stats-file', default=None,
+                        help='Append solver statistics to this file in JSON Lines format')
+
+    # Process arguments
+    args = parser.parse_args()
+
+    # Material parameters (Young's modulus and Poisson's ratio) and cube size, same as `main.py`
+    E, nu, cube_size = 10000000, 0.45, 0.025
+    material = LinearElastic(E, nu) if args.material == 'linear' else NeoHookean(E, nu)
+
+    nx, ny, nz = (int(s) for s in args.cuboid_size.split('x'))
+    mesh = tet_mesh_cuboid(nx, ny, nz, cube_size)
+
+    fem = DynamicFEM(mesh, material, args.density, args.time_step, args.integrator,
+                     solver=args.solver, stats_file=args.stats_file)
+
+    # Fix the left-most side and apply gravity
+    V = mesh.vertices
+    bc = V[:, 0] < V[:, 0].min() + cube_size * 0.5
+    f_ext = fem.gravity_forces()
+
+    # Optionally write the surface of each frame
+    frame_callback = None
+    if args.stl_dir is not None:
+        os.makedirs(args.stl_dir, exist_ok=True)
+
+        def frame_callback(frame: int, t: float, U: array):
+            mesh.with_vertices(V + U).write_to_file(
+                os.path.join(args.stl_dir, f'frame_{frame:05d}.stl'), binary=True,
+                surface_only=True)
+
+    U, _ = fem.simulate(f_ext, bc, args.num_steps, output_file=args.output,
+                        frame_interval=args.frame_interval, frame_callback=frame_callback)
+
+    print(fem.stats.summary())
+    print(f"Tip deflection after {fem.dynamics_info['time']:.4g}s: {U[:, 2].min():.4g}m")
+    print(f"Frames saved to '{args.output}'")
+
+
+if __name__ == '__main__':
+    main()
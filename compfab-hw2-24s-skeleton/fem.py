@@ -1,72 +1,557 @@
 from tet_mesh import TetMesh
 from material import Material
+from linear_solver import LinearSolver, create_linear_solver
+from telemetry import SolveStats
 
 from numpy import ndarray as array
 from scipy.sparse import csc_matrix, spmatrix
-from scipy.sparse.linalg import cg
-from functools import partial
-from typing import Type, List
+from scipy.sparse.linalg import LinearOperator
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Type, Tuple, Union
 
 import numpy as np
 
-# CG solver
-conjugate_gradient = partial(cg, tol=1e-5)
+
+# Function that applies a callback to consecutive chunks (slices) of tet elements
+ChunkMap = Callable[[Callable[[slice], None]], None]
+
+
+def compute_sparsity_pattern(row_inds: array, col_inds: array,
+                             shape: Tuple[int, int]) -> Tuple[array, array, array]:
+    '''
+    Compute the CSC sparsity pattern of a sparse matrix from the (row, column) indices of its
+    triplets, where triplets with the same (row, column) index are summed up.
+
+    Params:
+        * `row_inds: array`         - (M), row indices of the triplets
+        * `col_inds: array`         - (M), column indices of the triplets
+        * `shape: Tuple[int, int]`  - shape of the sparse matrix
+
+    Return value:
+        * `indices: array`  - (nnz), row indices of the CSC matrix
+        * `indptr: array`   - (#cols + 1), column pointers of the CSC matrix
+        * `data_map: array` - (M), the position of each triplet in the CSC data array
+    '''
+    num_rows, num_cols = shape
+
+    # Sort the triplets by column first and then by row, which is the storage order of CSC
+    keys = col_inds.astype(np.int64).ravel() * num_rows + row_inds.ravel()
+    unique_keys, data_map = np.unique(keys, return_inverse=True)
+
+    # Use 32-bit indices whenever possible, which is what the sparse solvers expect
+    index_dtype = np.int32 if max(unique_keys.size, num_rows) < 2 ** 31 else np.int64
+    indices = (unique_keys % num_rows).astype(index_dtype)
+    indptr = np.searchsorted(unique_keys // num_rows, np.arange(num_cols + 1))
+    indptr = indptr.astype(index_dtype)
+    data_map = data_map.ravel().astype(index_dtype)
+
+    return indices, indptr, data_map
+
+
+def map_chunks(func: Callable[[slice], None], num_items: int, chunk_size: int,
+               executor: Optional[ThreadPoolExecutor]=None):
+    '''
+    Call `func` on consecutive slices of `num_items` items, each with at most `chunk_size`
+    items. The slices are processed by the thread pool `executor` if specified, which pays off
+    since NumPy releases the GIL in batched array operations. `func` should write its results
+    into disjoint parts of a preallocated output, so that the results do not depend on the
+    order the chunks finish in.
+    '''
+    chunks = [slice(i, min(i + chunk_size, num_items)) for i in range(0, num_items, chunk_size)]
+    if executor is None or len(chunks) <= 1:
+        for chunk in chunks:
+            func(chunk)
+    else:
+        # Consume the iterator to propagate exceptions
+        for _ in executor.map(func, chunks):
+            pass
+
+
+def check_element_geometry(Dm: array, tol: float=1e-8) -> array:
+    '''
+    Check the rest shape of tet elements before inverting Dm. Degenerate elements, whose
+    |det(Dm)| is at most `tol` times the cube of their longest edge, are reported all at once
+    with a ValueError. Elements oriented opposite to the majority of the mesh (inverted) only
+    trigger a warning, since the orientation convention varies across meshes.
+
+    Params:
+        * `Dm: array`   - (T x d x d) rest shape matrices of tet elements
+        * `tol: float`  - relative tolerance of degenerate elements
+
+    Return value:
+        * `det_Dm: array` - (T) determinants of Dm
+    '''
+    det_Dm = np.linalg.det(Dm)
+
+    # Compare |det(Dm)| with the longest edge, which makes the test scale invariant
+    edges = np.concatenate((Dm, Dm[:, :, [1, 2, 0]] - Dm), axis=2)
+    max_edge = np.linalg.norm(edges, axis=1).max(axis=1)
+    degenerate = np.nonzero(np.abs(det_Dm) <= tol * max_edge ** 3)[0]
+    if degenerate.size:
+        raise ValueError(f'Found {degenerate.size} degenerate tet elements, e.g., '
+                         f'{degenerate[:10].tolist()}')
+
+    # Find the elements with the minority orientation
+    num_negative = np.count_nonzero(det_Dm < 0)
+    if 0 < num_negative < det_Dm.size:
+        inverted = np.nonzero((det_Dm < 0) == (num_negative * 2 < det_Dm.size))[0]
+        print(f'Warning - found {inverted.size} inverted tet elements, e.g., '
+              f'{inverted[:10].tolist()}')
+
+    return det_Dm
+
+
+def compute_dF_dx(Dm_inv: array) -> array:
+    '''
+    Compute dF/dx (T x d^2 x (d+1)d) of all tet elements from Dm^(-1), where the rows follow the
+    column-major flattening of F.
+    '''
+    dim, dim2 = Dm_inv.shape[1], Dm_inv.shape[1] ** 2
+
+    # The formula is dF/dx = d(Ds * Dm^(-1))/dx = d(Ds)/dx * Dm^(-1)
+    ## Compute dF/dx1
+    dF_dx1 = np.eye(dim) * -Dm_inv.sum(axis=1).reshape(-1, dim, 1, 1)
+    dF_dx1 = dF_dx1.reshape(-1, dim2, dim)
+
+    ## Compute dF/d(x2, x3, ..., xm), where m is the simplex size (4 for a tet mesh)
+    dF_dx_others = np.eye(dim) * Dm_inv.transpose(0, 2, 1).reshape(-1, dim, dim, 1, 1)
+    dF_dx_others = dF_dx_others.transpose(0, 1, 3, 2, 4).reshape(-1, dim2, dim2)
+    return np.dstack((dF_dx1, dF_dx_others))
+
+
+def shape_gradients(Dm_inv: array) -> array:
+    '''
+    Compute the gradients of the linear shape functions of all tet elements (T x (d+1) x d),
+    such that F = SUM_i x_i * g_i^T. This is a compact form of dF/dx.
+    '''
+    return np.concatenate((-Dm_inv.sum(axis=1, keepdims=True), Dm_inv), axis=1)
+
+
+class StiffnessOperator(LinearOperator):
+    '''
+    Matrix-free stiffness matrix. The product K * u is computed element by element, i.e.,
+        K * u = SUM_t volume_t * dF/dx_t^T * dP/dF_t * dF/dx_t * u_t
+    where u_t (12) gathers the entries of u at the vertices of tet element t. Only the stress
+    differentials at the current deformation are stored, which takes no memory at all for the
+    linear elastic material since its stress differential is constant.
+    '''
+    def __init__(self, dof_map: array, dF_dx: Optional[array], dP_dF: array, volumes: array,
+                 num_dofs: int, active_mask: Optional[array]=None,
+                 Dm_inv: Optional[array]=None, map_elements: Optional[ChunkMap]=None):
+        '''
+        Params:
+            * `dof_map: array`     - (T x 4d), the global coordinate indices of each tet element
+            * `dF_dx: array`       - (T x d^2 x 4d), dF/dx of all tet elements, or None to
+                compute its products from `Dm_inv` on the fly
+            * `dP_dF: array`       - (T x d^2 x d^2), dP/dF of all tet elements
+            * `volumes: array`     - (T), volumes of tet elements
+            * `num_dofs: int`      - total number of coordinates (Nd)
+            * `active_mask: array` - (Nd), optional mask of unconstrained coordinates. If
+                specified, the operator acts on the unconstrained coordinates only.
+            * `Dm_inv: array`      - (T x d x d), Dm^(-1) of all tet elements, required if
+                `dF_dx` is None
+            * `map_elements`       - optional function that runs a callback over chunks of
+                elements (see `StaticFEM.map_elements`). All elements are processed at once by
+                default.
+        '''
+        # Determine the operator size
+        size = num_dofs if active_mask is None else int(np.count_nonzero(active_mask))
+        super().__init__(np.float64, (size, size))
+
+        # Save the element data. Without dF/dx, the shape function gradients are used instead
+        self.dof_map = dof_map
+        self.dF_dx = dF_dx
+        self.shape_gradients = shape_gradients(Dm_inv) if dF_dx is None else None
+        self.dP_dF = dP_dF
+        self.volumes = volumes
+        self.num_dofs = num_dofs
+        self.active_mask = active_mask
+        self.map_elements = map_elements or (lambda func: func(slice(None)))
+
+        # A constant stress differential is broadcast over all elements (zero stride) and can be
+        # applied by a single matrix product
+        self.dP_dF_const = dP_dF[0] if dP_dF.strides[0] == 0 else None
+
+    def element_forces(self, X: array, f: array, s: slice):
+        '''
+        Compute the element forces Kt * u_t (4d x L) of the elements in slice `s` and write them
+        into `f`.
+        '''
+        # Store class member data into local variables
+        dof_map, volumes = self.dof_map[s], self.volumes[s]
+        num_cols = X.shape[1]
+
+        # Gather the element vectors (T x 4d x L) and compute dF = dF/dx * u_t (T x d^2 x L)
+        G = self.shape_gradients[s] if self.shape_gradients is not None else None
+        if G is None:
+            dF_dx = self.dF_dx[s]
+            dF = dF_dx @ X[dof_map]
+        else:
+            dF = G.transpose(0, 2, 1) @ X[dof_map].reshape(G.shape[0], G.shape[1], -1)
+            dF = dF.reshape(G.shape[0], -1, num_cols)
+
+        # Compute dP = volume * dP/dF * dF
+        if self.dP_dF_const is not None:
+            dP = self.dP_dF_const @ dF
+        else:
+            dP = self.dP_dF[s] @ dF
+        dP *= volumes.reshape(-1, 1, 1)
+
+        # Compute the element forces dF/dx^T * dP
+        if G is None:
+            np.matmul(dF_dx.transpose(0, 2, 1), dP, out=f[s])
+        else:
+            f[s] = (G @ dP.reshape(G.shape[0], G.shape[2], -1)).reshape(G.shape[0], -1, num_cols)
+
+    def _matmat(self, X: array) -> array:
+        # Store class member data into local variables
+        dof_map = self.dof_map
+        active_mask = self.active_mask
+        num_cols = X.shape[1]
+
+        # Expand X to all coordinates
+        if active_mask is not None:
+            X_full = np.zeros((self.num_dofs, num_cols))
+            X_full[active_mask] = X
+            X = X_full
+
+        # Compute the element forces chunk by chunk and scatter them into the output
+        f = np.empty(dof_map.shape + (num_cols,))
+        self.map_elements(lambda s: self.element_forces(X, f, s))
+        Y = np.stack([np.bincount(dof_map.ravel(), weights=f[:, :, i].ravel(),
+                                  minlength=self.num_dofs) for i in range(num_cols)], axis=1)
+
+        return Y if active_mask is None else Y[active_mask]
+
+    def _matvec(self, x: array) -> array:
+        return self._matmat(x.reshape(-1, 1)).reshape(-1)
+
+    def _adjoint(self) -> LinearOperator:
+        # The stiffness matrix is symmetric
+        return self
+
+    def diagonal(self) -> array:
+        '''
+        Compute the diagonal of the stiffness matrix (used by the Jacobi preconditioner).
+        '''
+        G = self.shape_gradients
+        if G is None:
+            Kt_diag = np.einsum('tia,tij,tja->ta', self.dF_dx, self.dP_dF, self.dF_dx)
+        else:
+            # dF/dx of coordinate c of vertex i has entries G[i, b] at the rows (b, c) of vec(F)
+            dim = G.shape[2]
+            dP_dF = self.dP_dF.reshape(-1, dim, dim, dim, dim)
+            Kt_diag = np.einsum('tib,tbcdc,tid->tic', G, dP_dF, G).reshape(G.shape[0], -1)
+        Kt_diag *= self.volumes.reshape(-1, 1)
+        diag = np.bincount(self.dof_map.ravel(), weights=Kt_diag.ravel(),
+                           minlength=self.num_dofs)
+        return diag if self.active_mask is None else diag[self.active_mask]
 
 
 class StaticFEM:
     '''
     Static analysis using the finite element method (FEM).
     '''
-    def __init__(self, mesh: TetMesh, material: Type[Material]):
+    def __init__(self, mesh: TetMesh, material: Type[Material],
+                 solver: Union[str, LinearSolver]='cg', matrix_free: bool=False,
+                 compact: bool=False, dtype: np.dtype=np.float64, degenerate_tol: float=1e-8,
+                 num_workers: int=1, chunk_size: int=16384, stats_file: Optional[str]=None,
+                 spd_projection: bool=False):
         '''
         The constructor takes as input a tet mesh (`mesh`) and a material model (`material`).
+        Optionally, `solver` specifies the default linear solver by its name in `LINEAR_SOLVERS`
+        (see `linear_solver.py`) or as a solver object.
+
+        If `matrix_free` is True, the solvers apply the stiffness matrix element by element
+        through `stiffness_operator` instead of assembling it, and the sparsity pattern of K is
+        not precomputed. This only works with iterative solvers that do not need the entries of
+        K (`cg` and `jacobi`).
+
+        To reduce memory on large meshes, `compact` stores Dm^(-1) (T x 3 x 3) instead of the
+        mostly zero dF/dx (T x 9 x 12) and computes its products on the fly, and `dtype` (e.g.,
+        np.float32) sets the storage precision of the element geometry. Together with
+        `matrix_free`, this takes less than 100 bytes per element with float32. Elements whose
+        relative volume is below `degenerate_tol` are reported by a ValueError (see
+        `check_element_geometry`).
+
+        Element contributions to forces and stiffness are computed in chunks of `chunk_size`
+        elements, which bounds the size of temporary arrays. With `num_workers` > 1, the chunks
+        are processed by a thread pool. The results are identical for any number of workers.
+
+        If `spd_projection` is True, the stress differentials dP/dF of all elements are projected
+        to positive semi-definite matrices (see `material.project_spd`) before computing the
+        stiffness. The stiffness matrix then stays positive semi-definite far from the rest
+        shape, so Newton's method always gets a descent direction at the cost of an
+        eigendecomposition per element.
+
+        Every solve function records its statistics (phase times, linear solves, residuals and
+        peak memory) in `self.stats` (see `telemetry.py`), and the precomputation is recorded in
+        `self.setup_stats`. If `stats_file` is specified, these statistics are also appended to
+        the file in JSON Lines format.
         '''
-        # Extract vertices and tet elements from the input argument
-        V, T = mesh.vertices, mesh.elements
+        # Time the precomputation
+        self.setup_stats = SolveStats('setup')
+        self.stats_file = stats_file
+
+        # Save the input arguments
+        self.mesh = mesh
+        self.material = material
+
+        # Precompute the element geometry
+        with self.setup_stats.timer('geometry'):
+            self.init_geometry(compact, dtype, degenerate_tol)
+
+        # Default linear solver
+        self.solver = create_linear_solver(solver)
+        self.matrix_free = matrix_free
+
+        # Check the solver for the matrix-free mode
+        if matrix_free:
+            self.check_matrix_free_solver(self.solver)
+
+        self.spd_projection = spd_projection
+
+        # Thread pool for element computations
+        assert num_workers >= 1 and chunk_size >= 1, \
+            'The number of workers and the chunk size must be positive'
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.executor = ThreadPoolExecutor(num_workers) if num_workers > 1 else None
+
+        # Statistics of the linear solves in the last call to a solve function
+        self.solver_stats: List[Dict] = []
+
+        # Statistics of the last call to `solve_newton` and `solve_continuation`
+        self.newton_info: Dict = {}
+        self.continuation_info: Dict = {}
+
+        # Statistics of the last call to a solve function
+        self.stats: Optional[SolveStats] = None
+
+        # Precompute the sparsity pattern of K unless the stiffness matrix is never assembled
+        self.K_indices, self.K_indptr, self.K_data_map = None, None, None
+        if not matrix_free:
+            self.init_sparsity_pattern()
+
+        # Cache of the reduced sparsity pattern for the last boundary condition mask
+        self.reduced_pattern_cache = None
+
+        self.finish_stats(self.setup_stats)
+
+    def init_geometry(self, compact: bool, dtype: np.dtype, degenerate_tol: float):
+        '''
+        Precompute the element geometry, i.e., Dm^(-1) (`self.Dm_inv`), dF/dx (`self.dF_dx`,
+        None in compact mode), the tet volumes (`self.volumes`) and the DOF indices of the
+        element stiffness matrices (`self.dof_map`). See the constructor for the parameters.
+        '''
+        # Extract vertices and tet elements from the input mesh
+        V, T = self.mesh.vertices, self.mesh.elements
 
         # Constants
-        dim, dim2 = V.shape[1], V.shape[1] ** 2
+        dim = V.shape[1]
 
         # Recall that F = Ds * Dm^(-1), where
         #   - Ds = [x2 - x1, x3 - x1, x4 - x1] is the bases after deformation
         #   - Dm = [X2 - X1, X3 - X1, X4 - X1] is the bases before deformation
-        # Here we precompute Dm^(-1) for all tet elements
+        # Here we precompute Dm^(-1) for all tet elements, after checking for degenerate ones
         tet_vertices = V[T.ravel()].reshape(-1, T.shape[1], dim)
         Dm = (tet_vertices[:, 1:] - tet_vertices[:, [0]]).transpose(0, 2, 1)
+        det_Dm = check_element_geometry(Dm, degenerate_tol)
         Dm_inv = np.linalg.inv(Dm)
 
-        # Precompute dF/dx for all tet elements
-        # The formula is dF/dx = d(Ds * Dm^(-1))/dx = d(Ds)/dx * Dm^(-1)
-        ## Compute dF/dx1
-        dF_dx1 = np.eye(dim) * -Dm_inv.sum(axis=1).reshape(-1, dim, 1, 1)
-        dF_dx1 = dF_dx1.reshape(-1, dim2, dim)
-
-        ## Compute dF/d(x2, x3, ..., xm), where m is the simplex size (4 for a tet mesh)
-        dF_dx_others = np.eye(dim) * Dm_inv.transpose(0, 2, 1).reshape(-1, dim, dim, 1, 1)
-        dF_dx_others = dF_dx_others.transpose(0, 1, 3, 2, 4).reshape(-1, dim2, dim2)
-        dF_dx = np.dstack((dF_dx1, dF_dx_others))
+        # Precompute dF/dx for all tet elements unless it is computed on the fly
+        self.dF_dx = None if compact else compute_dF_dx(Dm_inv).astype(dtype, copy=False)
+        self.Dm_inv = Dm_inv.astype(dtype, copy=False)
 
         # Precompute tet volumes
-        volumes = np.abs(np.linalg.det(Dm)) * (1 / 6)
+        self.volumes = (np.abs(det_Dm) * (1 / 6)).astype(dtype, copy=False)
 
-        # Save the input arguments
-        self.mesh = mesh
-        self.material = material
+        # The i-th row/column of an element stiffness matrix Kt (12x12) maps to the
+        # dof_map[i]-th row/column of K
+        index_dtype = np.int32 if V.size < 2 ** 31 else np.int64
+        dof_map = (T[:, :, None] * dim + np.arange(dim)).reshape(T.shape[0], -1)
+        self.dof_map = dof_map.astype(index_dtype, copy=False)
 
-        # Save the precomputed values
-        self.Dm_inv = Dm_inv
-        self.dF_dx = dF_dx
-        self.volumes = volumes
+    def init_sparsity_pattern(self):
+        '''
+        Precompute the sparsity pattern of the stiffness matrix K. The mesh topology never
+        changes, so the triplet indices of all element stiffness matrices and their positions in
+        the CSC data array of K are computed only once.
+        '''
+        dof_map = self.dof_map
+        num_dofs = self.mesh.vertices.size
+
+        row_inds = np.broadcast_to(dof_map[:, :, None], dof_map.shape + dof_map.shape[1:])
+        col_inds = np.broadcast_to(dof_map[:, None, :], row_inds.shape)
+        with self.setup_stats.timer('sparsity_pattern'):
+            self.K_indices, self.K_indptr, self.K_data_map = \
+                compute_sparsity_pattern(row_inds, col_inds, (num_dofs, num_dofs))
 
-    def elastic_force(self, vertices: array) -> array:
+    def start_stats(self, name: str) -> SolveStats:
         '''
-        Compute the internal elastic force at current vertex positions.
+        Start recording the statistics of a solve function named `name` in `self.stats`. The
+        linear solves are also recorded in `self.solver_stats`.
+        '''
+        self.solver_stats = []
+        self.stats = SolveStats(name, self.solver_stats)
+        return self.stats
+
+    def finish_stats(self, stats: SolveStats):
+        '''
+        Finish recording the statistics and append them to the statistics file, if any.
+        '''
+        stats.finish()
+        if self.stats_file is not None:
+            stats.write_json(self.stats_file)
+
+    @staticmethod
+    def check_matrix_free_solver(solver: LinearSolver):
+        '''
+        Check whether a linear solver works with the matrix-free stiffness operator.
+        '''
+        if solver.requires_matrix:
+            raise ValueError(f"The '{solver.name}' solver requires an assembled stiffness "
+                             f"matrix and cannot be used in matrix-free mode")
+
+    def reduced_sparsity_pattern(self, boundary_conditions: array) -> Tuple[array, array, array]:
+        '''
+        Compute the sparsity pattern of the reduced stiffness matrix, where the rows and columns of
+        constrained coordinates are removed. The pattern is derived from the full sparsity pattern
+        and cached for the last boundary condition mask.
+
+        Params:
+            * `boundary_conditions: array` - (N), a boolean mask array over the vertices. Those
+                masked by True are assumed to be fixed and excluded from the solver.
+
+        Return value:
+            * `indices: array`  - (nnz), row indices of the reduced CSC matrix
+            * `indptr: array`   - (#active coordinates + 1), column pointers of the CSC matrix
+            * `data_map: array` - (T x 4d x 4d), the position of each element stiffness entry in
+                the CSC data array. Entries of constrained coordinates point to the extra slot at
+                index `nnz`.
+        '''
+        # Look up the cache
+        cache = self.reduced_pattern_cache
+        if cache is not None and np.array_equal(cache[0], boundary_conditions):
+            return cache[1]
+
+        # Compute the full sparsity pattern on demand
+        if self.K_indices is None:
+            self.init_sparsity_pattern()
+
+        # Store class member data into local variables
+        dim = self.mesh.vertices.shape[1]
+        indices, indptr = self.K_indices, self.K_indptr
+
+        # Renumber the unconstrained coordinates
+        active_mask = (~boundary_conditions).repeat(dim)    # The mask of unconstrained coordinates
+        active_indices = np.nonzero(active_mask)[0]         # Indices of unconstrained coordinates
+        active_ids = np.zeros(active_mask.size, dtype=indices.dtype)
+        active_ids[active_indices] = np.arange(active_indices.size)
+
+        # Keep the nonzeros of K whose row and column are both unconstrained
+        col_inds = np.repeat(np.arange(active_mask.size), np.diff(indptr))
+        keep = active_mask[indices] & active_mask[col_inds]
+        keep_offsets = np.concatenate(([0], np.cumsum(keep)))
+        num_keep = keep_offsets[-1]
+
+        # Compute the reduced CSC index arrays. Constrained columns contain no nonzeros, so the
+        # column pointers are simply read off at unconstrained columns
+        reduced_indices = active_ids[indices[keep]]
+        reduced_indptr = keep_offsets[np.append(indptr[active_indices], indptr[-1])]
+        reduced_indptr = reduced_indptr.astype(indptr.dtype)
+
+        # Redirect the element stiffness entries to the reduced data array
+        nnz_map = np.full(indices.size, num_keep, dtype=self.K_data_map.dtype)
+        nnz_map[keep] = np.arange(num_keep)
+        reduced_data_map = nnz_map[self.K_data_map]
+
+        # Save the result to the cache
+        pattern = reduced_indices, reduced_indptr, reduced_data_map
+        self.reduced_pattern_cache = boundary_conditions.copy(), pattern
+        return pattern
+
+    def map_elements(self, func: Callable[[slice], None]):
+        '''
+        Call `func` on consecutive chunks (slices) of tet elements, in parallel if the solver has
+        multiple workers (see `map_chunks`).
+        '''
+        map_chunks(func, self.mesh.elements.shape[0], self.chunk_size, self.executor)
+
+    def lumped_masses(self, density: float) -> array:
+        '''
+        Compute the (N) lumped vertex masses given the mass density of the material, where each
+        tet element contributes a quarter of its mass to each of its vertices.
+        '''
+        V, T = self.mesh.vertices, self.mesh.elements
+        element_masses = density * self.volumes.astype(np.float64) / T.shape[1]
+        return np.bincount(T.ravel(), weights=element_masses.repeat(T.shape[1]),
+                           minlength=V.shape[0])
+
+    def rigid_body_modes(self, boundary_conditions: Optional[array]=None) -> array:
+        '''
+        Compute the rigid body modes of the mesh (3 translations and 3 rotations around the
+        centroid), which span the nullspace of the full stiffness matrix at the rest shape.
+
+        Return value:
+            * `B: array` - (Nd x 6) the rigid body modes, or (M x 6) if `boundary_conditions` is
+                specified, where only the unconstrained coordinates are kept
+        '''
+        V = self.mesh.vertices
+        X = V - V.mean(axis=0)
+
+        B = np.zeros((*V.shape, 6))
+        B[:, 0, 0] = B[:, 1, 1] = B[:, 2, 2] = 1.0
+        B[:, 1, 3], B[:, 2, 3] = -X[:, 2], X[:, 1]
+        B[:, 0, 4], B[:, 2, 4] = X[:, 2], -X[:, 0]
+        B[:, 0, 5], B[:, 1, 5] = -X[:, 1], X[:, 0]
+        B = B.reshape(-1, 6)
+
+        if boundary_conditions is not None:
+            B = B[(~boundary_conditions).repeat(V.shape[1])]
+        return B
+
+    def deformation_gradient(self, vertices: array, elements: slice=slice(None)) -> array:
+        '''
+        Compute the deformation gradients of all tet elements at current vertex positions.
 
         Params:
             * `vertices: array` - (Nxd) current vertex positions, N = #vertices, d = #dimensions
+            * `elements: slice` - optional range of tet elements to compute
 
         Return value:
-            * `f: spmatrix` - (Nxd) the elastic force matrix
+            * `F: array` - (Txdxd) deformation gradients, T = #elements
+        '''
+        # Compute Ds = [x2 - x1, x3 - x1, x4 - x1] for all tet elements at once
+        tet_vertices = vertices[self.mesh.elements[elements]]
+        Ds = (tet_vertices[:, 1:] - tet_vertices[:, [0]]).transpose(0, 2, 1)
+
+        # Compute F = Ds * Dm^(-1)
+        F = Ds @ self.Dm_inv[elements]
+        return F
+
+    def stress_differential(self, F: array) -> array:
+        '''
+        Compute the stress differentials dP/dF (T x 9 x 9) from the deformation gradients F
+        (T x 3 x 3) of tet elements, with the optional projection set in the constructor.
+        '''
+        return self.material.evaluate_batch(F, energy=False, stress=False,
+                                            spd_projection=self.spd_projection)[2]
+
+    def elastic_force(self, vertices: array,
+                      return_energy: bool=False) -> Union[array, Tuple[array, float]]:
+        '''
+        Compute the internal elastic force at current vertex positions.
+
+        Params:
+            * `vertices: array`     - (Nxd) current vertex positions, N = #vertices,
+                                      d = #dimensions
+            * `return_energy: bool` - also return the total elastic energy, which is evaluated
+                                      together with the stress tensors
+
+        Return value:
+            * `f: spmatrix`     - (Nxd) the elastic force matrix
+            * `energy: float`   - the total elastic energy (only if `return_energy` is True)
         '''
         # Store class member data into local variables
         V = self.mesh.vertices      # (Nx3), N = #vertices
@@ -74,7 +559,6 @@ class StaticFEM:
 
         material = self.material    # Material model
 
-        Dm_inv = self.Dm_inv        # (Tx3x3), Dm^(-1)
         dF_dx = self.dF_dx          # (Tx9x12), dF/dx
         volumes = self.volumes      # (T), volumes of tet elements
 
@@ -87,197 +571,287 @@ class StaticFEM:
         num_tets = T.shape[0]
         dim = V.shape[1]
 
-        # Initialize the force matrix
+        # The nodal forces and the elastic energies of all tet elements
+        dE_dx = np.empty((num_tets, T.shape[1], dim))
+        energies = np.empty(num_tets) if return_energy else None
+
+        def compute_chunk(s: slice):
+            # Compute the deformation gradients and stress tensors of the tet elements in chunk s
+            F = self.deformation_gradient(vertices, s)
+            W, P, _ = material.evaluate_batch(F, energy=return_energy, tangent=False)
+            num_chunk_tets = P.shape[0]
+
+            if return_energy:
+                energies[s] = volumes[s] * W
+
+            # Compute dE/dx = volume * vec(P) * dF/dx for all tet elements, where vec(P) flattens
+            # P column by column. A batched matrix product reproduces the per-element
+            # vector-matrix product bit by bit, whereas `np.einsum` may sum in a different order
+            if dF_dx is not None:
+                P_vec = volumes[s].reshape(-1, 1, 1) * \
+                        P.transpose(0, 2, 1).reshape(num_chunk_tets, 1, -1)
+                dE_dx[s] = (P_vec @ dF_dx[s]).reshape(num_chunk_tets, -1, dim)
+
+            # With compact geometry, the same product is dE/dx_i = volume * P * g_i, where g_i is
+            # the shape function gradient of vertex i
+            else:
+                G = shape_gradients(self.Dm_inv[s])
+                dE_dx[s] = volumes[s].reshape(-1, 1, 1) * (G @ P.transpose(0, 2, 1))
+
+        self.map_elements(compute_chunk)
+
+        # Scatter the nodal forces into the force matrix f. `np.add.at` accumulates repeated
+        # indices in element order, which matches a sequential loop over tet elements
         f = np.zeros_like(V)
+        np.add.at(f, T, -dE_dx)
 
-        # Iterate over all tet elements
-        for t in range(num_tets):
-            # Compute the deformation gradient F
-            tet_indices = T[t]
-            tet_vertices = vertices[tet_indices]
-            F = (tet_vertices[1:] - tet_vertices[0]).T @ Dm_inv[t]
+        # Suppress negative zeroes
+        f = np.where(np.abs(f) < 1e-8, 0, f)
+        return (f, float(energies.sum())) if return_energy else f
 
-            # Compute dE/dx
-            P = material.stress_tensor(F)
-            dE_dx = volumes[t] * P.T.ravel() @ dF_dx[t]
+    def element_stiffness(self, vertices: array) -> array:
+        '''
+        Compute the stiffness matrices of all tet elements given the current vertex positions.
 
-            # Add the nodal forces to the force matrix f
-            f[tet_indices] -= dE_dx.reshape(-1, dim)
+        Params:
+            * `vertices: array` - (Nxd) current vertex positions, N = #vertices, d = #dimensions
 
-        # Suppress negative zeroes
-        f = np.where(np.abs(f) < 1e-8, 0, f)
-        return f
+        Return value:
+            * `Kt: array` - (T x 4d x 4d) element stiffness matrices, T = #elements
+        '''
+        # Store class member data into local variables
+        volumes = self.volumes      # (T), volumes of tet elements
+
+        # The element stiffness matrices of all tet elements
+        T = self.mesh.elements
+        Kt = np.empty((T.shape[0], T.shape[1] * 3, T.shape[1] * 3))
+
+        def compute_chunk(s: slice):
+            # Get dF/dx, or compute it temporarily with compact geometry
+            dF_dx = self.dF_dx[s] if self.dF_dx is not None else compute_dF_dx(self.Dm_inv[s])
+
+            # Compute the deformation gradients and stress differentials of the tet elements
+            F = self.deformation_gradient(vertices, s)
+            dP_dF = self.stress_differential(F)
+
+            # Compute Kt (see the derivation below)
+            dP_dx = dP_dF @ dF_dx
+            Kt_chunk = volumes[s].reshape(-1, 1, 1) * dF_dx.transpose(0, 2, 1) @ dP_dx
 
-    def stiffness_matrix(self, vertices: array) -> spmatrix:
+            # Suppress negative zeroes
+            Kt[s] = np.where(np.abs(Kt_chunk) < 1e-8, 0, Kt_chunk)
+
+        # Compute the contribution of each tet element t to the stiffness matrix K
+        # Formula: Kt = d^2(Et)/d(xt)^2, where
+        #   - Et (scalar) is the strain energy of t
+        #   - xt (4x3) is the vertex positions of t
+        #   - Kt (12x12) is the contribtion from t to K
+        # If we apply the chain rule (the subscript t is omitted for simplicity):
+        #   dE/dx = volume * dW/dx
+        #         = volume * dW/dF * dF/dx
+        #         = volume * P * dF/dx
+        #   d^E/dx^2 = volume * d(P * dF/dx)/dx
+        #            = volume * dP/dx * dF/dx            (d^2F/dx^2 is zero)
+        #            = volume * (dP/dF * dF/dx) * dF/dx
+        self.map_elements(compute_chunk)
+        return Kt
+
+    def stiffness_matrix(self, vertices: array, boundary_conditions: array=None) -> spmatrix:
         '''
         Compute the stiffness matrix given the current vertex positions.
 
         Params:
-            * `vertices: array` - (Nxd) current vertex positions, N = #vertices, d = #dimensions
+            * `vertices: array`            - (Nxd) current vertex positions, N = #vertices,
+                d = #dimensions
+            * `boundary_conditions: array` - (N), optional boolean mask array over the vertices.
+                If specified, the rows and columns of vertices masked by True are excluded from
+                the output, which is equivalent to `K[active_indices][:, active_indices]`.
 
         Return value:
-            * `K: spmatrix` - (Nd x Nd) the sparse stiffness matrix
+            * `K: spmatrix` - (Nd x Nd) the sparse stiffness matrix, or (M x M) the reduced
+                stiffness matrix where M = #unconstrained coordinates
         '''
         # Store class member data into local variables
         V = self.mesh.vertices      # (Nx3), N = #vertices
-        T = self.mesh.elements      # (Tx4), T = #elements
 
-        material = self.material    # Material model
+        # Check input validity
+        assert vertices.shape == V.shape, \
+            f'The passed-in vertices must match the shape of tet vertices. Expected {V.shape} ' \
+            f'but got {vertices.shape} instead'
 
-        Dm_inv = self.Dm_inv        # (Tx3x3), Dm^(-1)
-        dF_dx = self.dF_dx          # (Tx9x12), dF/dx
-        volumes = self.volumes      # (T), volumes of tet elements
+        # Get the sparsity pattern of the full or the reduced stiffness matrix
+        if boundary_conditions is None:
+            if self.K_indices is None:
+                self.init_sparsity_pattern()
+            indices, indptr, data_map = self.K_indices, self.K_indptr, self.K_data_map
+        else:
+            indices, indptr, data_map = self.reduced_sparsity_pattern(boundary_conditions)
+
+        num_dofs = indptr.size - 1
+
+        # Compute the element stiffness matrices
+        Kt = self.element_stiffness(vertices)
+
+        # Sum up the elements of all Kt's into the CSC data array of K using the precomputed
+        # sparsity pattern. Entries sharing the same position in K are added together, and the
+        # entries of constrained coordinates are gathered in a trailing slot that is discarded.
+        # Note that K shares the index arrays with the cached sparsity pattern, so it should not
+        # be modified in place
+        data = np.bincount(data_map, weights=Kt.ravel(), minlength=indices.size + 1)
+        K = csc_matrix((data[:indices.size], indices, indptr), shape=(num_dofs, num_dofs))
+        return K
+
+    def stiffness_operator(self, vertices: array,
+                           boundary_conditions: array=None) -> StiffnessOperator:
+        '''
+        Compute the matrix-free stiffness operator given the current vertex positions. The
+        operator can substitute the output of `stiffness_matrix` in iterative solvers.
 
+        Params:
+            * `vertices: array`            - (Nxd) current vertex positions, N = #vertices,
+                d = #dimensions
+            * `boundary_conditions: array` - (N), optional boolean mask array over the vertices.
+                If specified, the operator acts on the unconstrained coordinates only.
+
+        Return value:
+            * `K: StiffnessOperator` - (Nd x Nd) or (M x M) the stiffness operator
+        '''
         # Check input validity
+        V = self.mesh.vertices
         assert vertices.shape == V.shape, \
             f'The passed-in vertices must match the shape of tet vertices. Expected {V.shape} ' \
             f'but got {vertices.shape} instead'
 
-        # Constants
-        num_vertices, num_tets = V.shape[0], T.shape[0]
-        dim, simplex_size = V.shape[1], T.shape[1]
-
-        # Initialize an empty list of triplets for the output sparse matrix
-        triplets: List[int, int, float] = [[0, 0, 0.0]]
-
-        # Iterate over all tet elements
-        for t in range(num_tets):
-            # Compute the deformation gradient F
-            # Formula: F = Ds * Dm^(-1), where
-            #   - Dm = [x2 - x1, x3 - x1, x4 - x1] is the bases after deformation
-            #   - Ds = [X2 - X1, X3 - X1, X4 - X1] is the bases before deformation
-            # We have precomputed Dm^(-1) in the constructor, now we only care about Ds
-            # --------
-            # TODO: Your code here. The steps for computing F are as follows:
-            #   1. Get the vertices of the current tet element, dubbed as `tet_vertices`
-            #   2. Compute Ds
-            #   3. Compute F using the formula
-            # HINT:
-            #   - Consider how to index or slice the matrices to perform vectorized calculation,
-            #     i.e., conducting multiple concurrent math operations using a single Python
-            #     operator. For example,
-            #       * The addtion of two vectors `a` and `b` is simply written as `c = a + b`,
-            #         where c[i] = a[i] + b[i]
-            #       * The row-wise addtion of matrix `A` and vector `b` is written as `C = A + b`,
-            #         where C[i, j] = a[i, j] + b[j]
-            #   - Use `A.T` or `np.transpose(A)` to transpose a 2D array A
-            #   - Use the `@` operator for matrix multiplication
-            tet_vertices = vertices[T[t]]
-            Ds = ...    # <--
-            F = ...     # <--
-
-            # Compute tet element t's contribution to the stiffness matrix K
-            # Formula: Kt = d^2(Et)/d(xt)^2, where
-            #   - Et (scalar) is the strain energy of t
-            #   - xt (4x3) is the vertex positions of t, represented by the varaible `tet_vertices`
-            #   - Kt (12x12) is the contribtion from t to K
-            # If we apply the chain rule (the subscript t is omitted for simplicity):
-            #   dE/dx = volume * dW/dx
-            #         = volume * dW/dF * dF/dx
-            #         = volume * P * dF/dx
-            #   d^E/dx^2 = volume * d(P * dF/dx)/dx
-            #            = volume * dP/dx * dF/dx            (d^2F/dx^2 is zero, can you see why?)
-            #            = volume * (dP/dF * dF/dx) * dF/dx
-
-            # Let's first prepare the operands
-            # --------
-            # TODO: Your code here. Get the volume of t, dP/dF and dF/dx.
-            vol = ...       # <--
-            dP_dF = ...     # <--
-            dF_dxt = ...    # <--
-
-            # Compute Kt using the formula above
-            # --------
-            # TODO: Your code here. Compute Kt in two steps:
-            #   1. Compute dP/dx = dP/dF * dF/dx
-            #   2. Compute Kt = volume * dP/dx * dF/dx
-            # HINT:
-            #   - Use the `@` operator for matrix multiplication
-            #   - Some matrix should be transposed in Step 2
-            dP_dxt = ...    # <--
-            Kt = np.zeros((simplex_size * dim, simplex_size * dim))     # <--
+        # Compute the stress differentials at the current deformation
+        F = self.deformation_gradient(vertices)
+        dP_dF = self.stress_differential(F)
 
-            # Suppress negative zeroes
-            Kt = np.where(np.abs(Kt) < 1e-8, 0, Kt)
+        # Get the mask of unconstrained coordinates
+        active_mask = None
+        if boundary_conditions is not None:
+            active_mask = (~boundary_conditions).repeat(V.shape[1])
 
-            # Assign the elements of Kt to their right positions in the global matrix K
-            #
-            # Just like HW3, K is represented by a list of triplets (row_ind, col_ind, val) which
-            # refers to the row index, column index, and the value of each element. Note that
-            # triplets associated with the same element index (row_ind, col_ind) are summed up
-            # automatically when creating the sparse matrix.
-            #
-            # Therefore, we can simply create m^2 triplets for every Kt assuming that Kt is a mxm
-            # matrix. To avoid writing deep nested loops in Python (very slow), let's adopt
-            # the following strategy:
-            #   1. Figure out an index mapping from Kt to K, dubbed as `index_map`. `index_map` is
-            #      a array of length m and maps the i-th row/column in Kt to the index_map[i]-th
-            #      row/column in K. Mathematically, m = `simplex_size * dim`.
-            #   2. Iterate over all elements in Kt to create cooresponding triplets for K. This
-            #      step only requires a double nested loop.
-
-            # Construct the index mapping from Kt to K
-            # --------
-            # TODO: Your code here. Implement step 1.
-            m = Kt.shape[0]
-            index_map = np.zeros(m, dtype=np.int64)
-            for i in []:        # <--
-                for j in []:    # <--
-                    ...         # <--
-
-            # Create m^2 triplets for K
-            # --------
-            # TODO: Your code here. Implement step 2.
-            for i in []:        # <--
-                for j in []:    # <--
-                    ...         # <--
-
-        # Construct the sparse matrix K
-        row_inds, col_inds, vals = list(zip(*triplets))
-        K = csc_matrix((vals, (row_inds, col_inds)),
-                       shape=(num_vertices * dim, num_vertices * dim))
-        return K
+        return StiffnessOperator(self.dof_map, self.dF_dx, dP_dF, self.volumes, V.size,
+                                 active_mask, self.Dm_inv, self.map_elements)
+
+    def system_matrix(self, vertices: array,
+                      boundary_conditions: array) -> Union[spmatrix, StiffnessOperator]:
+        '''
+        Compute the reduced stiffness matrix or, in matrix-free mode, the reduced stiffness
+        operator for the solvers.
+        '''
+        if self.matrix_free:
+            return self.stiffness_operator(vertices, boundary_conditions)
+        return self.stiffness_matrix(vertices, boundary_conditions)
 
-    def solve_linear(self, external_forces: array, boundary_conditions: array) -> array:
+    def linear_solve(self, solver: LinearSolver, K: spmatrix, f: array,
+                     x0: Optional[array]=None, tol: Optional[float]=None) -> array:
+        '''
+        Solve K * x = f using a linear solver and record the solver statistics. `x0` and `tol` are
+        the optional initial guess and relative tolerance for iterative solvers.
+        '''
+        x, info = solver.solve(K, f, x0, tol)
+        self.solver_stats.append(info)
+
+        if not info['converged']:
+            print(f"Warning - {info['solver']} solver failed to converge "
+                  f"(residual = {info['residual']:.3g})")
+
+        return x
+
+    def solve_linear(self, external_forces: array, boundary_conditions: array,
+                     solver: Union[str, LinearSolver, None]=None,
+                     return_stats: bool=False) -> Union[array, Tuple[array, SolveStats]]:
         '''
         Solve mesh deformation from the linear equations K * U = f_ext.
 
         Params:
-            * `external_forces: array`     - (Nxd), external forces, N = #vertices, d = #dimensions
+            * `external_forces: array`     - (Nxd), external forces, N = #vertices, d = #dimensions.
+                A stack of L load cases can be passed in as a (LxNxd) array, in which case the
+                stiffness matrix is assembled and factorized (or preconditioned) only once.
             * `boundary_conditions: array` - (N), a boolean mask array over the vertices. Those
                 masked by True are assumed to be fixed and excluded from the solver.
+            * `solver`                     - the linear solver (name or object) for this call,
+                defaults to the solver specified in the constructor
+            * `return_stats: bool`         - also return the statistics of this call
 
         Return Value:
-            * `U: array` - (Nxd), deformation matrix
+            * `U: array` - (Nxd) or (LxNxd), deformation matrix
+            * `stats: SolveStats` - statistics of this call (only if `return_stats` is True),
+                which are also saved in `self.stats`
         '''
         # Store class member data into local variables
         V = self.mesh.vertices      # (Nx3), N = #vertices
         dim = V.shape[1]            # d = #dimensions
 
-        # Compute the stiffness matrix
-        K_full = self.stiffness_matrix(V)
+        # Check input validity
+        assert external_forces.shape[-2:] == V.shape and external_forces.ndim in (2, 3), \
+            f'The external forces must be shaped as {V.shape} or (L, *{V.shape}), but got ' \
+            f'{external_forces.shape} instead'
+
+        # Get the linear solver
+        solver = self.solver if solver is None else create_linear_solver(solver)
+        if self.matrix_free:
+            self.check_matrix_free_solver(solver)
+        stats = self.start_stats('linear')
 
         # Apply boundary conditions by removing fixed points
-        active_mask = (~boundary_conditions).repeat(dim)    # The mask of unconstrained coordinates
-        active_indices = np.nonzero(active_mask)[0]         # Indices of unconstrained coordinates
+        with stats.timer('slicing'):
+            active_mask = (~boundary_conditions).repeat(dim)    # The mask of unconstrained coords
+
+        # Compute the reduced stiffness matrix directly from the boundary conditions
+        with stats.timer('assembly'):
+            K = self.system_matrix(V, boundary_conditions)      # The actual stiffness matrix
+
+        # The actual external forces we use, stacked as columns for multiple load cases
+        with stats.timer('slicing'):
+            num_cases = external_forces.shape[0] if external_forces.ndim == 3 else 1
+            f_ext = external_forces.reshape(num_cases, -1)[:, active_mask].T
+
+        # Solve the linear equation
+        with stats.timer('solve'):
+            U = self.linear_solve(solver, K, f_ext if num_cases > 1 else f_ext[:, 0])
+        info = self.solver_stats[-1]
+        stats.residual_history.append(info['residual'])
+        print(f"Linear solver '{info['solver']}' finished in {info['iterations']} iterations "
+              f"(residual = {info['residual']:.3g}, "
+              f"time = {info['setup_time'] + info['solve_time']:.3g}s)")
 
-        K = K_full[active_indices][:, active_indices]       # The actual stiffness matrix we use
-        f_ext = external_forces.ravel()[active_mask]        # The actual external forces we use
+        # Obtain the full-size deformation matrix
+        with stats.timer('slicing'):
+            U_full = np.zeros((num_cases, V.size))
+            U_full[:, active_mask] = U.reshape(-1, num_cases).T
+            U_full = U_full.reshape(external_forces.shape)
 
-        # Solve the linear equation using the conjugate gradient method
-        U, stat = conjugate_gradient(K, f_ext)
-        if stat != 0:
-            print('Warning - CG solver failed with status', stat)
-        else:
-            print('CG solver finished')
+        self.finish_stats(stats)
+        return (U_full, stats) if return_stats else U_full
 
-        # Obtain the full-size deformation matrix
-        U_full = np.zeros_like(V)
-        U_full.ravel()[active_mask] = U
-        return U_full
+    def solve_load_cases(self, external_forces: array, boundary_conditions: array,
+                         solver: Union[str, LinearSolver, None]=None) -> Tuple[array, array]:
+        '''
+        Solve the linear deformation under multiple load cases sharing the same boundary
+        conditions, and compute the compliance C = f_ext^T * U of each case.
+
+        Params:
+            * `external_forces: array`     - (LxNxd), external forces of L load cases
+            * `boundary_conditions: array` - (N), the boundary condition mask (see `solve_linear`)
+            * `solver`                     - the linear solver (name or object) for this call
+
+        Return Value:
+            * `U: array`          - (LxNxd), deformation matrices
+            * `compliance: array` - (L), compliance values
+        '''
+        U = self.solve_linear(external_forces, boundary_conditions, solver)
+        compliance = np.einsum('lij,lij->l', external_forces, U)
+        return U, compliance
 
     def solve_newton(self, external_forces: array, boundary_conditions: array,
-                     max_iters: int=1000, max_line_search_iters: int=20) -> array:
+                     max_iters: int=1000, max_line_search_iters: int=20,
+                     solver: Union[str, LinearSolver, None]=None, warm_start: bool=True,
+                     jacobian_update_interval: int=1, inexact: bool=True,
+                     max_forcing_term: float=0.5,
+                     initial_displacement: Optional[array]=None,
+                     return_stats: bool=False) -> Union[array, Tuple[array, SolveStats]]:
         '''
         Solve mesh deformation using Newton's method. Instead of solving K * U = f_ext, Newton's
         method iteratively solves the following equation:
@@ -291,30 +865,94 @@ class StaticFEM:
                 masked by True are assumed to be fixed and excluded from the solver.
             * `max_iters: int`             - maximum iterations for the Newton's method
             * `max_line_search_iters: int` - maximum iterations of the line search algorithm
+            * `solver`                     - the linear solver (name or object) for this call,
+                defaults to the solver specified in the constructor
+            * `warm_start: bool`           - start iterative linear solvers from the update
+                direction of the previous iteration instead of zero
+            * `jacobian_update_interval: int` - recompute the stiffness matrix every this many
+                iterations (modified Newton). In between, the linear solver reuses the
+                factorization or preconditioner of the lagged stiffness matrix. The stiffness
+                matrix is always recomputed after a failed line search.
+            * `inexact: bool`              - use an inexact Newton method, where the relative
+                tolerance of iterative linear solvers (the forcing term) is loose far from
+                convergence and tightens as the residual decreases
+            * `max_forcing_term: float`    - the upper bound of the forcing term
+            * `initial_displacement: array` - (Nxd), optional initial guess of the deformation.
+                Newton's method starts from the rest shape by default.
+            * `return_stats: bool`         - also return the statistics of this call
+
+        With `spd_projection` (see the constructor), the stiffness matrix only guarantees a
+        descent direction of the total potential energy rather than the residual error, so the
+        line search also accepts steps that sufficiently decrease the potential energy (the
+        Armijo condition).
 
         Return Value:
-            * `U: array` - (Nxd), deformation matrix
+            * `U: array` - (Nxd), deformation matrix. The number of iterations, the final residual
+                error, and whether Newton's method converged are saved in `self.newton_info`.
+            * `stats: SolveStats` - statistics of this call (only if `return_stats` is True),
+                including the residual error of every iteration, which are also saved in
+                `self.stats`
         '''
         # Check input validity
         assert max_iters >= 1 and max_line_search_iters >= 1, \
             'The iteration budgets must be at least 1'
+        assert jacobian_update_interval >= 1, 'The Jacobian update interval must be at least 1'
 
         # Store class member data into local variables
         V = self.mesh.vertices     # (Nx3), N = #vertices
         dim = V.shape[1]           # d = #dimensions
 
+        # Get the linear solver
+        solver = self.solver if solver is None else create_linear_solver(solver)
+        if self.matrix_free:
+            self.check_matrix_free_solver(solver)
+        stats = self.start_stats('newton')
+
+        # Newton's method stops when the residual error is below this threshold
+        residual_tol = 1e-4
+
         # Apply boundary conditions to external forces
-        active_mask = (~boundary_conditions).repeat(dim)    # The mask of unconstrained coordinates
-        active_indices = np.nonzero(active_mask)[0]         # Indices of unconstrained coordinates
-        f_ext = external_forces.ravel()[active_mask]        # The reduced external force vector
+        with stats.timer('slicing'):
+            active_mask = (~boundary_conditions).repeat(dim)    # The mask of unconstrained coords
+            f_ext = external_forces.ravel()[active_mask]        # The reduced external forces
 
-        # Initialize the stiffness matrix
-        K_full = self.stiffness_matrix(V)
-        K = K_full[active_indices][:, active_indices]       # The reduced stiffness matrix
+        # Line search on the total potential energy (elastic energy - f_ext^T * U) as well
+        energy_line_search = self.spd_projection
 
-        # Initialize the elastic force matrix and the solution
-        f_el = np.zeros_like(f_ext)
+        # Initialize the solution, the elastic force matrix and the potential energy (zero at
+        # the rest shape)
         Ui = np.zeros_like(f_ext)
+        f_el = np.zeros_like(f_ext)
+        energy_i = 0.0
+        V_i = V
+        if initial_displacement is not None:
+            with stats.timer('elastic_force'):
+                Ui[:] = initial_displacement.ravel()[active_mask]
+                V_i = V.copy()
+                V_i.ravel()[active_mask] += Ui
+                f_el_full, elastic_energy = self.elastic_force(V_i, return_energy=True)
+                f_el[:] = f_el_full.ravel()[active_mask]
+                energy_i = elastic_energy - f_ext @ Ui
+        dU = None
+
+        # Give up if the initial guess is invalid (e.g., has inverted elements)
+        self.newton_info = {'iterations': 0, 'converged': False, 'line_search_iterations': 0,
+                            'residual': float(np.linalg.norm(f_ext + f_el))}
+        stats.info = self.newton_info
+        stats.residual_history.append(self.newton_info['residual'])
+        if not np.isfinite(self.newton_info['residual']):
+            print("Warning - Newton's method got an invalid initial guess")
+            self.finish_stats(stats)
+            return (initial_displacement, stats) if return_stats else initial_displacement
+
+        # Initialize the reduced stiffness matrix
+        with stats.timer('assembly'):
+            K = self.system_matrix(V_i, boundary_conditions)
+        K_age = 0           # Number of iterations since the last stiffness matrix update
+
+        # Initialize the forcing term of the inexact Newton method
+        eta = max_forcing_term if inexact else None
+        f_res_norm_last = None
 
         # Our solver has a predefined budget of `max_iters` iterations
         for it in range(max_iters):
@@ -325,88 +963,211 @@ class StaticFEM:
             # residual forces `f_res`:
             #    f_res = f_ext + f_el
             # The update direction is dubbed as `dU`, where dU = U - Ui.
-            # --------
-            # TODO: Your code here. Compute f_res and dU.
-            # HINT: use the function `conjugate_gradient` to solve linear equations A * x = b.
-            # The usage is `x, stat = conjugate_gradient(A, b)`, where `stat` indicates the
-            # status of the CG solver.
-            f_res = np.zeros_like(f_ext)            # <--
-            dU, stat = np.zeros_like(f_ext), 0      # <--
-            if stat != 0:
-                print('Warning - CG solver failed with status', stat)
+            f_res = f_ext + f_el
+
+            # Precompute the norm of `f_res` as the residual error
+            f_res_norm = np.linalg.norm(f_res)
+
+            # Update the forcing term using the second choice of Eisenstat and Walker (1996). The
+            # safeguards keep the forcing term from dropping too fast or oversolving the linear
+            # equation beyond the accuracy Newton's method asks for
+            if inexact and f_res_norm_last is not None:
+                eta_last = eta
+                eta = 0.9 * (f_res_norm / f_res_norm_last) ** 2
+                if 0.9 * eta_last ** 2 > 0.1:
+                    eta = max(eta, 0.9 * eta_last ** 2)
+                eta = min(max(eta, 0.5 * residual_tol / f_res_norm), max_forcing_term)
+
+            with stats.timer('solve'):
+                dU = self.linear_solve(solver, K, f_res, x0=dU if warm_start else None, tol=eta)
 
             # Perform line search to find a feasible step size for updating Ui
             #
             # The idea behind line search is very simple. We start from an initial step size `l`
             # and test if U = Ui + dU * l is a better solution to K * U = f_ext. A better solution
             # means that the residual forces at U are smaller than Ui (smaller residual error).
-            #
-            # We have given you the skeleton code of the line search algorithm, and now you will
-            # fill in the blank lines according to the comments
 
             # Initialize line search step size
             l = 1.0
+            line_search_success = False
 
-            # Precompute the norm of `f_res` as the residual error
-            f_res_norm = np.linalg.norm(f_res)
+            # The potential energy should decrease by at least a fraction of its first-order
+            # prediction, -f_res^T * dU * l (only if dU is a descent direction)
+            energy_slope = 1e-4 * (f_res @ dU) if energy_line_search else 0.0
 
             # Line search algorithm loop
-            for _ in range(max_line_search_iters):
-
-                # Compute the current U using the step size l
-                # --------
-                # TODO: Your code here. Compute U.
-                U = np.zeros_like(Ui)       # <--
-
-                # Get the vertex coordinates `V_l` given the deformation matrix U
-                V_l = V.copy()
-                V_l.ravel()[active_mask] += U
-
-                # Computing the residual forces at U breaks down into two steps:
-                #   1. Compute the reduced elastic forces f_el
-                #   2. Compute f_res
-                # --------
-                # TODO: Your code here. Compute f_el.
-                f_el_full = np.zeros_like(V)    # <--
-                f_el[:] = f_el_full.ravel()[active_mask]
-
-                # --------
-                # TODO: Your code here. Compute f_res at step size l.
-                f_res_l = np.zeros_like(f_ext)      # <--
-
-                # Exit the loop if `f_res_l` has a smaller norm than `f_res`
-                # --------
-                # TODO: Your code here. Implement the if-condition.
-                # HINT:
-                #   - The `np.linalg.norm` function computes the norm of a vector.
-                #   - The norm of f_res has been precomputed and stored in `f_res_norm`
-                f_res_l_norm = 0.0      # <--
-                if True:                # <--
-                    break
-
-                # Halve the step size
-                l *= 0.5
+            with stats.timer('line_search'):
+                for ls_it in range(max_line_search_iters):
+
+                    # Compute the current U using the step size l
+                    U = Ui + dU * l
+
+                    # Get the vertex coordinates `V_l` given the deformation matrix U
+                    V_l = V.copy()
+                    V_l.ravel()[active_mask] += U
+
+                    # Computing the residual forces at U breaks down into two steps:
+                    #   1. Compute the reduced elastic forces f_el (and the elastic energy)
+                    #   2. Compute f_res
+                    if energy_line_search:
+                        f_el_full, elastic_energy = self.elastic_force(V_l, return_energy=True)
+                        energy_l = elastic_energy - f_ext @ U
+                    else:
+                        f_el_full = self.elastic_force(V_l)
+                    f_el[:] = f_el_full.ravel()[active_mask]
+                    f_res_l = f_ext + f_el
+
+                    # Exit the loop if `f_res_l` has a smaller norm than `f_res`, or if the
+                    # potential energy decreases in energy line search
+                    f_res_l_norm = np.linalg.norm(f_res_l)
+                    if f_res_l_norm < f_res_norm or (energy_slope > 0 and
+                                                     energy_l <= energy_i - energy_slope * l):
+                        line_search_success = True
+                        break
+
+                    # Halve the step size
+                    l *= 0.5
 
             # Print the residual error after line search
-            print(f'Iteration {it + 1}: residual error = {f_res_l_norm}')
+            info = self.solver_stats[-1]
+            print(f'Iteration {it + 1}: residual error = {f_res_l_norm}, '
+                  f"{info['solver']} iterations = {info['iterations']}")
+            self.newton_info.update(iterations=it + 1, residual=float(f_res_l_norm))
+            self.newton_info['line_search_iterations'] += ls_it + 1
+            stats.residual_history.append(float(f_res_l_norm))
 
             # Exit the loop if the residual error is sufficiently small
-            if f_res_l_norm < 1e-4:
+            if f_res_l_norm < residual_tol:
                 print(f"Newton's method converged in {it + 1} iterations")
+                self.newton_info['converged'] = True
+                break
+
+            # Stop if no valid step was found (e.g., all trial steps invert elements)
+            if not np.isfinite(f_res_l_norm):
+                print("Warning - Newton's method failed in line search")
                 break
 
+            # Do not warm start the next linear solve from a direction that failed line search.
+            # Otherwise, a loose forcing term may accept the same direction again without any
+            # iterations. Starting from zero, CG always returns a descent direction
+            if not line_search_success:
+                dU = None
+
             # Update Ui using the U value after line search
             Ui[:] = U
-
-            # Update the reduced stiffness matrix at Ui
-            # --------
-            # TODO: Your code here.
-            # HINT: You will need the deformed vertex positions to compute the stiffness matrix.
-            # However, it's actually ready in an existing variable. Which one is it?
-            K_full = csc_matrix((V.shape[0] * dim, V.shape[0] * dim))   # <--
-            K = K_full[active_indices][:, active_indices]
+            if energy_line_search:
+                energy_i = energy_l
+            f_res_norm_last = f_res_norm
+
+            # Update the reduced stiffness matrix at Ui, i.e., the deformed vertex positions V_l.
+            # A lagged stiffness matrix is kept for up to `jacobian_update_interval` iterations
+            # unless it fails to produce a descent direction
+            K_age += 1
+            if K_age >= jacobian_update_interval or not line_search_success:
+                with stats.timer('assembly'):
+                    K = self.system_matrix(V_l, boundary_conditions)
+                K_age = 0
 
         # Obtain the full-size deformation matrix U
-        U_full = np.zeros_like(V)
-        U_full.ravel()[active_mask] = U
-        return U_full
+        with stats.timer('slicing'):
+            U_full = np.zeros_like(V)
+            U_full.ravel()[active_mask] = U
+
+        self.finish_stats(stats)
+        return (U_full, stats) if return_stats else U_full
+
+    def solve_continuation(self, external_forces: array, boundary_conditions: array,
+                           initial_step: float=0.1, min_step: float=1e-3,
+                           max_newton_iters: int=20, target_newton_iters: int=6,
+                           extrapolate: bool=True, return_stats: bool=False,
+                           **newton_kwargs) -> Union[array, Tuple[array, SolveStats]]:
+        '''
+        Solve mesh deformation under large loads by load continuation. The external forces are
+        ramped up from zero in increments, each solved by Newton's method starting from the
+        solution of the previous increment. The increment grows when Newton's method converges
+        quickly and shrinks when it is slow. A failed increment is retried at half the size.
+
+        Params:
+            * `external_forces: array`     - (Nxd), external forces at full load
+            * `boundary_conditions: array` - (N), the boundary condition mask (see `solve_newton`)
+            * `initial_step: float`        - the first load increment, as a fraction of the full
+                load
+            * `min_step: float`            - the smallest load increment before giving up
+            * `max_newton_iters: int`      - Newton iteration budget of each increment
+            * `target_newton_iters: int`   - the desired number of Newton iterations per
+                increment, which controls the adaptive step size
+            * `extrapolate: bool`          - predict the initial guess of each increment by
+                linear extrapolation from the last two solutions
+            * `return_stats: bool`         - also return the statistics of this call
+            * `newton_kwargs`              - other keyword arguments of `solve_newton`
+
+        Return Value:
+            * `U: array` - (Nxd), deformation matrix at the largest load reached. The load factor
+                reached and the numbers of increments, Newton iterations and linear solves are
+                saved in `self.continuation_info`.
+            * `stats: SolveStats` - statistics of this call (only if `return_stats` is True),
+                accumulated over all Newton solves, which are also saved in `self.stats`
+        '''
+        # Check input validity
+        assert 0 < min_step <= initial_step <= 1, 'Expected 0 < min_step <= initial_step <= 1'
+        assert target_newton_iters >= 1, 'The target number of Newton iterations must be positive'
+
+        # Load factor and deformation of the last converged increment, and the one before it
+        load, U = 0.0, np.zeros_like(external_forces)
+        load_prev, U_prev = None, None
+        step = initial_step
+
+        # Accumulate statistics over all increments
+        stats = SolveStats('continuation')
+        num_increments, num_failures, newton_iters = 0, 0, 0
+
+        while load < 1.0:
+            step = min(step, 1.0 - load)
+            print(f'------ Load step {num_increments + 1}: load factor = {load + step:.4g} ------')
+
+            # Predict the initial guess from the last two converged increments
+            U_guess = U
+            if extrapolate and U_prev is not None:
+                U_guess = U + (U - U_prev) * (step / (load - load_prev))
+
+            # Solve the current increment
+            U_next = self.solve_newton(external_forces * (load + step), boundary_conditions,
+                                       max_iters=max_newton_iters,
+                                       initial_displacement=U_guess, **newton_kwargs)
+            info = self.newton_info
+            stats.merge(self.stats)
+            newton_iters += info['iterations']
+
+            # Retry with half the increment upon failure
+            if not info['converged']:
+                num_failures += 1
+                step *= 0.5
+                if step < min_step:
+                    print(f'Warning - load continuation stopped at load factor {load:.4g}')
+                    break
+                continue
+
+            # Accept the increment
+            load_prev, U_prev = load, U
+            load, U = load + step, U_next
+            num_increments += 1
+
+            # Adapt the increment to the convergence speed of Newton's method
+            step *= min(max(target_newton_iters / max(info['iterations'], 1), 0.5), 2.0)
+
+        # Save the statistics
+        self.solver_stats = stats.linear_solves
+        self.continuation_info = {
+            'load': load,
+            'increments': num_increments,
+            'failures': num_failures,
+            'newton_iterations': newton_iters,
+            'linear_solves': len(stats.linear_solves),
+        }
+        print(f'Load continuation reached load factor {load:.4g} in {num_increments} increments '
+              f'({newton_iters} Newton iterations, {len(stats.linear_solves)} linear solves)')
+
+        self.stats = stats
+        stats.info = self.continuation_info
+        self.finish_stats(stats)
+        return (U, stats) if return_stats else U
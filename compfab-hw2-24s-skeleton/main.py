@@ -1,9 +1,11 @@
 from tet_mesh import TetMesh, tet_mesh_cuboid, tet_mesh_from_file
 from material import Material, LinearElastic, NeoHookean
 from fem import StaticFEM
+from linear_solver import LINEAR_SOLVERS
+from stiffness_io import SPARSE_FORMATS, save_stiffness_matrix
 
 from numpy import ndarray as array
-from typing import Tuple
+from typing import Optional, Tuple
 
 import os
 import argparse
@@ -54,9 +56,13 @@ def boundary_conditions(vertices: array, external_force: array,
     return f_ext, bc
 
 
-def test_fem(mesh: TetMesh, material: Material, external_force: array, name: str):
+def test_fem(mesh: TetMesh, material: Material, external_force: array, name: str,
+             solver: str='cg', matrix_free: bool=False, binary_stl: bool=False,
+             surface_only: bool=False, stats_file: Optional[str]=None,
+             save_k: Optional[str]=None):
     '''
-    Default FEM test function.
+    Default FEM test function. If `save_k` is a sparse matrix format in `SPARSE_FORMATS` (e.g.,
+    '.npz'), the reduced stiffness matrix is saved in that format for any mesh size.
     '''
     # Print test case info
     print(f'------------ Test: {name}, Material: {material.type} ------------')
@@ -66,14 +72,15 @@ def test_fem(mesh: TetMesh, material: Material, external_force: array, name: str
     os.makedirs(result_dir, mode=0o775, exist_ok=True)
 
     # Save the rest mesh
-    mesh.write_to_file(os.path.join(result_dir, 'mesh_rest.stl'))
+    mesh.write_to_file(os.path.join(result_dir, 'mesh_rest.stl'), binary=binary_stl,
+                       surface_only=surface_only)
 
     # Set boundary conditions
     V = mesh.vertices
     f_ext, bc = boundary_conditions(V, external_force, tolerance=cube_size * 0.5)
 
     # Create the FEM solver
-    fem = StaticFEM(mesh, material)
+    fem = StaticFEM(mesh, material, solver, matrix_free, stats_file=stats_file)
 
     # Compute the deformation
     if material.type == 'linear':
@@ -82,27 +89,30 @@ def test_fem(mesh: TetMesh, material: Material, external_force: array, name: str
         U = fem.solve_newton(f_ext, bc)
     else:
         raise ValueError('Unknown material model type')
+    print(f'Solver statistics: {fem.stats.summary()}')
 
     # Save the stiffness matrix for the linear material model (for case 4x2x2 only)
     if V.shape[0] <= 16:
-        # Get the stiffness matrix
-        K_full = fem.stiffness_matrix(V)
-        active_indices = np.nonzero((~bc).repeat(V.shape[1]))[0]
-        K = K_full[active_indices][:, active_indices]
+        # Get the reduced stiffness matrix
+        K = fem.stiffness_matrix(V, bc)
 
         # Write the stiffness matrix into an external file
         stiffness_matrix_file_name = os.path.join(result_dir, f'K_{name}_{material.type}.txt')
-        with open(stiffness_matrix_file_name, 'w') as f:
-            for row in K.toarray():
-                row_str = ' '.join([f'{v:.6f}' for v in row])
-                f.write(f'{row_str}\n')
+        np.savetxt(stiffness_matrix_file_name, K.toarray(), fmt='%.6f')
 
         print(f"Stiffness matrix saved to '{stiffness_matrix_file_name}'")
 
+    # Save the sparse reduced stiffness matrix
+    if save_k:
+        stiffness_matrix_file_name = os.path.join(result_dir, f'K_{name}_{material.type}{save_k}')
+        save_stiffness_matrix(stiffness_matrix_file_name, fem.stiffness_matrix(V, bc))
+
+        print(f"Sparse stiffness matrix saved to '{stiffness_matrix_file_name}'")
+
     # Construct and save the deformed mesh
-    mesh_deform = TetMesh(V + U, mesh.elements)
+    mesh_deform = mesh.with_vertices(V + U)
     output_mesh_file_name = os.path.join(result_dir, f'deformed_{material.type}.stl')
-    mesh_deform.write_to_file(output_mesh_file_name)
+    mesh_deform.write_to_file(output_mesh_file_name, binary=binary_stl, surface_only=surface_only)
 
     print(f"Deformed mesh saved to '{output_mesh_file_name}'")
 
@@ -160,9 +170,14 @@ def boundary_conditions_custom(vertices: array, tolerance: float=1e-8) -> Tuple[
     return f_ext, bc
 
 
-def test_fem_custom(mesh: TetMesh, material: Material, name: str):
+def test_fem_custom(mesh: TetMesh, material: Material, name: str, solver: str='cg',
+                    matrix_free: bool=False, binary_stl: bool=False,
+                    surface_only: bool=False, continuation: bool=False,
+                    stats_file: Optional[str]=None, save_k: Optional[str]=None,
+                    spd_projection: bool=False):
     '''
-    Customized FEM test function.
+    Customized FEM test function. See `test_fem` for `save_k` and `StaticFEM` for
+    `spd_projection`.
     '''
     # Print test case info
     print(f'------------ Custom test: {name}, Material: {material.type} ------------')
@@ -172,20 +187,34 @@ def test_fem_custom(mesh: TetMesh, material: Material, name: str):
     os.makedirs(result_dir, mode=0o775, exist_ok=True)
 
     # Save the rest mesh
-    mesh.write_to_file(os.path.join(result_dir, 'mesh_rest.stl'), invert_normal=True)
+    mesh.write_to_file(os.path.join(result_dir, 'mesh_rest.stl'), invert_normal=True,
+                       binary=binary_stl, surface_only=surface_only)
 
     # Set boundary conditions
     V = mesh.vertices
     f_ext, bc = boundary_conditions_custom(V)
 
     # Solve deformation
-    fem = StaticFEM(mesh, material)
-    U = fem.solve_newton(f_ext, bc)
+    fem = StaticFEM(mesh, material, solver, matrix_free, stats_file=stats_file,
+                    spd_projection=spd_projection)
+    if continuation:
+        U = fem.solve_continuation(f_ext, bc)
+    else:
+        U = fem.solve_newton(f_ext, bc)
+    print(f'Solver statistics: {fem.stats.summary()}')
+
+    # Save the sparse reduced stiffness matrix
+    if save_k:
+        stiffness_matrix_file_name = os.path.join(result_dir, f'K_{name}_{material.type}{save_k}')
+        save_stiffness_matrix(stiffness_matrix_file_name, fem.stiffness_matrix(V, bc))
+
+        print(f"Sparse stiffness matrix saved to '{stiffness_matrix_file_name}'")
 
     # Construct and save the deformed mesh
-    mesh_deform = TetMesh(V + U, mesh.elements)
+    mesh_deform = mesh.with_vertices(V + U)
     output_mesh_file_name = os.path.join(result_dir, f'deformed_{material.type}.stl')
-    mesh_deform.write_to_file(output_mesh_file_name, invert_normal=True)
+    mesh_deform.write_to_file(output_mesh_file_name, invert_normal=True, binary=binary_stl,
+                              surface_only=surface_only)
 
     print(f"Deformed mesh saved to '{output_mesh_file_name}'")
 
@@ -202,6 +231,27 @@ def main():
                         help='Dimensions of the cuboid for testing (e.g. 4x2x2)')
     parser.add_argument('-f', '--test-force', default='0,0,-50',
                         help='The external force for testing (e.g., 0,0,-50)')
+    parser.add_argument('-s', '--solver', default='cg', choices=list(LINEAR_SOLVERS),
+                        help='Linear solver for FEM (default to cg)')
+    parser.add_argument('--matrix-free', action='store_true',
+                        help='Apply the stiffness matrix element by element without assembling it '
+                             '(cg and jacobi solvers only)')
+    parser.add_argument('--binary-stl', action='store_true',
+                        help='Write output meshes in binary STL format')
+    parser.add_argument('--surface-only', action='store_true',
+                        help='Only write the boundary faces of output meshes')
+    parser.add_argument('--continuation', action='store_true',
+                        help='Ramp up the external forces over adaptive load steps for the custom '
+                             'mesh (useful for large loads)')
+    parser.add_argument('--spd-projection', action='store_true',
+                        help='Project element stress differentials to positive semi-definite '
+                             "matrices for a more robust Newton's method on the custom mesh")
+    parser.add_argument('--mmap', action='store_true',
+                        help='Memory-map the external tet mesh file instead of reading it')
+    parser.add_argument('--stats-file', default=None,
+                        help='Append solver statistics to this file in JSON Lines format')
+    parser.add_argument('--save-k', default=None, choices=list(SPARSE_FORMATS),
+                        help='Save the reduced stiffness matrix in a sparse format')
 
     # Process arguments
     args = parser.parse_args()
@@ -209,6 +259,11 @@ def main():
     mesh_name = args.mesh
     test_cuboid_size = args.test_cuboid_size
     test_force = np.array([int(c) for c in args.test_force.split(',')])
+    solver = args.solver
+    matrix_free = args.matrix_free
+    binary_stl = args.binary_stl
+    surface_only = args.surface_only
+    stats_file = args.stats_file
 
     # Material models
     linear_material = LinearElastic(E, nu)
@@ -221,10 +276,12 @@ def main():
     if mesh_name:
         # Read tet mesh data from file
         file_name = os.path.join(ROOT_DIR, 'data', 'assignment2', f'{mesh_name}_tetmesh.dat')
-        tet_mesh = tet_mesh_from_file(file_name, max_size=cube_size * 10)
+        tet_mesh = tet_mesh_from_file(file_name, max_size=cube_size * 10, mmap=args.mmap)
 
         # Test deformation using the specified mesh
-        test_fem_custom(tet_mesh, neohookean_material, mesh_name)
+        test_fem_custom(tet_mesh, neohookean_material, mesh_name, solver, matrix_free,
+                        binary_stl, surface_only, args.continuation, stats_file,
+                        args.save_k, args.spd_projection)
 
     # Use a custom cuboid size
     elif test_cuboid_size:
@@ -236,7 +293,8 @@ def main():
 
         # Test both linear and non-linear materials
         for material in (linear_material, neohookean_material):
-            test_fem(tet_mesh, material, test_force, test_cuboid_size)
+            test_fem(tet_mesh, material, test_force, test_cuboid_size, solver, matrix_free,
+                     binary_stl, surface_only, stats_file, args.save_k)
 
     # Perform default testing with cuboids
     else:
@@ -251,7 +309,8 @@ def main():
 
                 # Test deformation using the cuboid mesh
                 test_name = f'{nx}x{ny}x{nz}'
-                test_fem(tet_mesh, material, test_force, test_name)
+                test_fem(tet_mesh, material, test_force, test_name, solver, matrix_free,
+                         binary_stl, surface_only, stats_file, args.save_k)
 
 
 if __name__ == '__main__':
@@ -1,9 +1,62 @@
 from abc import ABC, abstractmethod
 from numpy import ndarray as array
+from typing import Optional, Tuple
 
 import numpy as np
 
 
+def inverse_and_det(F: array) -> Tuple[array, array]:
+    '''
+    Compute the inverses and determinants of a batch of matrices (Txdxd) together. 3x3 matrices
+    are inverted analytically from their cofactors, which is several times faster than
+    `np.linalg.inv` and `np.linalg.det` on large batches and computes the determinants for free.
+    Singular matrices produce non-finite inverses instead of raising an error.
+    '''
+    if F.shape[-2:] != (3, 3):
+        return np.linalg.inv(F), np.linalg.det(F)
+
+    # Entries of F (row-major) as contiguous arrays over the batch
+    a, b, c, d, e, f, g, h, i = F.reshape(-1, 9).T
+
+    # The adjugate of F, i.e., the transposed cofactor matrix (row-major)
+    adj = np.empty((9, F.shape[0]), dtype=np.result_type(F.dtype, np.float32))
+    adj[0], adj[1], adj[2] = e * i - f * h, c * h - b * i, b * f - c * e
+    adj[3], adj[4], adj[5] = f * g - d * i, a * i - c * g, c * d - a * f
+    adj[6], adj[7], adj[8] = d * h - e * g, b * g - a * h, a * e - b * d
+
+    # Expand the determinant along the first row of F, then F^(-1) = adj(F) / det(F)
+    det = a * adj[0] + b * adj[3] + c * adj[6]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        adj /= det
+
+    return adj.T.reshape(F.shape), det
+
+
+def project_spd(A: array, min_eigenvalue: float=0.0) -> array:
+    '''
+    Project a batch of symmetric matrices (T x n x n) to the nearest (in Frobenius norm)
+    positive semi-definite matrices by clamping their eigenvalues to at least `min_eigenvalue`.
+    This takes an eigendecomposition per matrix, which costs several times more than computing
+    dP/dF itself. Batches that are broadcast from a single matrix (e.g., the constant dP/dF of
+    the linear elastic material) are projected only once.
+    '''
+    if A.ndim == 3 and A.strides[0] == 0:
+        return np.broadcast_to(project_spd(A[0], min_eigenvalue), A.shape)
+
+    eigvals, eigvecs = np.linalg.eigh(A)
+
+    # Only rebuild the matrices with eigenvalues below the threshold from their clamped
+    # eigendecompositions
+    mask = eigvals.min(axis=-1) < min_eigenvalue
+    if not mask.any():
+        return A
+
+    eigvals, eigvecs = np.maximum(eigvals[mask], min_eigenvalue), eigvecs[mask]
+    A = A.copy()
+    A[mask] = (eigvecs * eigvals[..., None, :]) @ np.swapaxes(eigvecs, -1, -2)
+    return A
+
+
 class Material(ABC):
     '''
     Abstract class for material models.
@@ -31,6 +84,78 @@ class Material(ABC):
     @abstractmethod
     def stress_differential(self, F: array) -> array: ...
 
+    # The batched counterparts below fall back to per-element evaluation. Subclasses should
+    # override them with vectorized implementations.
+
+    def energy_density_batch(self, F: array) -> array:
+        '''
+        Compute the energy densities for a batch of deformation gradients.
+
+        Params:
+            * `F: array` - (Txdxd) deformation gradients, T = #elements, d = #dimensions
+
+        Return value:
+            * `W: array` - (T) energy densities
+        '''
+        return np.array([self.energy_density(Ft) for Ft in F])
+
+    def stress_tensor_batch(self, F: array) -> array:
+        '''
+        Compute the stress tensors for a batch of deformation gradients.
+
+        Params:
+            * `F: array` - (Txdxd) deformation gradients, T = #elements, d = #dimensions
+
+        Return value:
+            * `P: array` - (Txdxd) stress tensors
+        '''
+        return np.stack([self.stress_tensor(Ft) for Ft in F])
+
+    def stress_differential_batch(self, F: array) -> array:
+        '''
+        Compute the differentials of the stress tensors w.r.t. a batch of deformation gradients.
+
+        Params:
+            * `F: array` - (Txdxd) deformation gradients, T = #elements, d = #dimensions
+
+        Return value:
+            * `dP_dF: array` - (T x d^2 x d^2) the gradients of the stress tensors w.r.t. F
+        '''
+        return np.stack([self.stress_differential(Ft) for Ft in F])
+
+    def evaluate_batch(self, F: array, energy: bool=True, stress: bool=True, tangent: bool=True,
+                       spd_projection: bool=False) -> Tuple[Optional[array], Optional[array],
+                                                            Optional[array]]:
+        '''
+        Compute the energy densities, stress tensors and stress differentials for a batch of
+        deformation gradients in one call. Subclasses override this method to share
+        intermediate results (e.g., det(F) and F^(-1)) among the three quantities.
+
+        Params:
+            * `F: array`             - (Txdxd) deformation gradients, T = #elements,
+                                       d = #dimensions
+            * `energy: bool`         - whether to compute the energy densities
+            * `stress: bool`         - whether to compute the stress tensors
+            * `tangent: bool`        - whether to compute the stress differentials
+            * `spd_projection: bool` - project the stress differentials to positive
+                                       semi-definite matrices (see `project_spd`), which keeps
+                                       the stiffness matrix positive semi-definite for Newton's
+                                       method far from the rest shape
+
+        Return value:
+            * `W: array`     - (T) energy densities, or None if not requested
+            * `P: array`     - (Txdxd) stress tensors, or None if not requested
+            * `dP_dF: array` - (T x d^2 x d^2) stress differentials, or None if not requested
+        '''
+        W = self.energy_density_batch(F) if energy else None
+        P = self.stress_tensor_batch(F) if stress else None
+        dP_dF = self.stress_differential_batch(F) if tangent else None
+
+        if tangent and spd_projection:
+            dP_dF = project_spd(dP_dF)
+
+        return W, P, dP_dF
+
 
 class LinearElastic(Material):
     '''
@@ -54,6 +179,16 @@ class LinearElastic(Material):
         W = self.mu * strain_contract + 0.5 * self.lm * strain.trace() ** 2
         return W
 
+    def energy_density_batch(self, F: array) -> array:
+        '''
+        Compute the energy densities W for a batch of deformation gradients (Txdxd).
+        '''
+        strain = 0.5 * (F + F.transpose(0, 2, 1)) - np.eye(F.shape[-1])
+        strain_contract = np.einsum('tij,tij->t', strain, strain)
+        strain_trace = np.trace(strain, axis1=1, axis2=2)
+        W = self.mu * strain_contract + 0.5 * self.lm * strain_trace ** 2
+        return W
+
     def stress_tensor(self, F: array) -> array:
         '''
         Compute the stress tensor P.
@@ -64,6 +199,15 @@ class LinearElastic(Material):
         P = self.mu * (F + F.T - 2 * I) + self.lm * (F.trace() - dim) * I
         return P
 
+    def stress_tensor_batch(self, F: array) -> array:
+        '''
+        Compute the stress tensors P for a batch of deformation gradients (Txdxd).
+        '''
+        dim, I = F.shape[-1], np.eye(F.shape[-1])
+        F_trace = np.trace(F, axis1=1, axis2=2).reshape(-1, 1, 1)
+        P = self.mu * (F + F.transpose(0, 2, 1) - 2 * I) + self.lm * (F_trace - dim) * I
+        return P
+
     def stress_differential(self, F: array) -> array:
         '''
         Compute the differential of the stress tensor P w.r.t. the deformation gradient F.
@@ -85,34 +229,36 @@ class LinearElastic(Material):
         mu, lm = self.mu, self.lm
 
         # Compute d(F.T)/dF
-        # --------
-        # TODO: Your code here. Think about which elements in d(F.T)/dF are non-zero.
+        # Both matrices are flattened column by column, so F[i, j] sits at index j * dim + i
         dFT_dF = np.zeros((dim2, dim2))
-        for i in []:        # <--
-            for j in []:    # <--
-                ...         # <--
+        for i in range(dim):
+            for j in range(dim):
+                dFT_dF[i * dim + j, j * dim + i] = 1
 
         # Compute D1
-        # --------
-        # TODO: Your code here.
-        # HINT: The `np.eye(n)` function creates an identify matrix of size nxn
-        D1 = np.zeros((dim2, dim2))     # <--
+        D1 = np.eye(dim2) + dFT_dF
 
         # Compute D2 = d(F.trace() * I)/dF
-        # --------
-        # TODO: Your code here. Think about which elements in D2 are non-zero
+        # Only the diagonal elements of F contribute to the diagonal elements of P
         D2 = np.zeros((dim2, dim2))
-        for i in []:        # <--
-            for j in []:    # <--
-                ...         # <--
+        for i in range(dim):
+            for j in range(dim):
+                D2[i * (dim + 1), j * (dim + 1)] = 1
 
         # Compute dP/dF
-        # --------
-        # TODO: Your code here.
-        dP_dF = np.zeros((dim2, dim2))      # <--
+        dP_dF = mu * D1 + lm * D2
 
         return dP_dF
 
+    def stress_differential_batch(self, F: array) -> array:
+        '''
+        Compute dP/dF for a batch of deformation gradients (Txdxd). Since dP/dF is constant for
+        the linear elastic material, the result is a read-only broadcast view of shape
+        (T x d^2 x d^2) that takes no extra memory.
+        '''
+        dP_dF = self.stress_differential(np.eye(F.shape[-1]))
+        return np.broadcast_to(dP_dF, (F.shape[0],) + dP_dF.shape)
+
 
 class NeoHookean(Material):
     '''
@@ -138,6 +284,12 @@ class NeoHookean(Material):
         W = 0.5 * self.mu * (I1 - dim - 2 * logJ) + 0.5 * self.lm * logJ ** 2
         return W
 
+    def energy_density_batch(self, F: array) -> array:
+        '''
+        Compute the energy densities W for a batch of deformation gradients (Txdxd).
+        '''
+        return self.evaluate_batch(F, stress=False, tangent=False)[0]
+
     def stress_tensor(self, F: array) -> array:
         '''
         Compute the stress tensor P.
@@ -149,6 +301,12 @@ class NeoHookean(Material):
         P = self.mu * (F - F_invT) + self.lm * logJ * F_invT
         return P
 
+    def stress_tensor_batch(self, F: array) -> array:
+        '''
+        Compute the stress tensors P for a batch of deformation gradients (Txdxd).
+        '''
+        return self.evaluate_batch(F, energy=False, tangent=False)[1]
+
     def stress_differential(self, F: array) -> array:
         '''
         Compute the differential of the stress tensor P w.r.t. the deformation gradient F.
@@ -191,3 +349,67 @@ class NeoHookean(Material):
         # Compute dP/dF
         dP_dF = D1 + D2 + D3
         return dP_dF
+
+    def stress_differential_batch(self, F: array) -> array:
+        '''
+        Compute dP/dF for a batch of deformation gradients (Txdxd).
+        '''
+        return self.evaluate_batch(F, energy=False, stress=False)[2]
+
+    def evaluate_batch(self, F: array, energy: bool=True, stress: bool=True, tangent: bool=True,
+                       spd_projection: bool=False) -> Tuple[Optional[array], Optional[array],
+                                                            Optional[array]]:
+        '''
+        Compute the energy densities, stress tensors and stress differentials for a batch of
+        deformation gradients (Txdxd), sharing det(F) and F^(-1) among them. See
+        `Material.evaluate_batch` for the parameters.
+
+        Stresses are bit-compatible with `stress_tensor`, so that `StaticFEM.elastic_force`
+        reproduces the per-element loop exactly. The faster analytic inverse (see
+        `inverse_and_det`) is only used if the stress differentials alone are requested, where
+        results agree to round-off.
+        '''
+        # Constants
+        num_elements = F.shape[0]
+        dim, dim2 = F.shape[-1], F.shape[-1] ** 2
+        mu, lm = self.mu, self.lm
+
+        # Compute F^(-1) and log(J) only once
+        if energy or stress:
+            F_inv, J = np.linalg.inv(F), np.linalg.det(F)
+        else:
+            F_inv, J = inverse_and_det(F)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            logJ = np.log(J)
+        F_invT = F_inv.transpose(0, 2, 1)
+
+        W, P, dP_dF = None, None, None
+
+        # W = 0.5 * mu * (I1 - dim - 2 * log(J)) + 0.5 * lm * log(J) ** 2
+        if energy:
+            I1 = np.einsum('tij,tij->t', F, F)
+            W = 0.5 * mu * (I1 - dim - 2 * logJ) + 0.5 * lm * logJ ** 2
+
+        # P = mu * (F - F^(-T)) + lm * log(J) * F^(-T)
+        if stress:
+            P = mu * (F - F_invT) + (lm * logJ).reshape(-1, 1, 1) * F_invT
+
+        # Following `stress_differential`, dP/dF = D1 + D2 + D3 where, with P[i, j] at column-major
+        # index (j, i) and F[k, s] at (s, k),
+        #   - D1 = mu * I
+        #   - D2 = lm * vec(F^(-T)) * vec(F^(-T))^T
+        #   - D3[j, i, s, k] = (mu - lm * log(J)) * F^(-1)[j, k] * F^(-1)[s, i]
+        # D3 is written out directly, which avoids transposing a temporary 4D array
+        if tangent:
+            coeff = (mu - lm * logJ).reshape(-1, 1, 1)
+            dP_dF = ((coeff * F_inv)[:, :, None, None, :] * F_invT[:, None, :, :, None])
+            dP_dF = dP_dF.reshape(num_elements, dim2, dim2)
+
+            F_invT_vec = F_inv.reshape(num_elements, dim2)
+            dP_dF += lm * F_invT_vec[:, :, None] * F_invT_vec[:, None, :]
+            dP_dF.reshape(num_elements, -1)[:, ::dim2 + 1] += mu
+
+            if spd_projection:
+                dP_dF = project_spd(dP_dF)
+
+        return W, P, dP_dF
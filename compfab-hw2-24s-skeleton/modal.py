@@ -0,0 +1,198 @@
+from tet_mesh import TetMesh, tet_mesh_cuboid, tet_mesh_from_file
+from material import LinearElastic, NeoHookean
+from fem import StaticFEM
+from linear_solver import LINEAR_SOLVERS, AlgebraicMultigridCG, LinearSolver, create_linear_solver
+from main import boundary_conditions, cube_size, E, nu
+
+from numpy import ndarray as array
+from scipy.sparse import diags
+from scipy.sparse.linalg import LinearOperator, eigsh
+from typing import List, Optional, Tuple, Union
+
+import os
+import argparse
+import numpy as np
+
+
+def modal_analysis(fem: StaticFEM, boundary_conditions: array, num_modes: int=10,
+                   density: float=1000.0, sigma: Optional[float]=None,
+                   solver: Union[str, LinearSolver]='direct', tol: float=0.0,
+                   return_stats: bool=False) -> Tuple[array, array]:
+    '''
+    Compute the natural frequencies and vibration modes of the mesh at its rest shape by solving
+    the generalized eigenvalue problem
+        K * u = omega^2 * M * u
+    for the lowest `num_modes` eigenvalues, where K is the reduced stiffness matrix and M is the
+    lumped mass matrix (see `StaticFEM.lumped_masses`).
+
+    The eigenvalues closest to the shift `sigma` are found by the shift-invert mode of ARPACK
+    (`scipy.sparse.linalg.eigsh`), which only needs solutions of (K - sigma * M) * x = b. The
+    linear solver is set up once for this matrix, so the sparse factorization (or the multigrid
+    hierarchy of iterative solvers) is shared by all solves. The fill-in of sparse LU grows
+    quickly on 3D meshes, so for meshes beyond ~10^4 vertices, 'amg' is much faster and its memory
+    is linear in the mesh size.
+
+    Params:
+        * `fem: StaticFEM`             - the FEM solver of the mesh and material
+        * `boundary_conditions: array` - (N) boolean mask of fixed vertices
+        * `num_modes: int`             - number of modes to compute
+        * `density: float`             - mass density of the material in kg/m^3
+        * `sigma: float`               - optional shift in (rad/s)^2. Defaults to zero if some
+            vertices are fixed, and to a small negative value otherwise, which keeps the shifted
+            matrix positive definite despite the rigid body modes.
+        * `solver`                     - linear solver of the shifted systems, by name in
+            `LINEAR_SOLVERS` or as a solver object. Iterative solvers run to a tight tolerance.
+        * `tol: float`                 - relative accuracy of eigenvalues (0 means machine
+            precision)
+        * `return_stats: bool`         - also return the solver statistics
+
+    Return value:
+        * `frequencies: array` - (k) natural frequencies in Hz, in ascending order
+        * `modes: array`       - (k x N x d) mode shapes, normalized with respect to M
+        * `stats: SolveStats`  - solver statistics (only if `return_stats` is True)
+    '''
+    # Store class member data into local variables
+    V = fem.mesh.vertices      # (Nx3), N = #vertices
+    dim = V.shape[1]           # d = #dimensions
+
+    stats = fem.start_stats('modal')
+
+    # Assemble the reduced stiffness matrix at the rest shape and the lumped mass matrix
+    with stats.timer('assembly'):
+        active_mask = (~boundary_conditions).repeat(dim)
+        K = fem.stiffness_matrix(V, boundary_conditions)
+        m = fem.lumped_masses(density).repeat(dim)[active_mask]
+
+    num_dofs = K.shape[0]
+    assert 0 < num_modes < num_dofs, \
+        f'The number of modes must be between 1 and {num_dofs - 1}, got {num_modes}'
+
+    # The default shift is relative to the magnitude of the eigenvalues, estimated by the
+    # diagonals of K and M
+    if sigma is None:
+        sigma = 0.0 if boundary_conditions.any() else -1e-6 * np.median(K.diagonal() / m)
+
+    # Set up the solver of the shifted matrix once. Iterative solvers need tight tolerances for
+    # the eigenvalues to converge, and algebraic multigrid is built from the rigid body modes
+    with stats.timer('factorization'):
+        if solver == 'amg':
+            solver = AlgebraicMultigridCG(tol=1e-10,
+                                          near_nullspace=fem.rigid_body_modes(boundary_conditions))
+        elif isinstance(solver, str) and solver != 'direct':
+            solver = create_linear_solver(solver, tol=1e-10)
+        else:
+            solver = create_linear_solver(solver)
+        A = K - sigma * diags(m) if sigma else K
+        A = A.tocsc()
+        solver.setup(A)
+
+    def solve_shifted(b: array) -> array:
+        return fem.linear_solve(solver, A, b.ravel())
+
+    OPinv = LinearOperator(A.shape, matvec=solve_shifted, dtype=np.float64)
+
+    # Solve the generalized eigenvalue problem in shift-invert mode
+    with stats.timer('eigensolve'):
+        eigenvalues, eigenvectors = eigsh(K, num_modes, M=diags(m), sigma=sigma, which='LM',
+                                          OPinv=OPinv, tol=tol)
+
+    # Sort by eigenvalue and fix the sign of each mode so that its largest entry is positive
+    order = np.argsort(eigenvalues)
+    eigenvalues, eigenvectors = eigenvalues[order], eigenvectors[:, order]
+    signs = np.sign(eigenvectors[np.abs(eigenvectors).argmax(axis=0), np.arange(num_modes)])
+    eigenvectors *= np.where(signs != 0, signs, 1.0)
+
+    # Convert eigenvalues (omega^2) to frequencies in Hz and obtain full-size mode shapes
+    frequencies = np.sqrt(np.maximum(eigenvalues, 0.0)) / (2 * np.pi)
+    modes = np.zeros((num_modes, V.size))
+    modes[:, active_mask] = eigenvectors.T
+    modes = modes.reshape(num_modes, *V.shape)
+
+    stats.info = {'num_modes': num_modes, 'sigma': float(sigma), 'num_dofs': num_dofs,
+                  'frequencies': frequencies.tolist()}
+    fem.finish_stats(stats)
+    return (frequencies, modes, stats) if return_stats else (frequencies, modes)
+
+
+def write_mode_shapes(mesh: TetMesh, modes: array, output_dir: str, amplitude: float=0.05,
+                      binary: bool=True, surface_only: bool=True) -> List[str]:
+    '''
+    Write each mode shape as the surface of the mesh displaced along the mode. The largest
+    displacement of each mode is `amplitude` times the bounding box diagonal of the mesh. See
+    `TetMesh.write_to_file` for `binary` and `surface_only`.
+
+    Return value:
+        * `file_names: List[str]` - the names of the written files
+    '''
+    V = mesh.vertices
+    bbox_diagonal = np.linalg.norm(V.max(axis=0) - V.min(axis=0))
+    os.makedirs(output_dir, exist_ok=True)
+
+    file_names = []
+    for i, mode in enumerate(modes):
+        max_norm = np.linalg.norm(mode, axis=1).max()
+        scale = amplitude * bbox_diagonal / max_norm if max_norm > 0 else 0.0
+
+        file_name = os.path.join(output_dir, f'mode_{i:02d}.stl')
+        mesh.with_vertices(V + mode * scale).write_to_file(file_name, binary=binary,
+                                                           surface_only=surface_only)
+        file_names.append(file_name)
+
+    return file_names
+
+
+def main():
+    '''
+    Main routine.
+    '''
+    # Command line argument parser
+    parser = argparse.ArgumentParser(description='Modal analysis of a tet mesh')
+    parser.add_argument('-m', '--mesh', default='',
+                        help='Input tet mesh file, whose bottom 5% are fixed')
+    parser.add_argument('-c', '--test-cuboid-size', default='20x4x4',
+                        help='The size of the test cuboid (e.g., 20x4x4), whose left side is fixed')
+    parser.add_argument('-k', '--num-modes', type=int, default=10, help='Number of modes')
+    parser.add_argument('-r', '--density', type=float, default=1000.0,
+                        help='Mass density in kg/m^3')
+    parser.add_argument('-s', '--solver', default='direct', choices=list(LINEAR_SOLVERS),
+                        help='Linear solver of the shift-invert mode (default to direct)')
+    parser.add_argument('--free', action='store_true',
+                        help='Do not fix any vertices (the first 6 modes are rigid body motions)')
+    parser.add_argument('--material', default='linear', choices=['linear', 'neohookean'],
+                        help='Material model, which is linearized at the rest shape')
+    parser.add_argument('-a', '--amplitude', type=float, default=0.05,
+                        help='Max. displacement of written mode shapes relative to the mesh size')
+    parser.add_argument('-o', '--output-dir', default='modes',
+                        help='Output folder of the mode shapes')
+    parser.add_argument('--stats-file', default=None,
+                        help='Append solver statistics to this file in JSON Lines format')
+
+    # Process arguments
+    args = parser.parse_args()
+
+    if args.mesh:
+        mesh = tet_mesh_from_file(args.mesh, max_size=cube_size * 10)
+        h = mesh.vertices[:, 2] - mesh.vertices[:, 2].min()
+        bc = h < h.max() * 0.05
+    else:
+        nx, ny, nz = (int(s) for s in args.test_cuboid_size.split('x'))
+        mesh = tet_mesh_cuboid(nx, ny, nz, cube_size)
+        _, bc = boundary_conditions(mesh.vertices, np.zeros(3), tolerance=cube_size * 0.5)
+    if args.free:
+        bc[:] = False
+
+    material = LinearElastic(E, nu) if args.material == 'linear' else NeoHookean(E, nu)
+    fem = StaticFEM(mesh, material, args.solver, stats_file=args.stats_file)
+
+    frequencies, modes = modal_analysis(fem, bc, args.num_modes, args.density,
+                                        solver=args.solver)
+    write_mode_shapes(mesh, modes, args.output_dir, args.amplitude)
+
+    print(fem.stats.summary())
+    for i, frequency in enumerate(frequencies):
+        print(f'Mode {i}: {frequency:.6g} Hz')
+    print(f"Mode shapes saved to '{args.output_dir}'")
+
+
+if __name__ == '__main__':
+    main()
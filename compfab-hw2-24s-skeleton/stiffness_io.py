@@ -0,0 +1,129 @@
+from numpy import ndarray as array
+from scipy.sparse import coo_matrix, csc_matrix, spmatrix, load_npz, save_npz
+from scipy.io import mmread, mmwrite
+from typing import Dict
+
+import os
+import argparse
+import numpy as np
+
+
+# File formats of sparse matrices by extension
+SPARSE_FORMATS = ('.npz', '.mtx')
+
+
+def save_stiffness_matrix(file_name: str, K: spmatrix):
+    '''
+    Save a sparse stiffness matrix without densifying it. The format is chosen by the file
+    extension: '.npz' (compressed NumPy archive via `scipy.sparse.save_npz`, the most compact and
+    fastest) or '.mtx' (Matrix Market coordinate format, readable by other tools).
+    '''
+    ext = os.path.splitext(file_name)[1]
+    if ext == '.npz':
+        save_npz(file_name, csc_matrix(K))
+    elif ext == '.mtx':
+        mmwrite(file_name, coo_matrix(K), symmetry='general')
+    else:
+        raise ValueError(f"Unknown sparse matrix format '{ext}', should be one of "
+                         f"{list(SPARSE_FORMATS)}")
+
+
+def read_dense_matrix(file_name: str) -> array:
+    '''
+    Read a dense matrix written as rows of space-separated values (the `K_*.txt` format of
+    `main.py`). Parsing all values at once is much faster than `np.loadtxt`.
+    '''
+    with open(file_name) as f:
+        text = f.read()
+
+    num_cols = len(text.split('\n', 1)[0].split())
+    values = np.array(text.split(), dtype=float)
+    return values.reshape(-1, num_cols)
+
+
+def load_stiffness_matrix(file_name: str) -> csc_matrix:
+    '''
+    Load a stiffness matrix saved by `save_stiffness_matrix` ('.npz' or '.mtx'), or a dense text
+    matrix ('.txt') such as the references in `data/assignment2/std`.
+    '''
+    ext = os.path.splitext(file_name)[1]
+    if ext == '.npz':
+        return csc_matrix(load_npz(file_name))
+    elif ext == '.mtx':
+        return csc_matrix(mmread(file_name))
+    elif ext == '.txt':
+        return csc_matrix(read_dense_matrix(file_name))
+    else:
+        raise ValueError(f"Unknown matrix format '{ext}', should be one of "
+                         f"{list(SPARSE_FORMATS) + ['.txt']}")
+
+
+def compare_stiffness_matrices(K: spmatrix, K_ref: spmatrix, tol: float=1e-6) -> Dict:
+    '''
+    Compare a stiffness matrix against a reference without densifying either of them.
+
+    Params:
+        * `K: spmatrix`     - the stiffness matrix to check
+        * `K_ref: spmatrix` - the reference stiffness matrix
+        * `tol: float`      - tolerance of the max. error relative to the largest entry of the
+                              reference. The default allows for references printed with 6
+                              decimal digits.
+
+    Return value:
+        * `result: Dict` - the number of nonzeros of both matrices, the max. absolute error, the
+            max. and Frobenius norm errors relative to the reference, and whether the matrices
+            match within `tol`
+    '''
+    if K.shape != K_ref.shape:
+        return {'match': False, 'shape': K.shape, 'shape_ref': K_ref.shape}
+
+    # Entries of either matrix that are explicitly stored as zero do not count as nonzeros. The
+    # matrices are copied since the output of `StaticFEM.stiffness_matrix` shares its index
+    # arrays with the cached sparsity pattern
+    K, K_ref = csc_matrix(K, copy=True), csc_matrix(K_ref, copy=True)
+    K.eliminate_zeros()
+    K_ref.eliminate_zeros()
+    diff = (K - K_ref).tocoo()
+
+    ref_max = np.abs(K_ref.data).max() if K_ref.nnz else 1.0
+    ref_norm = np.linalg.norm(K_ref.data) if K_ref.nnz else 1.0
+    max_error = np.abs(diff.data).max() if diff.nnz else 0.0
+
+    return {
+        'match': bool(max_error <= tol * ref_max),
+        'shape': K.shape,
+        'nnz': K.nnz,
+        'nnz_ref': K_ref.nnz,
+        'max_abs_error': float(max_error),
+        'max_rel_error': float(max_error / ref_max),
+        'frobenius_rel_error': float(np.linalg.norm(diff.data) / ref_norm),
+    }
+
+
+def main():
+    '''
+    Compare two stiffness matrix files.
+    '''
+    # Command line argument parser
+    parser = argparse.ArgumentParser(description='Compare a stiffness matrix file against a '
+                                                 'reference (.npz, .mtx or dense .txt)')
+    parser.add_argument('file', help='The stiffness matrix to check')
+    parser.add_argument('reference', help='The reference stiffness matrix')
+    parser.add_argument('-t', '--tol', type=float, default=1e-6,
+                        help='Tolerance of the max. error relative to the largest reference entry')
+
+    # Process arguments
+    args = parser.parse_args()
+
+    result = compare_stiffness_matrices(load_stiffness_matrix(args.file),
+                                        load_stiffness_matrix(args.reference), args.tol)
+    for key, value in result.items():
+        print(f'{key:<20} {value}')
+
+    # Exit with an error code on mismatch
+    if not result['match']:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
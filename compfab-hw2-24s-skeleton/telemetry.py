@@ -0,0 +1,136 @@
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+import sys
+import json
+import time
+import tracemalloc
+
+# Peak resident memory is only reported on Unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_memory() -> Optional[int]:
+    '''
+    Return the peak resident set size of the process in bytes, or None if it is not available
+    on this platform.
+    '''
+    if resource is None:
+        return None
+
+    # Linux reports the peak in kilobytes while macOS reports it in bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class SolveStats:
+    '''
+    Structured statistics of a FEM computation (e.g., a call to a solve function), including the
+    wall time of each phase, the statistics of all linear solves, the residual history of
+    nonlinear solvers, and the peak memory.
+
+    Peak memory is measured in two ways. `peak_memory` is the peak resident set size of the whole
+    process so far, which is cheap but never decreases. If `tracemalloc` is tracing, which slows
+    down allocations, `peak_traced_memory` is the peak memory allocated during this computation.
+    '''
+    def __init__(self, name: str, linear_solves: Optional[List[Dict]]=None):
+        '''
+        `name` identifies the computation, e.g., 'newton'. `linear_solves` is the list where
+        the statistics of linear solves are appended to.
+        '''
+        self.name = name
+        self.phase_times: Dict[str, float] = {}
+        self.linear_solves: List[Dict] = [] if linear_solves is None else linear_solves
+        self.residual_history: List[float] = []
+        self.info: Dict = {}
+
+        self.total_time = 0.0
+        self.peak_memory: Optional[int] = None
+        self.peak_traced_memory: Optional[int] = None
+
+        # Start measuring
+        self.start_time = time.perf_counter()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+
+    @contextmanager
+    def timer(self, phase: str) -> Iterator[None]:
+        '''
+        Context manager that adds the wall time of the enclosed code to `phase`.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phase_times[phase] = \
+                self.phase_times.get(phase, 0.0) + time.perf_counter() - start
+
+    @property
+    def linear_iterations(self) -> int:
+        '''
+        Total number of iterations of all linear solves.
+        '''
+        return sum(info['iterations'] for info in self.linear_solves)
+
+    def finish(self):
+        '''
+        Stop measuring the total time and the peak memory.
+        '''
+        self.total_time = time.perf_counter() - self.start_time
+        self.peak_memory = peak_memory()
+        if tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            self.peak_traced_memory = max(self.peak_traced_memory or 0, peak)
+
+    def merge(self, other: 'SolveStats'):
+        '''
+        Accumulate the phase times, linear solves, residual history, and traced peak memory of a
+        nested computation (e.g., a Newton solve within load continuation).
+        '''
+        for phase, t in other.phase_times.items():
+            self.phase_times[phase] = self.phase_times.get(phase, 0.0) + t
+
+        self.linear_solves.extend(other.linear_solves)
+        self.residual_history.extend(other.residual_history)
+
+        if other.peak_traced_memory is not None:
+            self.peak_traced_memory = max(self.peak_traced_memory or 0,
+                                          other.peak_traced_memory)
+
+    def to_dict(self) -> Dict:
+        '''
+        Convert the statistics into a JSON-serializable dictionary.
+        '''
+        return {
+            'name': self.name,
+            'timestamp': time.time(),
+            'total_time': self.total_time,
+            'phase_times': self.phase_times,
+            'linear_solves': self.linear_solves,
+            'linear_iterations': self.linear_iterations,
+            'residual_history': self.residual_history,
+            'peak_memory': self.peak_memory,
+            'peak_traced_memory': self.peak_traced_memory,
+            'info': self.info,
+        }
+
+    def write_json(self, file_name: str):
+        '''
+        Append the statistics to a file as a line of JSON (JSON Lines format).
+        '''
+        # NumPy scalars are converted to Python numbers
+        line = json.dumps(self.to_dict(), default=lambda x: x.item())
+        with open(file_name, 'a') as f:
+            f.write(line + '\n')
+
+    def summary(self) -> str:
+        '''
+        Return a human-readable summary of the phase times.
+        '''
+        total = max(self.total_time, 1e-12)
+        phases = ', '.join(f'{phase} = {t:.3g}s ({t / total:.0%})'
+                           for phase, t in self.phase_times.items())
+        return f"'{self.name}' finished in {self.total_time:.3g}s: {phases}"
@@ -0,0 +1,23 @@
+from tet_mesh import tet_mesh_cuboid
+from material import LinearElastic
+from dynamic_fem import DynamicFEM
+
+import numpy as np
+
+
+def test_converge_on_last_newton_iteration():
+    '''
+    A time step whose Newton iteration converges on the last allowed iteration counts as
+    converged. With a direct solver, a linear elastic step converges in one iteration.
+    '''
+    mesh = tet_mesh_cuboid(4, 2, 2, 0.1)
+    fem = DynamicFEM(mesh, LinearElastic(1e6, 0.45), time_step=1e-3, solver='direct')
+
+    boundary_conditions = mesh.vertices[:, 0] < 1e-8
+    f_ext = np.zeros_like(mesh.vertices)
+    f_ext[mesh.vertices[:, 0] > mesh.vertices[:, 0].max() - 1e-8, 1] = -10.0
+
+    fem.simulate(f_ext, boundary_conditions, 3, max_newton_iters=1)
+    info = fem.dynamics_info
+    assert info['converged'] and info['failed_steps'] == 0
+    assert info['steps'] == 3 and info['newton_iterations'] == 3
@@ -0,0 +1,59 @@
+from tet_mesh import tet_mesh_cuboid
+from material import NeoHookean, LinearElastic
+from fem import StaticFEM
+
+from numpy import ndarray as array
+
+import numpy as np
+
+
+def elastic_force_loop(fem: StaticFEM, vertices: array) -> array:
+    '''
+    Reference elastic force computed by a per-element loop (the original `elastic_force`).
+    '''
+    V, T = fem.mesh.vertices, fem.mesh.elements
+    f = np.zeros_like(V)
+
+    for t in range(T.shape[0]):
+        tet_indices = T[t]
+        tet_vertices = vertices[tet_indices]
+        F = (tet_vertices[1:] - tet_vertices[0]).T @ fem.Dm_inv[t]
+
+        P = fem.material.stress_tensor(F)
+        dE_dx = fem.volumes[t] * P.T.ravel() @ fem.dF_dx[t]
+        f[tet_indices] -= dE_dx.reshape(-1, V.shape[1])
+
+    return np.where(np.abs(f) < 1e-8, 0, f)
+
+
+def test_elastic_force_bit_exact():
+    '''
+    The batched elastic force reproduces the per-element loop bit by bit, with or without the
+    energy and in parallel chunks.
+    '''
+    mesh = tet_mesh_cuboid(6, 3, 3, 0.1)
+    vertices = mesh.vertices + np.random.default_rng(0).uniform(-0.01, 0.01, mesh.vertices.shape)
+
+    for material in (NeoHookean(1e6, 0.45), LinearElastic(1e6, 0.45)):
+        f_ref = elastic_force_loop(StaticFEM(mesh, material), vertices)
+
+        for fem in (StaticFEM(mesh, material), StaticFEM(mesh, material, num_workers=3,
+                                                          chunk_size=50)):
+            assert np.array_equal(fem.elastic_force(vertices), f_ref)
+            assert np.array_equal(fem.elastic_force(vertices, return_energy=True)[0], f_ref)
+
+
+def test_neohookean_batch():
+    '''
+    Batched NeoHookean stresses match `stress_tensor` bit by bit, and the stress differentials
+    from the analytic inverse match `stress_differential` to round-off.
+    '''
+    material = NeoHookean(1e6, 0.45)
+    F = np.eye(3) + np.random.default_rng(1).uniform(-0.3, 0.3, (100, 3, 3))
+
+    P = material.stress_tensor_batch(F)
+    assert np.array_equal(P, np.stack([material.stress_tensor(Ft) for Ft in F]))
+
+    dP_dF = material.stress_differential_batch(F)
+    dP_dF_ref = np.stack([material.stress_differential(Ft) for Ft in F])
+    assert np.allclose(dP_dF, dP_dF_ref, rtol=1e-12, atol=1e-12 * np.abs(dP_dF_ref).max())
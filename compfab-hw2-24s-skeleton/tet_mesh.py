@@ -1,11 +1,22 @@
 from numpy import ndarray as array
 
-from typing import BinaryIO
+from typing import BinaryIO, Tuple
 
 import struct
 import numpy as np
 
 
+# Record layout of a triangle in binary STL files (50 bytes, little-endian)
+STL_TRIANGLE_DTYPE = np.dtype([
+    ('normal', '<f4', (3,)),
+    ('vertices', '<f4', (3, 3)),
+    ('attribute', '<u2'),
+])
+
+# Vertex indices of four triangles in a tet element
+TET_FACE_INDICES = np.array([[0, 1, 2], [1, 3, 2], [1, 0, 3], [0, 2, 3]])
+
+
 def read_array_from_file(f: BinaryIO, dtype: np.dtype, dim: int=2) -> array:
     '''
     Read a Numpy array from the current position of the input file.
@@ -21,6 +32,24 @@ def read_array_from_file(f: BinaryIO, dtype: np.dtype, dim: int=2) -> array:
     return arr.reshape(*shape)
 
 
+def memmap_array_from_file(file_name: str, offset: int, dtype: np.dtype,
+                           dim: int=2) -> Tuple[array, int]:
+    '''
+    Memory-map a Numpy array stored at byte `offset` of the input file (in the same format as
+    `read_array_from_file`). The array content is only loaded from disk when accessed. Returns
+    the read-only array and the byte offset right after it.
+    '''
+    assert dim <= 2, 'Only support up to 2D matrices'
+
+    # Read matrix shape
+    shape = tuple(int(n) for n in np.fromfile(file_name, dtype='<i8', count=dim, offset=offset))
+    offset += 8 * dim
+
+    # Map matrix content
+    arr = np.memmap(file_name, dtype=dtype, mode='r', offset=offset, shape=shape)
+    return arr, offset + arr.nbytes
+
+
 class TetMesh:
     '''
     Class of a tetrahedral mesh.
@@ -36,6 +65,9 @@ class TetMesh:
         self.V = vertices
         self.T = elements
 
+        # Cache of the boundary faces, which only depend on the elements
+        self.boundary_face_cache = None
+
     @property
     def vertices(self) -> array:
         '''
@@ -50,44 +82,154 @@ class TetMesh:
         '''
         return self.T
 
-    def write_to_file(self, file_name: str, invert_normal: bool=False):
+    def faces(self) -> array:
+        '''
+        Return the vertex indices of all tet faces as a (4T x 3) array.
+        '''
+        return self.T[:, TET_FACE_INDICES].reshape(-1, 3)
+
+    def boundary_faces(self) -> array:
+        '''
+        Return the vertex indices of the faces on the mesh surface as an (F x 3) array, in the
+        same order and orientation as `faces`. The result is cached.
+
+        A face is on the surface if it belongs to exactly one tet element, which is found by
+        hashing the sorted vertex indices of all faces. Voxel meshes from `tet_mesh_cuboid` or the
+        voxelizer are not conforming, though: adjacent voxels split their shared square face
+        along different diagonals. Such triangle pairs are matched geometrically, by the midpoint
+        of their longest edge (the center of the square) and opposite normals. The geometric
+        test assumes undeformed voxels, so compute boundary faces on the rest mesh and share
+        them with deformed meshes through `with_vertices`.
+        '''
+        if self.boundary_face_cache is not None:
+            return self.boundary_face_cache
+
+        faces = self.faces()
+        num_vertices = self.V.shape[0]
+
+        # Hash each face by its sorted vertex indices so that a face shared by two tets gets the
+        # same key from both sides
+        sorted_faces = np.sort(faces, axis=1).astype(np.int64)
+        if num_vertices < 2 ** 21:
+            keys = (sorted_faces[:, 0] * num_vertices + sorted_faces[:, 1]) * num_vertices \
+                   + sorted_faces[:, 2]
+            _, first, counts = np.unique(keys, return_index=True, return_counts=True)
+        else:
+            _, first, counts = np.unique(sorted_faces, axis=0, return_index=True,
+                                         return_counts=True)
+
+        # Faces that occur once
+        candidates = np.sort(first[counts == 1])
+
+        # Compute the longest edge midpoints and unit normals of the remaining faces
+        tri = self.V[faces[candidates]]
+        edges = tri[:, [1, 2, 0]] - tri
+        longest = np.argmax(np.linalg.norm(edges, axis=2), axis=1)
+        rows = np.arange(tri.shape[0])
+        midpoints = tri[rows, longest] + edges[rows, longest] * 0.5
+        normals = np.cross(edges[:, 0], edges[:, 1])
+        normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-300)
+
+        # Flip the normals to the same hemisphere and remember their original orientation
+        major = np.argmax(np.abs(normals), axis=1)
+        sides = np.sign(normals[rows, major])
+        normals *= sides[:, None]
+
+        # Group the faces by quantized midpoints and normals. A group with faces from both sides
+        # lies inside the mesh
+        scale = np.linalg.norm(self.V.max(axis=0) - self.V.min(axis=0)) * 1e-6
+        group_keys = np.hstack((np.rint(midpoints / scale), np.rint(normals * 1e6)))
+        group_keys = np.ascontiguousarray(group_keys.astype(np.int64))
+        group_keys = group_keys.view(np.dtype((np.void, group_keys.itemsize * 6))).ravel()
+        _, groups = np.unique(group_keys, return_inverse=True)
+        front = np.bincount(groups, weights=sides > 0)
+        back = np.bincount(groups, weights=sides < 0)
+        interior = (front > 0) & (back > 0)
+
+        self.boundary_face_cache = faces[candidates[~interior[groups]]]
+        return self.boundary_face_cache
+
+    def with_vertices(self, vertices: array) -> 'TetMesh':
         '''
-        Write the tet mesh in STL format.
+        Create a tet mesh with the same elements at new vertex positions (e.g., after
+        deformation). The new mesh shares the boundary faces of this mesh.
         '''
-        # Store mesh data into local variables (eliminates lookup overhead)
-        V, T = self.V, self.T
+        mesh = TetMesh(vertices, self.T)
+        mesh.boundary_face_cache = self.boundary_face_cache
+        return mesh
 
-        # Vertex indices of four triangles in a tet element
-        tri_indices = [[0, 1, 2], [1, 3, 2], [1, 0, 3], [0, 2, 3]]
+    def triangles(self, invert_normal: bool=False, surface_only: bool=False) -> array:
+        '''
+        Return the vertex positions of all tet faces, or only the boundary faces if
+        `surface_only` is True, as an (F x 3 x 3) array.
+        '''
+        faces = self.boundary_faces() if surface_only else self.faces()
 
         # Optionally invert normal
         if invert_normal:
-            tri_indices = [[i, k, j] for i, j, k in tri_indices]
+            faces = faces[:, [0, 2, 1]]
+
+        return self.V[faces]
+
+    def write_to_file(self, file_name: str, invert_normal: bool=False, binary: bool=False,
+                      surface_only: bool=False):
+        '''
+        Write the tet mesh in STL format. Binary STL files are much faster to write and several
+        times smaller than ASCII ones. If `surface_only` is True, only the boundary faces are
+        written, which is enough for visualization.
+        '''
+        if binary:
+            self.write_to_binary_file(file_name, invert_normal, surface_only)
+            return
+
+        # Gather the vertices of all triangles at once
+        triangles = self.triangles(invert_normal, surface_only)
 
         with open(file_name, 'w') as f:
             # Write header
             f.write('solid tet_mesh\n')
 
-            # Write tets
-            for tet in T:
-                for indices in tri_indices:
-                    # Get the current triangle
-                    tri = V[tet[indices]]
-
-                    # Write the vertices of the current triangle
-                    f.write(
-                        f'facet normal 0 0 0\n'
-                        f'    outer loop\n'
-                        f'        vertex {tri[0, 0]} {tri[0, 1]} {tri[0, 2]}\n'
-                        f'        vertex {tri[1, 0]} {tri[1, 1]} {tri[1, 2]}\n'
-                        f'        vertex {tri[2, 0]} {tri[2, 1]} {tri[2, 2]}\n'
-                        f'    endloop\n'
-                        f'endfacet\n'
-                    )
+            # Write triangles
+            for tri in triangles:
+                f.write(
+                    f'facet normal 0 0 0\n'
+                    f'    outer loop\n'
+                    f'        vertex {tri[0, 0]} {tri[0, 1]} {tri[0, 2]}\n'
+                    f'        vertex {tri[1, 0]} {tri[1, 1]} {tri[1, 2]}\n'
+                    f'        vertex {tri[2, 0]} {tri[2, 1]} {tri[2, 2]}\n'
+                    f'    endloop\n'
+                    f'endfacet\n'
+                )
 
             # Write footer
             f.write('endsolid')
 
+    def write_to_binary_file(self, file_name: str, invert_normal: bool=False,
+                             surface_only: bool=False):
+        '''
+        Write the tet mesh in binary STL format. All triangle records are built as one structured
+        array and written to the file at once.
+        '''
+        triangles = self.triangles(invert_normal, surface_only)
+
+        # Compute unit face normals (zero for degenerate triangles)
+        normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        norms = np.linalg.norm(normals, axis=1, keepdims=True)
+        normals /= np.where(norms > 0, norms, 1.0)
+
+        # Fill in the triangle records
+        records = np.zeros(triangles.shape[0], dtype=STL_TRIANGLE_DTYPE)
+        records['normal'] = normals
+        records['vertices'] = triangles
+
+        with open(file_name, 'wb') as f:
+            # Write the 80-byte header and the number of triangles
+            f.write(b'tet_mesh'.ljust(80, b'\0'))
+            f.write(struct.pack('<I', records.size))
+
+            # Write triangles
+            records.tofile(f)
+
 
 def tet_mesh_cuboid(nx: int, ny: int, nz: int, cube_size: float) -> TetMesh:
     '''
@@ -123,18 +265,28 @@ def tet_mesh_cuboid(nx: int, ny: int, nz: int, cube_size: float) -> TetMesh:
     return TetMesh(vertices, elements)
 
 
-def tet_mesh_from_file(file_name: str, max_size: float=0.0) -> TetMesh:
+def tet_mesh_from_file(file_name: str, max_size: float=0.0, mmap: bool=False) -> TetMesh:
     '''
     Read a tet mesh from binary file (backward compatibility with HW3). Optionally scale the mesh
     so that its longest dimension is equal to `max_size`.
+
+    If `mmap` is True, the vertex and element arrays are memory-mapped from the file instead of
+    read into memory, so that large meshes open instantly. Note that scaling the mesh creates an
+    in-memory copy of the vertex array.
     '''
+    # Memory-map mesh data
+    if mmap:
+        V, offset = memmap_array_from_file(file_name, 0, np.dtype(np.float64))
+        T, _ = memmap_array_from_file(file_name, offset, np.dtype(np.int32))
+
     # Read mesh data
-    with open(file_name, 'rb') as f:
-        # Read the vertex array (V)
-        V = read_array_from_file(f, np.dtype(np.float64))
+    else:
+        with open(file_name, 'rb') as f:
+            # Read the vertex array (V)
+            V = read_array_from_file(f, np.dtype(np.float64))
 
-        # Read the elements array (T)
-        T = read_array_from_file(f, np.dtype(np.int32))
+            # Read the elements array (T)
+            T = read_array_from_file(f, np.dtype(np.int32))
 
     # Optionally scale the mesh
     if max_size > 0.0:
@@ -0,0 +1,74 @@
+from topopt import SOLVERS, TopologyOptimization
+
+from contextlib import redirect_stdout
+from typing import List
+
+import io
+import time
+import argparse
+import numpy as np
+
+
+def benchmark_cg(sizes: List[int], solvers: List[str], num_iters: int=200, penalty: int=3):
+    '''
+    Measure the throughput of the CG solver in `TopologyOptimization.solve_fem` (CG iterations
+    per second) over grid sizes. Each solve runs exactly `num_iters` iterations from zero on an
+    MBB beam with a uniform density.
+
+    Params:
+        * `sizes: List[int]`   - grid sizes to test (x by x/2)
+        * `solvers: List[str]` - CG-based solvers to test ('cg' or 'mgcg')
+        * `num_iters: int`     - number of CG iterations per solve
+        * `penalty: int`       - the penalty exponent
+    '''
+    print(f'------------ Benchmark: CG iterations per second ({num_iters} iterations) '
+          f'------------')
+    print(f'{"size":>6} {"#elements":>10} {"solver":>7} {"time (s)":>9} {"iter/s":>9} '
+          f'{"elem*iter/s":>12}')
+
+    for size in sizes:
+        opt = TopologyOptimization(size, size // 2, 'mbb')
+        opt.density[:] = 0.5
+        num_elements = opt.density.size
+
+        for solver in solvers:
+            # A zero tolerance runs the full iteration budget. Solver output is hidden
+            start = time.perf_counter()
+            with redirect_stdout(io.StringIO()):
+                opt.solve_fem(penalty, cg_max_iters=num_iters, cg_tolerance=0.0, solver=solver,
+                              warm_start=False)
+            t = time.perf_counter() - start
+
+            rate = opt.cg_iterations / t
+            print(f'{size:>6} {num_elements:>10} {solver:>7} {t:>9.3f} {rate:>9.4g} '
+                  f'{rate * num_elements:>12.4g}')
+
+
+def main():
+    '''
+    Main routine.
+    '''
+    # Command line argument parser
+    parser = argparse.ArgumentParser(description='Microbenchmark of the topology optimization '
+                                                 'CG solver')
+    parser.add_argument('-s', '--sizes', default='50,100,200,400,800',
+                        help='Comma-separated grid sizes (x by x/2)')
+    parser.add_argument('-n', '--num-iters', type=int, default=200,
+                        help='Number of CG iterations per solve')
+    parser.add_argument('--solvers', default='cg,mgcg',
+                        help='Comma-separated CG-based solvers to test')
+
+    # Process arguments
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    solvers = args.solvers.split(',')
+    for solver in solvers:
+        if solver not in SOLVERS or solver == 'direct':
+            raise ValueError(f"Unknown CG-based solver '{solver}'")
+
+    benchmark_cg(sizes, solvers, args.num_iters)
+
+
+if __name__ == '__main__':
+    main()
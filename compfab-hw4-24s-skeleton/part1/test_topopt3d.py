@@ -0,0 +1,35 @@
+from topopt3d import TopologyOptimization3D
+
+import numpy as np
+
+
+def test_optimality_criteria():
+    '''
+    Run a few design iterations of 3D topology optimization on a small grid. Every OC update must
+    meet the volume constraint, and the compliance must decrease.
+    '''
+    fraction, penalty = 0.3, 3
+    opt = TopologyOptimization3D(12, 6, 4, 'cantilever')
+    opt.density[:] = fraction
+
+    compliances = []
+    for _ in range(5):
+        s = opt.solve_fem(penalty, cg_tolerance=1e-6)
+        compliances.append(opt.compliance)
+        opt.optimality_criteria(opt.sensitivity_filtering(s, 1.5), fraction, 0.2)
+
+        # Volume constraint and valid density range
+        assert abs(opt.density.mean() - fraction) < 1e-6
+        assert opt.density.min() >= 1e-2 and opt.density.max() <= 1.0
+
+    assert all(c1 < c0 for c0, c1 in zip(compliances, compliances[1:])), compliances
+
+
+def test_sensitivity_filtering():
+    '''
+    Filtering preserves uniform sensitivities, including at the grid boundary.
+    '''
+    opt = TopologyOptimization3D(6, 5, 4, 'cantilever')
+    opt.density[:] = np.random.default_rng(0).uniform(0.1, 1.0, opt.density.shape)
+    s_filtered = opt.sensitivity_filtering(np.full(opt.density.shape, 2.0), 2.5)
+    assert np.allclose(s_filtered, 2.0)
@@ -1,4 +1,6 @@
 from scipy.signal import convolve2d
+from scipy.sparse import csc_matrix
+from scipy.sparse.linalg import splu
 from PIL import Image
 
 from typing import List, Tuple
@@ -9,6 +11,328 @@ import argparse
 import numpy as np
 
 
+# Linear solvers of the FEM problem
+SOLVERS = ('cg', 'mgcg', 'direct')
+
+
+def nested_dissection(node_ids: array, leaf_size: int=16) -> array:
+    '''
+    Compute the nested dissection ordering of the nodes of a regular grid. The grid is split in
+    half along its longer side by a line of nodes (the separator), and both halves are ordered
+    recursively before the separator. Eliminating nodes in this order keeps the fill-in of the
+    sparse LU factorization low on 2D grids.
+
+    Params:
+        * `node_ids: array` - (N, M), node indices of the grid
+        * `leaf_size: int`  - grids with at most this many nodes are not split further
+
+    Return value:
+        * `order: array` - (N * M), node indices in the elimination order
+    '''
+    nx, ny = node_ids.shape
+    if nx * ny <= leaf_size or min(nx, ny) < 3:
+        return node_ids.ravel()
+
+    # Split along the longer side
+    if nx < ny:
+        return nested_dissection(node_ids.T, leaf_size)
+
+    m = nx // 2
+    return np.concatenate((nested_dissection(node_ids[:m], leaf_size),
+                           nested_dissection(node_ids[m + 1:], leaf_size), node_ids[m]))
+
+
+class StiffnessKernel:
+    '''
+    Matrix-vector product with the stiffness matrix of a quad grid that does not allocate any
+    arrays. The element stiffness scales are fixed at construction, and the unrolled element
+    vectors are kept in preallocated buffers, so that the 8x8 element products of all elements
+    are computed by a single matrix multiplication (N * M x 8) * (8 x 8).
+    '''
+    def __init__(self, Ke: array, scale: array):
+        '''
+        Params:
+            * `Ke: array`    - (8, 8), the element stiffness matrix
+            * `scale: array` - (N, M), the stiffness scale of each element (e.g., density **
+                               penalty)
+        '''
+        self.Ke_T = np.ascontiguousarray(Ke.T)
+        self.scale = np.expand_dims(scale, 2)
+
+        # Work buffers of unrolled element vectors (N, M, 8)
+        self.x_unroll = np.empty((*scale.shape, 8))
+        self.Kx_unroll = np.empty((*scale.shape, 8))
+
+    def apply(self, x: array, out: array=None) -> array:
+        '''
+        Compute the matrix-vector product of the stiffness matrix and a vector field.
+
+        Params:
+            * `x: array`   - (N + 1, M + 1, 2), the input vector field
+            * `out: array` - (N + 1, M + 1, 2), optional output array (must not be `x`)
+
+        Return value:
+            * `Kx: array` - (N + 1, M + 1, 2), the output vector field after left-multiplication
+                            by K
+        '''
+        x_unroll, Kx_unroll = self.x_unroll, self.Kx_unroll
+        if out is None:
+            out = np.empty_like(x)
+
+        # Unroll x into (N, M, 8)
+        x_unroll[:, :, :2] = x[:-1, :-1]
+        x_unroll[:, :, 2: 4] = x[:-1, 1:]
+        x_unroll[:, :, 4: 6] = x[1:, :-1]
+        x_unroll[:, :, 6:] = x[1:, 1:]
+
+        # Compute the unrolled Kx in the shape of (N, M, 8)
+        np.matmul(x_unroll.reshape(-1, 8), self.Ke_T, out=Kx_unroll.reshape(-1, 8))
+        Kx_unroll *= self.scale
+
+        # Compute the output Kx (N + 1, M + 1, 2). The first corner covers all nodes but those
+        # in the last row and column
+        out[:-1, :-1] = Kx_unroll[:, :, :2]
+        out[-1] = 0
+        out[:-1, -1] = 0
+        out[:-1, 1:] += Kx_unroll[:, :, 2: 4]
+        out[1:, :-1] += Kx_unroll[:, :, 4: 6]
+        out[1:, 1:] += Kx_unroll[:, :, 6:]
+
+        return out
+
+
+def stiffness_diagonal(Ke: array, scale: array) -> array:
+    '''
+    Compute the diagonal of the stiffness matrix of a quad grid as an (N + 1, M + 1, 2) field,
+    where `Ke` and `scale` are the same as `StiffnessKernel`.
+    '''
+    Ke_diag = np.diagonal(Ke)
+    scale = np.expand_dims(scale, 2)
+
+    diag = np.zeros((scale.shape[0] + 1, scale.shape[1] + 1, 2))
+    diag[:-1, :-1] += scale * Ke_diag[:2]
+    diag[:-1, 1:] += scale * Ke_diag[2: 4]
+    diag[1:, :-1] += scale * Ke_diag[4: 6]
+    diag[1:, 1:] += scale * Ke_diag[6:]
+
+    return diag
+
+
+def prolong(c: array, out: array, buffer: array) -> array:
+    '''
+    Bilinearly interpolate a vector field on the nodes of a coarse grid to the grid twice as fine,
+    and add the result to `out` without allocating arrays. Fine node 2i coincides with coarse node
+    i, and odd fine nodes are averages of their two (or four) coarse neighbors. Coarse nodes
+    beyond the fine grid only contribute to odd fine nodes, which happens when the number of fine
+    elements is odd along an axis (see `coarsen_scale`).
+
+    Params:
+        * `c: array`      - (Nc + 1, Mc + 1, 2), the coarse vector field
+        * `out: array`    - (N + 1, M + 1, 2), the fine vector field to add to
+        * `buffer: array` - (Nc + 1, M + 1, 2), work buffer of the interpolation along the y-axis
+
+    Return value:
+        * `out: array` - (N + 1, M + 1, 2), the fine vector field
+    '''
+    # Numbers of even and odd fine nodes along both axes
+    (ex, ey), (ox, oy) = ((n + 1) // 2 for n in out.shape[:2]), (n // 2 for n in out.shape[:2])
+
+    # Interpolate along the y-axis into the buffer
+    buffer[:, ::2] = c[:, :ey]
+    np.add(c[:, :oy], c[:, 1: oy + 1], out=buffer[:, 1::2])
+    buffer[:, 1::2] *= 0.5
+
+    # Interpolate along the x-axis and add to the output
+    out[::2] += buffer[:ex]
+    buffer *= 0.5
+    out[1::2] += buffer[:ox]
+    out[1::2] += buffer[1: ox + 1]
+
+    return out
+
+
+def restrict(f: array, out: array, buffer: array) -> array:
+    '''
+    Restrict a vector field (e.g., residual forces) on the nodes of a fine grid to the coarse
+    grid without allocating arrays. This is the transpose of `prolong`, i.e., full weighting
+    without normalization.
+
+    Params:
+        * `f: array`      - (N + 1, M + 1, 2), the fine vector field, which is overwritten
+        * `out: array`    - (Nc + 1, Mc + 1, 2), the output coarse vector field
+        * `buffer: array` - (Nc + 1, M + 1, 2), work buffer of the restriction along the x-axis
+
+    Return value:
+        * `out: array` - (Nc + 1, Mc + 1, 2), the coarse vector field
+    '''
+    # Numbers of even and odd fine nodes along both axes
+    (ex, ey), (ox, oy) = ((n + 1) // 2 for n in f.shape[:2]), (n // 2 for n in f.shape[:2])
+
+    # Restrict along the x-axis into the buffer. Odd fine nodes are split between two coarse
+    # nodes, and coarse nodes beyond the fine grid only receive from odd ones
+    buffer[:ex] = f[::2]
+    buffer[ex:] = 0.0
+    f[1::2] *= 0.5
+    buffer[:ox] += f[1::2]
+    buffer[1: ox + 1] += f[1::2]
+
+    # Restrict along the y-axis into the output
+    out[:, :ey] = buffer[:, ::2]
+    out[:, ey:] = 0.0
+    buffer[:, 1::2] *= 0.5
+    out[:, :oy] += buffer[:, 1::2]
+    out[:, 1: oy + 1] += buffer[:, 1::2]
+
+    return out
+
+
+def coarsen_scale(scale: array) -> array:
+    '''
+    Compute the element stiffness scales of the coarse grid with half as many elements along each
+    axis, where each coarse element averages the scales of its 2x2 fine elements. An odd number
+    of fine elements is padded by repeating the last row or column. The 2D element stiffness
+    matrix does not depend on the element size, so coarse grids share `Ke` with the fine grid.
+    '''
+    scale = np.pad(scale, ((0, scale.shape[0] % 2), (0, scale.shape[1] % 2)), mode='edge')
+    return 0.25 * (scale[::2, ::2] + scale[1::2, ::2] + scale[::2, 1::2] + scale[1::2, 1::2])
+
+
+class GeometricMultigrid:
+    '''
+    Matrix-free geometric multigrid V-cycle that approximates the inverse of the stiffness matrix
+    of a quad grid, to be used as a preconditioner of the conjugate gradient method. Coarse grids
+    are rediscretized from averaged element stiffness scales, smoothed by damped Jacobi
+    iterations, and the coarsest grid is solved by a dense pseudo-inverse.
+    '''
+    def __init__(self, Ke: array, scale: array, bc: Tuple[array, ...], coarsest_size: int=16,
+                 smoothing_steps: int=2, omega: float=0.6):
+        '''
+        Params:
+            * `Ke: array`             - (8, 8), the element stiffness matrix
+            * `scale: array`          - (N, M), the stiffness scale of each element
+            * `bc: tuple`             - index arrays (X, Y, dimension) of constrained coordinates
+            * `coarsest_size: int`    - grids are coarsened until both sides have at most this
+                                        many elements (default to 16)
+            * `smoothing_steps: int`  - Jacobi iterations before and after coarse grid correction
+                                        (default to 2)
+            * `omega: float`          - damping factor of Jacobi iterations (default to 0.6)
+        '''
+        self.Ke = Ke
+        self.smoothing_steps = smoothing_steps
+        bc = tuple(np.asarray(indices) for indices in bc)
+
+        # Build the grid hierarchy from fine to coarse. Each level stores the element scales,
+        # the stiffness kernel, the constrained coordinates, the inverse diagonal of K scaled by
+        # the damping factor for Jacobi iterations, and three work buffers for the solution, the
+        # residual and the right hand side restricted from the finer level. Together with the
+        # grid transfer buffers between consecutive levels (see `restrict` and `prolong`), a
+        # V-cycle allocates no arrays
+        self.levels: List[Tuple[array, StiffnessKernel, tuple, array, array, array, array]] = []
+        self.transfer_buffers: List[array] = []
+        while True:
+            scaled_inv_diag = omega / stiffness_diagonal(Ke, scale)
+            if bc:
+                scaled_inv_diag[bc] = 0.0
+            x = np.empty_like(scaled_inv_diag)
+            self.levels.append((scale, StiffnessKernel(Ke, scale), bc, scaled_inv_diag, x,
+                                np.empty_like(x), np.empty_like(x)))
+
+            if max(scale.shape) <= coarsest_size:
+                break
+
+            # Coarse grids have (N + 1) // 2 + 1 nodes along the x-axis
+            self.transfer_buffers.append(np.empty(((scale.shape[0] + 1) // 2 + 1,
+                                                   *x.shape[1:])))
+
+            # Constraints move to the nearest coarse node
+            scale = coarsen_scale(scale)
+            if bc:
+                bc = ((bc[0] + 1) // 2, (bc[1] + 1) // 2, bc[2])
+
+        # Factorize the coarsest grid
+        self.coarsest_inverse = self.coarsest_matrix_inverse()
+
+    def coarsest_matrix_inverse(self) -> array:
+        '''
+        Assemble the dense stiffness matrix of the coarsest grid, with constrained coordinates
+        replaced by the identity, and compute its pseudo-inverse.
+        '''
+        scale, _, bc, _, _, _, _ = self.levels[-1]
+        nx, ny = scale.shape[0] + 1, scale.shape[1] + 1
+        num_dofs = nx * ny * 2
+
+        # Coordinate indices of each quad element in the order of `Ke`
+        node_ids = np.arange(nx * ny).reshape(nx, ny)
+        element_nodes = np.dstack((node_ids[:-1, :-1], node_ids[:-1, 1:], node_ids[1:, :-1],
+                                   node_ids[1:, 1:]))
+        dof_map = (element_nodes[..., None] * 2 + np.arange(2)).reshape(-1, 8)
+
+        K = np.zeros((num_dofs, num_dofs))
+        Ke_scaled = np.expand_dims(scale, (2, 3)) * self.Ke
+        np.add.at(K, (dof_map[:, :, None], dof_map[:, None, :]), Ke_scaled.reshape(-1, 8, 8))
+
+        if bc:
+            fixed = np.ravel_multi_index(bc, (nx, ny, 2))
+            K[fixed] = 0.0
+            K[:, fixed] = 0.0
+            K[fixed, fixed] = 1.0
+
+        return np.linalg.pinv(K, hermitian=True)
+
+    def cycle(self, r: array, level: int=0) -> array:
+        '''
+        Approximately solve K * x = r on a grid level by a V-cycle starting from x = 0.
+
+        Params:
+            * `r: array`   - (N + 1, M + 1, 2), the right hand side (zero at constrained
+                             coordinates)
+            * `level: int` - index of the grid level (0 is the finest)
+
+        Return value:
+            * `x: array` - (N + 1, M + 1, 2), the approximate solution, which is a work buffer
+                           overwritten by the next cycle
+        '''
+        _, kernel, bc, scaled_inv_diag, x, work, _ = self.levels[level]
+
+        # Solve the coarsest grid directly
+        if level == len(self.levels) - 1:
+            np.matmul(self.coarsest_inverse, r.reshape(-1), out=x.reshape(-1))
+            return x
+
+        def smooth():
+            # Damped Jacobi iteration x += omega * D^(-1) * (r - K * x)
+            kernel.apply(x, out=work)
+            np.subtract(r, work, out=work)
+            np.multiply(work, scaled_inv_diag, out=work)
+            np.add(x, work, out=x)
+
+        # Pre-smoothing (the first Jacobi iteration starts from x = 0)
+        np.multiply(scaled_inv_diag, r, out=x)
+        for _ in range(self.smoothing_steps - 1):
+            smooth()
+
+        # Coarse grid correction. The residual is restricted into the right hand side buffer of
+        # the coarse level, and the coarse solution is added to x by prolongation
+        kernel.apply(x, out=work)
+        np.subtract(r, work, out=work)
+        _, _, coarse_bc, _, _, _, r_coarse = self.levels[level + 1]
+        transfer_buffer = self.transfer_buffers[level]
+        restrict(work, r_coarse, transfer_buffer)
+        if coarse_bc:
+            r_coarse[coarse_bc] = 0.0
+
+        x_coarse = self.cycle(r_coarse, level + 1)
+        prolong(x_coarse, x, transfer_buffer)
+        if bc:
+            x[bc] = 0.0
+
+        # Post-smoothing
+        for _ in range(self.smoothing_steps):
+            smooth()
+
+        return x
+
+
 class TopologyOptimization:
     '''
     2D topology optimization algorithm
@@ -38,6 +362,13 @@ class TopologyOptimization:
         # Initialize the stiffness matrix for each quad element
         self.initialize_element_stiffness_matrix(self.E, self.nu)
 
+        # Number of CG iterations of the last FEM solve and the last optimization run
+        self.cg_iterations = 0
+        self.total_cg_iterations = 0
+
+        # Initialize the sparsity pattern of the global stiffness matrix
+        self.initialize_sparsity_pattern()
+
 
     def initialize_boundary_conditions(self, bc_type: str):
         '''
@@ -132,8 +463,82 @@ class TopologyOptimization:
         self.Ke = np.ascontiguousarray(Ke_entries[indices[maps][:, maps]])
 
 
+    def initialize_sparsity_pattern(self):
+        '''
+        Precompute the sparsity pattern of the global stiffness matrix K, which never changes
+        during optimization. The displacement field flattened in the memory order of `self.x`
+        (node (i, j) owns the coordinates 2 * (i * (M + 1) + j) + [0, 1]) is permuted into the
+        nested dissection order for K, i.e., K acts on `x.ravel()[self.K_perm]`. The rows and
+        columns of constrained coordinates are replaced by those of the identity matrix, so that
+        K is nonsingular and has the same size as `self.x`.
+        '''
+        # Grid dimensions
+        grid_size_x, grid_size_y = self.density.shape
+        num_dofs = self.x.size
+
+        # Permute the coordinates into the nested dissection order of nodes
+        node_ids = np.arange(num_dofs // 2).reshape(grid_size_x + 1, grid_size_y + 1)
+        perm = (nested_dissection(node_ids)[:, None] * 2 + np.arange(2)).ravel()
+        rank = np.empty_like(perm)
+        rank[perm] = np.arange(num_dofs)
+
+        # Coordinate indices of each quad element in the order of `Ke`, i.e., the nodes (i, j),
+        # (i, j + 1), (i + 1, j), and (i + 1, j + 1)
+        element_nodes = np.dstack((node_ids[:-1, :-1], node_ids[:-1, 1:], node_ids[1:, :-1],
+                                   node_ids[1:, 1:]))
+        dof_map = rank[(element_nodes[..., None] * 2 + np.arange(2)).reshape(-1, 8)]
+
+        # Sort the entries of all element stiffness matrices by column and then by row (the CSC
+        # storage order), and find the position of each entry in the CSC data array
+        rows = np.broadcast_to(dof_map[:, :, None], (dof_map.shape[0], 8, 8)).ravel()
+        cols = np.broadcast_to(dof_map[:, None, :], (dof_map.shape[0], 8, 8)).ravel()
+        unique_keys, data_map = np.unique(cols.astype(np.int64) * num_dofs + rows,
+                                          return_inverse=True)
+        indices = (unique_keys % num_dofs).astype(np.int32)
+        indptr = np.searchsorted(unique_keys // num_dofs, np.arange(num_dofs + 1))
+
+        # Entries in the rows and columns of constrained coordinates are sent to a trailing slot
+        # that is discarded. The diagonal entries of these coordinates are set to 1 instead
+        fixed = np.zeros(num_dofs, dtype=bool)
+        if self.bc:
+            fixed[rank[np.ravel_multi_index(self.bc, self.x.shape)]] = True
+        data_map = np.where(fixed[rows] | fixed[cols], unique_keys.size, data_map.ravel())
+
+        fixed_ids = np.flatnonzero(fixed)
+        self.K_perm = perm
+        self.K_indices, self.K_indptr = indices, indptr.astype(np.int32)
+        self.K_data_map = data_map.astype(np.int32)
+        self.K_fixed_diagonal = np.searchsorted(unique_keys, fixed_ids * (num_dofs + 1))
+
+
+    def assemble_stiffness_matrix(self, penalty: int) -> csc_matrix:
+        '''
+        Assemble the global stiffness matrix K from the element stiffness matrix `Ke` scaled by
+        `density ** penalty`, using the precomputed sparsity pattern.
+
+        Params:
+            * `penalty: int` - the penalty exponent
+
+        Return value:
+            * `K: csc_matrix` - (2(N + 1)(M + 1), 2(N + 1)(M + 1)), the stiffness matrix in the
+                                nested dissection order of coordinates, where constrained
+                                coordinates are replaced by the identity
+        '''
+        # Save class members as local variables
+        indices, indptr, data_map = self.K_indices, self.K_indptr, self.K_data_map
+        num_dofs = self.x.size
+
+        # Sum up the scaled element stiffness matrices into the CSC data array
+        Ke_scaled = np.expand_dims(self.density ** penalty, (2, 3)) * self.Ke
+        data = np.bincount(data_map, weights=Ke_scaled.ravel(), minlength=indices.size + 1)
+        data = data[:indices.size]
+        data[self.K_fixed_diagonal] = 1.0
+
+        return csc_matrix((data, indices, indptr), shape=(num_dofs, num_dofs))
+
+
     def solve_fem(self, penalty: int, cg_max_iters: int=10 ** 5,
-                  cg_tolerance: float=1e-4) -> array:
+                  cg_tolerance: float=1e-4, solver: str='cg', warm_start: bool=True) -> array:
         '''
         Solve the FEM problem and compute sensitivities.
 
@@ -142,6 +547,16 @@ class TopologyOptimization:
             * `cg_max_iters: int`   - Max. iterations of the Conjugate Gradient solver
                                       (default to 10^5)
             * `cg_tolerance: float` - Relative error tolerance of the CG solver (default to 1e-4)
+            * `solver: str`         - linear solver: 'cg' for matrix-free Conjugate Gradient;
+                                      'mgcg' for matrix-free Conjugate Gradient preconditioned by
+                                      geometric multigrid, whose number of iterations barely
+                                      grows with the grid size; 'direct' for sparse LU
+                                      factorization of the assembled stiffness matrix. The latter
+                                      two are much faster on large grids since void elements make
+                                      K badly conditioned (default to 'cg')
+            * `warm_start: bool`    - start CG from the current displacement field (e.g., the
+                                      solution of the last design iteration) rather than zero
+                                      (default to True)
 
         Return value:
             * `s: array` - (N, M), sentivity values
@@ -156,36 +571,8 @@ class TopologyOptimization:
         # Save NumPy functions as local variables
         dstack = np.dstack
         expand_dims = np.expand_dims
-        zeros_like = np.zeros_like
 
         # Helper functions
-        def apply_K(x: array) -> array:
-            '''
-            Compute the matrix-vector product of the stiffness matrix `K` and a vector `x`.
-            Both input and output are shaped as vector fields rather than flattened vectors.
-
-            Params:
-                * `x: array` - (N + 1, M + 1, 2), the input vector field
-
-            Return value:
-                * `Kx: array` - (N, M, 2), the output vector field after left-multiplication by K
-            '''
-            # Unroll x into (N, M, 8, 1)
-            x_unroll = dstack((x[:-1, :-1], x[:-1, 1:], x[1:, :-1], x[1:, 1:]))
-
-            # Compute the unrolled Kx in the shape of (N, M, 8)
-            Kx_unroll = (Ke @ expand_dims(x_unroll, 3)).squeeze(3)
-            Kx_unroll *= expand_dims(density ** penalty, 2)
-
-            # Compute the output Kx (N, M, 2)
-            Kx = zeros_like(x)
-            Kx[:-1, :-1] += Kx_unroll[:, :, :2]
-            Kx[:-1, 1:] += Kx_unroll[:, :, 2: 4]
-            Kx[1:, :-1] += Kx_unroll[:, :, 4: 6]
-            Kx[1:, 1:] += Kx_unroll[:, :, 6:]
-
-            return Kx
-
         def get_sensitivity(x: array) -> array:
             '''
             Compute the sensitivity matrix for a vector field x using the formula
@@ -210,46 +597,99 @@ class TopologyOptimization:
 
             return s
 
+        # Check input validity
+        if solver not in SOLVERS:
+            raise ValueError(f"Unknown solver '{solver}', should be one of {list(SOLVERS)}")
+
+        # Number of CG iterations of this solve
+        self.cg_iterations = 0
+
+        # Solve K * x = f using the sparse LU factorization of K. Constrained coordinates have
+        # zero forces, so their displacements are zero. K is symmetric and already in nested
+        # dissection order, so SuperLU keeps the order and pivots on the diagonal
+        if solver == 'direct':
+            K = self.assemble_stiffness_matrix(penalty)
+            b = f.copy()
+            b[bc] = 0
+
+            perm = self.K_perm
+            lu = splu(K, permc_spec='NATURAL', diag_pivot_thresh=0.0,
+                      options={'SymmetricMode': True})
+            x.ravel()[perm] = lu.solve(b.ravel()[perm])
+            print('Direct solver finished')
+
+            # Compute sensitivities
+            return get_sensitivity(x)
+
+        # The stiffness kernel computes density ** penalty once per solve and applies K without
+        # allocating arrays. Together with the preallocated buffers below and the per-level
+        # buffers of the multigrid preconditioner, the CG loop updates all vectors in place
+        scale = density ** penalty
+        kernel = StiffnessKernel(Ke, scale)
+        bc = tuple(np.asarray(indices) for indices in bc)
+
+        # The multigrid-preconditioned CG replaces the residual forces r by the preconditioned
+        # residual z = M * r when updating the conjugate vector, where M approximates K^(-1) by a
+        # multigrid V-cycle. Plain CG is the special case z = r
+        if solver == 'mgcg':
+            multigrid = GeometricMultigrid(Ke, scale, bc)
+            precondition = multigrid.cycle
+        else:
+            precondition = lambda r: r
+
         # Error tolerance value
         f_tol = np.abs(f).max() * cg_tolerance
 
-        # Compute initial residual forces r = f - Kx and the conjugate vector p = r
-        Kx = apply_K(x)
-        r = f - Kx
+        # Start from zero unless warm-starting
+        if not warm_start:
+            x[:] = 0
+
+        # Compute initial residual forces r = f - Kx and the conjugate vector p = z
+        Kp = kernel.apply(x)
+        r = f - Kp
         r[bc] = 0
-        p = r.copy()
+        z = precondition(r)
+        p = z.copy()
+        work = np.empty_like(x)
+
+        # Flattened views for dot products
+        rr, pp, Kpp = r.ravel(), p.ravel(), Kp.ravel()
 
         # Conjugate gradient loop
         print('CG solver start')
 
         for it in range(cg_max_iters):
             # Compute Kp
-            Kp = apply_K(p)
+            kernel.apply(p, out=Kp)
             Kp[bc] = 0
 
             # Compute the step size
-            rr = r.ravel()
-            r_dot = rr @ rr
-            alpha = r_dot / (p.ravel() @ Kp.ravel() + 1e-100)
+            r_dot = rr @ z.ravel()
+            alpha = r_dot / (pp @ Kpp + 1e-100)
 
             # Update x and r
-            x += alpha * p
-            r -= alpha * Kp
+            np.multiply(p, alpha, out=work)
+            x += work
+            np.multiply(Kp, alpha, out=work)
+            r -= work
 
             # Exit the loop if the error tolerance is met
-            r_max = abs(r).max()
+            r_max = np.abs(r, out=work).max()
             if not it % 1000:
                 print(f'  iter {it}, r = {r_max:.6f}')
             if r_max < f_tol:
                 break
 
             # Compute the step size
-            beta = (rr @ rr) / (r_dot + 1e-100)
+            z = precondition(r)
+            beta = (rr @ z.ravel()) / (r_dot + 1e-100)
 
             # Update p
-            p[:] = r + beta * p
+            p *= beta
+            p += z
 
         # Check CG success
+        self.cg_iterations = it + 1
         if r_max < f_tol:
             print(f'CG converged in {it + 1} iterations')
         else:
@@ -399,7 +839,9 @@ class TopologyOptimization:
 
 
     def run(self, fraction: float, penalty: int=3, radius: float=1.5, threshold: float=0.005,
-            change_limit: float=0.2):
+            change_limit: float=0.2, solver: str='cg', warm_start: bool=True,
+            cg_tolerance: float=1e-4, max_cg_tolerance: float=1e-2,
+            adaptive_tolerance: bool=True):
         '''
         Run topology optimization.
 
@@ -409,11 +851,27 @@ class TopologyOptimization:
             * `radius: float`       - radius for sensitivity filtering (default to 1.5)
             * `threshold: float`    - termination threshold for density changes (default to 0.005)
             * `change_limit: float` - maximum density change in each OC step (default to 0.2)
+            * `solver: str`         - linear solver of the FEM problem (default to 'cg', see
+                                      `solve_fem`)
+            * `warm_start: bool`    - start each CG solve from the displacements of the last
+                                      design iteration (default to True)
+            * `cg_tolerance: float` - relative error tolerance of CG near convergence (default to
+                                      1e-4)
+            * `max_cg_tolerance: float` - the loosest relative error tolerance of CG (default to
+                                          1e-2)
+            * `adaptive_tolerance: bool` - adapt the CG tolerance to the last density change. The
+                                           sensitivities only need to be accurate enough for the
+                                           OC step, so the tolerance is loose while the design
+                                           changes a lot and tightens to `cg_tolerance` as the
+                                           density change approaches `threshold` (default to
+                                           True). Otherwise, `cg_tolerance` is always used.
         '''
         # Check input validity
         assert fraction > 0 and fraction < 1, 'target fraction must be between 0 and 1'
         assert penalty > 0, 'penalty exponent must be positive'
         assert radius >= 1, 'sensitivity filtering radius must be at least 1'
+        assert 0 < cg_tolerance <= max_cg_tolerance, \
+            'CG tolerances must satisfy 0 < cg_tolerance <= max_cg_tolerance'
 
         # Save class members as local variables
         d = self.density        # Density field
@@ -427,9 +885,15 @@ class TopologyOptimization:
         d_last = d.copy()       # density from the last iteration
         it = 1                  # iteration counter
 
+        # CG tolerance of the next FEM solve, which starts loose with adaptive tolerance
+        tolerance = max_cg_tolerance if adaptive_tolerance else cg_tolerance
+        self.total_cg_iterations = 0
+
         while True:
             # Get sensitivities from the FEM solver
-            s = self.solve_fem(penalty)
+            s = self.solve_fem(penalty, cg_tolerance=tolerance, solver=solver,
+                               warm_start=warm_start)
+            self.total_cg_iterations += self.cg_iterations
 
             # Perform sensitivity filtering
             s_filtered = self.sensitivity_filtering(s, radius)
@@ -439,13 +903,20 @@ class TopologyOptimization:
 
             # Calculate the change in density
             d_change = abs(d_last - d).max()
-            print(f'Iter {it}: density change = {d_change:.6g}')
+            print(f'Iter {it}: density change = {d_change:.6g}, CG tolerance = {tolerance:.3g}, '
+                  f'CG iterations = {self.cg_iterations}')
 
             # Exit the loop if it is sufficiently small
             if d_change < threshold:
-                print(f'Topology optimization finished in {it} iterations')
+                print(f'Topology optimization finished in {it} iterations '
+                      f'({self.total_cg_iterations} CG iterations in total)')
                 break
 
+            # Scale the CG tolerance with the density change
+            if adaptive_tolerance:
+                tolerance = float(np.clip(cg_tolerance * d_change / threshold, cg_tolerance,
+                                          max_cg_tolerance))
+
             # Update density from the last iteration
             d_last[:] = d
             it += 1
@@ -483,12 +954,20 @@ def main():
                         help='Sensitivity filtering radius')
     parser.add_argument('-m', '--change-limit', metavar='LIM', type=float, default=0.2,
                         help='Max. change limit per OC step')
+    parser.add_argument('--solver', default='cg', choices=list(SOLVERS),
+                        help='Linear solver of the FEM problem (default to cg)')
+    parser.add_argument('--no-warm-start', action='store_true',
+                        help='Start each CG solve from zero displacements')
+    parser.add_argument('--fixed-tolerance', action='store_true',
+                        help='Use a fixed CG tolerance instead of adapting it to density changes')
 
     args = parser.parse_args()
 
     # Run topology optimization
     opt = TopologyOptimization(args.size, args.size // 2, args.bc_type)
-    opt.run(args.fraction, args.penalty, args.radius, change_limit=args.change_limit)
+    opt.run(args.fraction, args.penalty, args.radius, change_limit=args.change_limit,
+            solver=args.solver, warm_start=not args.no_warm_start,
+            adaptive_tolerance=not args.fixed_tolerance)
 
     # Create the result folder
     ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
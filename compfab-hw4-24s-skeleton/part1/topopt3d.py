@@ -0,0 +1,779 @@
+from scipy.signal import fftconvolve
+
+from itertools import product
+from typing import List, Tuple
+from numpy import ndarray as array
+
+import os
+import argparse
+import numpy as np
+
+
+# Linear solvers of the 3D FEM problem
+SOLVERS_3D = ('cg', 'mgcg')
+
+# Grid offsets of the eight hex element corners. The i-th corner sits at the offset
+# (i >> 2, (i >> 1) & 1, i & 1), the same as the voxel corners in part 2
+HEX_CORNER_OFFSETS = tuple(product((0, 1), repeat=3))
+
+
+def corner_slices(offset: Tuple[int, int, int]) -> Tuple[slice, slice, slice]:
+    '''
+    Slices of a node field (N + 1, M + 1, L + 1, ...) that select one corner of every element,
+    given the grid offset of the corner.
+    '''
+    return tuple(slice(1, None) if o else slice(None, -1) for o in offset)
+
+
+class StiffnessKernel:
+    '''
+    Matrix-free product with the stiffness matrix of a hex grid, which is the 3D counterpart of
+    `topopt.StiffnessKernel`. The unrolled element vectors are kept in two preallocated (24, N,
+    M, L) buffers, so that the 24x24 element products of all elements are computed by a single
+    matrix multiplication and no arrays are allocated. The buffers store one coordinate of one
+    element corner per row, which keeps gathering from and scattering to nodes contiguous along
+    the z-axis. They dominate the memory usage of 3D topology optimization, so they default to
+    single precision.
+    '''
+    def __init__(self, Ke: array, scale: array, dtype: type=np.float32):
+        '''
+        Params:
+            * `Ke: array`    - (24, 24), the element stiffness matrix
+            * `scale: array` - (N, M, L), the stiffness scale of each element (e.g., density **
+                               penalty)
+            * `dtype: type`  - data type of the work buffers (default to float32)
+        '''
+        self.Ke = Ke
+        self.Ke_work = Ke.astype(dtype)
+        self.scale = scale.astype(dtype)
+        self.corners = [corner_slices(offset) for offset in HEX_CORNER_OFFSETS]
+
+        # Work buffers of unrolled element vectors (24, N, M, L) and of the output vector field
+        # with coordinates first (3, N + 1, M + 1, L + 1)
+        self.x_unroll = np.empty((24, *scale.shape), dtype=dtype)
+        self.Kx_unroll = np.empty((24, *scale.shape), dtype=dtype)
+        self.Kx_nodes = np.empty((3, *(n + 1 for n in scale.shape)), dtype=dtype)
+
+    def unroll(self, x: array) -> array:
+        '''
+        Gather the element vectors of a vector field (N + 1, M + 1, L + 1, 3) into the unrolled
+        buffer (24, N, M, L) and multiply them by the unscaled `Ke`.
+        '''
+        x_unroll, Kx_unroll = self.x_unroll, self.Kx_unroll
+        for i, corner in enumerate(self.corners):
+            x_unroll[i * 3: i * 3 + 3] = np.moveaxis(x[corner], 3, 0)
+
+        np.matmul(self.Ke_work, x_unroll.reshape(24, -1), out=Kx_unroll.reshape(24, -1))
+        return Kx_unroll
+
+    def apply(self, x: array, out: array=None) -> array:
+        '''
+        Compute the matrix-vector product of the stiffness matrix and a vector field.
+
+        Params:
+            * `x: array`   - (N + 1, M + 1, L + 1, 3), the input vector field
+            * `out: array` - (N + 1, M + 1, L + 1, 3), optional output array (must not be `x`)
+
+        Return value:
+            * `Kx: array` - (N + 1, M + 1, L + 1, 3), the output vector field after
+                            left-multiplication by K
+        '''
+        Kx_nodes = self.Kx_nodes
+        if out is None:
+            out = np.empty_like(x)
+
+        Kx_unroll = self.unroll(x)
+        Kx_unroll *= self.scale
+
+        # Scatter the element forces to nodes. The first corner covers all nodes but those on
+        # the three far sides of the grid
+        Kx_nodes[:, -1] = 0
+        Kx_nodes[:, :-1, -1] = 0
+        Kx_nodes[:, :-1, :-1, -1] = 0
+        for i, corner in enumerate(self.corners):
+            if i:
+                Kx_nodes[(slice(None), *corner)] += Kx_unroll[i * 3: i * 3 + 3]
+            else:
+                Kx_nodes[(slice(None), *corner)] = Kx_unroll[:3]
+
+        # Move the coordinates to the last axis
+        np.copyto(out, np.moveaxis(Kx_nodes, 0, 3))
+        return out
+
+    def element_energies(self, x: array) -> array:
+        '''
+        Compute xe^T * Ke * xe of every element for a vector field x (N + 1, M + 1, L + 1, 3),
+        without the stiffness scales.
+        '''
+        Kx_unroll = self.unroll(x)
+        return np.einsum('i...,i...->...', self.x_unroll, Kx_unroll).astype(np.float64)
+
+
+def stiffness_diagonal(Ke: array, scale: array, dtype: type=np.float32) -> array:
+    '''
+    Compute the diagonal of the stiffness matrix of a hex grid as an (N + 1, M + 1, L + 1, 3)
+    field, where `Ke` and `scale` are the same as `StiffnessKernel`.
+    '''
+    Ke_diag = np.diagonal(Ke).reshape(8, 3)
+    scale = np.expand_dims(scale, 3)
+
+    diag = np.zeros((scale.shape[0] + 1, scale.shape[1] + 1, scale.shape[2] + 1, 3), dtype=dtype)
+    for i, offset in enumerate(HEX_CORNER_OFFSETS):
+        diag[corner_slices(offset)] += scale * Ke_diag[i]
+
+    return diag
+
+
+def prolong(c: array, shape: Tuple[int, ...]) -> array:
+    '''
+    Trilinearly interpolate a vector field on the nodes of a coarse grid to the grid twice as
+    fine. See `topopt.prolong` for the node correspondence.
+
+    Params:
+        * `c: array`     - (Nc + 1, Mc + 1, Lc + 1, 3), the coarse vector field
+        * `shape: tuple` - (N + 1, M + 1, L + 1, 3), the shape of the fine vector field
+
+    Return value:
+        * `f: array` - (N + 1, M + 1, L + 1, 3), the fine vector field
+    '''
+    # Interpolate along each axis in turn
+    for axis in range(3):
+        c = np.moveaxis(c, axis, 0)
+        f = np.empty((c.shape[0] * 2 - 1, *c.shape[1:]), dtype=c.dtype)
+        f[::2] = c
+        np.add(c[:-1], c[1:], out=f[1::2])
+        f[1::2] *= 0.5
+        c = np.moveaxis(f[:shape[axis]], 0, axis)
+
+    return c
+
+
+def restrict(f: array, shape: Tuple[int, ...]) -> array:
+    '''
+    Restrict a vector field on the nodes of a fine grid to the coarse grid, which is the
+    transpose of `prolong`.
+
+    Params:
+        * `f: array`     - (N + 1, M + 1, L + 1, 3), the fine vector field
+        * `shape: tuple` - (Nc + 1, Mc + 1, Lc + 1, 3), the shape of the coarse vector field
+
+    Return value:
+        * `c: array` - (Nc + 1, Mc + 1, Lc + 1, 3), the coarse vector field
+    '''
+    # Restrict along each axis in turn, padding dropped fine nodes with zeros
+    for axis in range(3):
+        f = np.moveaxis(f, axis, 0)
+        padding = shape[axis] * 2 - 1 - f.shape[0]
+        if padding:
+            f = np.concatenate((f, np.zeros((padding, *f.shape[1:]), dtype=f.dtype)))
+
+        c = f[::2].copy()
+        c[:-1] += 0.5 * f[1::2]
+        c[1:] += 0.5 * f[1::2]
+        f = np.moveaxis(c, 0, axis)
+
+    return f
+
+
+def coarsen_scale(scale: array) -> array:
+    '''
+    Compute the element stiffness scales of the coarse grid with half as many elements along each
+    axis, where each coarse element averages its 2x2x2 fine elements (padded by repeating the last
+    layer if the number of fine elements is odd). Unlike 2D, the stiffness of a hex element is
+    proportional to its size, so the average is doubled for the coarse grid to share `Ke`.
+    '''
+    scale = np.pad(scale, [(0, n % 2) for n in scale.shape], mode='edge')
+    return 0.25 * sum(scale[o[0]::2, o[1]::2, o[2]::2] for o in HEX_CORNER_OFFSETS)
+
+
+class GeometricMultigrid:
+    '''
+    Matrix-free geometric multigrid V-cycle that approximates the inverse of the stiffness matrix
+    of a hex grid, to be used as a preconditioner of the conjugate gradient method. This follows
+    `topopt.GeometricMultigrid`, except that all levels work in the precision of the stiffness
+    kernel, and the finest level shares the kernel (and its buffers) with the CG solver.
+    '''
+    def __init__(self, kernel: StiffnessKernel, bc: Tuple[array, ...], coarsest_size: int=4,
+                 smoothing_steps: int=2, omega: float=0.4):
+        '''
+        Params:
+            * `kernel: StiffnessKernel` - the stiffness kernel of the finest grid
+            * `bc: tuple`               - index arrays (X, Y, Z, dimension) of constrained
+                                          coordinates
+            * `coarsest_size: int`      - grids are coarsened until all sides have at most this
+                                          many elements (default to 4)
+            * `smoothing_steps: int`    - Jacobi iterations before and after coarse grid
+                                          correction (default to 2)
+            * `omega: float`            - damping factor of Jacobi iterations (default to 0.4)
+        '''
+        Ke, dtype = kernel.Ke, kernel.x_unroll.dtype
+        self.Ke = Ke
+        self.smoothing_steps = smoothing_steps
+        scale = kernel.scale
+
+        # Build the grid hierarchy from fine to coarse. Each level stores the element scales,
+        # the stiffness kernel, the constrained coordinates, the scaled inverse diagonal of K,
+        # and two work buffers for the solution and the residual
+        self.levels: List[Tuple[array, StiffnessKernel, tuple, array, array, array]] = []
+        while True:
+            scaled_inv_diag = omega / stiffness_diagonal(Ke, scale, dtype)
+            if bc:
+                scaled_inv_diag[bc] = 0.0
+            x = np.empty_like(scaled_inv_diag)
+            self.levels.append((scale, kernel, bc, scaled_inv_diag, x, np.empty_like(x)))
+
+            if max(scale.shape) <= coarsest_size:
+                break
+
+            # Constraints move to the nearest coarse node
+            scale = coarsen_scale(scale)
+            kernel = StiffnessKernel(Ke, scale, dtype)
+            if bc:
+                bc = (*((indices + 1) // 2 for indices in bc[:3]), bc[3])
+
+        # Factorize the coarsest grid
+        self.coarsest_inverse = self.coarsest_matrix_inverse().astype(dtype)
+
+    def coarsest_matrix_inverse(self) -> array:
+        '''
+        Assemble the dense stiffness matrix of the coarsest grid, with constrained coordinates
+        replaced by the identity, and compute its pseudo-inverse.
+        '''
+        scale, _, bc, _, _, _ = self.levels[-1]
+        shape = tuple(n + 1 for n in scale.shape)
+        num_dofs = np.prod(shape) * 3
+
+        # Coordinate indices of each hex element in the order of `Ke`
+        node_ids = np.arange(np.prod(shape)).reshape(shape)
+        element_nodes = np.stack([node_ids[corner_slices(o)] for o in HEX_CORNER_OFFSETS], axis=3)
+        dof_map = (element_nodes[..., None] * 3 + np.arange(3)).reshape(-1, 24)
+
+        K = np.zeros((num_dofs, num_dofs))
+        Ke_scaled = np.expand_dims(scale, (3, 4)) * self.Ke
+        np.add.at(K, (dof_map[:, :, None], dof_map[:, None, :]), Ke_scaled.reshape(-1, 24, 24))
+
+        if bc:
+            fixed = np.unique(np.ravel_multi_index(bc, (*shape, 3)))
+            K[fixed] = 0.0
+            K[:, fixed] = 0.0
+            K[fixed, fixed] = 1.0
+
+        return np.linalg.pinv(K, hermitian=True)
+
+    def cycle(self, r: array, level: int=0) -> array:
+        '''
+        Approximately solve K * x = r on a grid level by a V-cycle starting from x = 0.
+
+        Params:
+            * `r: array`   - (N + 1, M + 1, L + 1, 3), the right hand side (zero at constrained
+                             coordinates)
+            * `level: int` - index of the grid level (0 is the finest)
+
+        Return value:
+            * `x: array` - (N + 1, M + 1, L + 1, 3), the approximate solution, which is a work
+                           buffer overwritten by the next cycle
+        '''
+        # Solve the coarsest grid directly
+        if level == len(self.levels) - 1:
+            return (self.coarsest_inverse @ r.ravel()).reshape(r.shape)
+
+        _, kernel, bc, scaled_inv_diag, x, work = self.levels[level]
+
+        def smooth():
+            # Damped Jacobi iteration x += omega * D^(-1) * (r - K * x)
+            kernel.apply(x, out=work)
+            np.subtract(r, work, out=work)
+            np.multiply(work, scaled_inv_diag, out=work)
+            np.add(x, work, out=x)
+
+        # Pre-smoothing (the first Jacobi iteration starts from x = 0)
+        np.multiply(scaled_inv_diag, r, out=x)
+        for _ in range(self.smoothing_steps - 1):
+            smooth()
+
+        # Coarse grid correction
+        kernel.apply(x, out=work)
+        np.subtract(r, work, out=work)
+        coarse_shape = self.levels[level + 1][4].shape
+        r_coarse = restrict(work, coarse_shape)
+        coarse_bc = self.levels[level + 1][2]
+        if coarse_bc:
+            r_coarse[coarse_bc] = 0.0
+
+        x_coarse = self.cycle(r_coarse, level + 1)
+        x += prolong(x_coarse, x.shape)
+        if bc:
+            x[bc] = 0.0
+
+        # Post-smoothing
+        for _ in range(self.smoothing_steps):
+            smooth()
+
+        return x
+
+
+class TopologyOptimization3D:
+    '''
+    3D topology optimization algorithm on a hex grid. This follows `TopologyOptimization` (SIMP
+    with sensitivity filtering and optimality criteria), with boundary conditions given as node
+    masks. Linear systems are solved by matrix-free CG, so the memory usage is linear in the grid
+    size (about 0.6 GB for a 100^3 grid).
+    '''
+    def __init__(self, grid_size_x: int, grid_size_y: int, grid_size_z: int,
+                 bc_type: str='cantilever'):
+        '''
+        Constructor function of the 3D topology optimization class.
+
+        Params:
+            * `grid_size_x: int` - length of the FEM grid
+            * `grid_size_y: int` - height of the FEM grid (forces point to -y)
+            * `grid_size_z: int` - depth of the FEM grid
+            * `bc_type: str`     - boundary condition type: 'mbb' for MBB beam; 'cantilever' for
+                                   cantilever beam; 'none' for no forces or constraints, which are
+                                   then given by `set_boundary_conditions`
+        '''
+        # Initialize the density, displacement, and force fields
+        grid_size = (grid_size_x, grid_size_y, grid_size_z)
+        self.density = np.zeros(grid_size)
+        self.x = np.zeros((*(n + 1 for n in grid_size), 3))
+        self.f = np.zeros_like(self.x)
+
+        # Boolean mask of constrained coordinates (N + 1, M + 1, L + 1, 3)
+        self.fixed = np.zeros(self.x.shape, dtype=bool)
+
+        # Material parameters
+        self.E = 1.0        # Young's modulus
+        self.nu = 0.3       # Poisson's ratio
+
+        # Initialize boundary conditions
+        self.initialize_boundary_conditions(bc_type)
+
+        # Initialize the stiffness matrix for each hex element
+        self.initialize_element_stiffness_matrix(self.E, self.nu)
+
+        # Number of CG iterations of the last FEM solve and the last optimization run, and the
+        # compliance of the last FEM solve
+        self.cg_iterations = 0
+        self.total_cg_iterations = 0
+        self.compliance = 0.0
+
+
+    def initialize_boundary_conditions(self, bc_type: str):
+        '''
+        Initialize boundary conditions (forces, fixed dimensions) of the preset problems. Line
+        loads along the z-axis sum up to 1N.
+
+        Params:
+            * `bc_type: str` - boundary condition type: 'mbb', 'cantilever' or 'none'
+        '''
+        # Grid dimensions
+        grid_size_x, grid_size_y, grid_size_z = self.density.shape
+        f, fixed = self.f, self.fixed
+
+        ## MBB beam (the left half of the beam, mirrored at x = 0 and z = 0)
+        if bc_type == 'mbb':
+            # Force: downward, along the top edge at the center of the beam
+            f[0, grid_size_y, :, 1] = -1 / (grid_size_z + 1)
+
+            # Fixed dimensions:
+            #   1. center of the beam, x-direction
+            #   2. bottom right edge of the beam, y-direction
+            #   3. center plane across the depth, z-direction
+            fixed[0, :, :, 0] = True
+            fixed[grid_size_x, 0, :, 1] = True
+            fixed[:, :, 0, 2] = True
+
+        ## Cantilever beam
+        elif bc_type == 'cantilever':
+            # Force: downward, along the middle of the right side of the beam
+            f[grid_size_x, grid_size_y // 2, :, 1] = -1 / (grid_size_z + 1)
+
+            # Fixed dimensions: the left side, all dimensions
+            fixed[0] = True
+
+        elif bc_type != 'none':
+            raise ValueError(f"Unrecognized boundary condition type '{bc_type}'")
+
+
+    def set_boundary_conditions(self, forces: array, fixed: array):
+        '''
+        Replace the boundary conditions with custom ones.
+
+        Params:
+            * `forces: array` - (N + 1, M + 1, L + 1, 3), nodal forces
+            * `fixed: array`  - (N + 1, M + 1, L + 1, 3) boolean mask of constrained coordinates,
+                                or (N + 1, M + 1, L + 1) mask of nodes fixed in all dimensions
+        '''
+        # Check input validity
+        assert forces.shape == self.f.shape, \
+            f'Forces must have the shape {self.f.shape}, got {forces.shape}'
+        assert fixed.shape in (self.fixed.shape, self.fixed.shape[:3]), \
+            f'Fixed mask must have the shape {self.fixed.shape[:3]} (+ (3,)), got {fixed.shape}'
+
+        self.f[:] = forces
+        self.fixed[:] = fixed if fixed.ndim == 4 else fixed[..., None]
+
+
+    def initialize_element_stiffness_matrix(self, E: float, nu: float):
+        '''
+        Initialize the 24x24 stiffness matrix for each unit hex element with trilinear shape
+        functions. The shape functions are products of 1D linear functions, so every entry is a
+        product of three exact 1D integrals
+            Ke[3a + i, 3b + j] = int (lambda * dNa/di * dNb/dj + mu * dNa/dj * dNb/di
+                                      + mu * delta_ij * grad(Na) . grad(Nb))
+        where a and b are corners (in the order of `HEX_CORNER_OFFSETS`) and i, j are dimensions.
+
+        Params:
+            * `E: float`  - Young's modulus of the material
+            * `nu: float` - Poisson's ratio of the material
+        '''
+        # Lame parameters
+        lam = E * nu / ((1 + nu) * (1 - 2 * nu))
+        mu = E / (2 * (1 + nu))
+
+        # 1D integrals over [0, 1] of the linear functions phi_0 = 1 - t and phi_1 = t:
+        # phi_a * phi_b, phi_a' * phi_b', and phi_a' * phi_b
+        S = np.array([[1 / 3, 1 / 6], [1 / 6, 1 / 3]])
+        D = np.array([[1.0, -1.0], [-1.0, 1.0]])
+        G = np.array([[-0.5, -0.5], [0.5, 0.5]])
+
+        def integral(i: int, j: int) -> array:
+            # (8, 8), the integrals of dNa/di * dNb/dj
+            factors = [D if d == i == j else G if d == i else G.T if d == j else S
+                       for d in range(3)]
+            return np.kron(factors[0], np.kron(factors[1], factors[2]))
+
+        B = [[integral(i, j) for j in range(3)] for i in range(3)]
+        laplacian = B[0][0] + B[1][1] + B[2][2]
+
+        Ke = np.zeros((8, 3, 8, 3))
+        for i in range(3):
+            for j in range(3):
+                Ke[:, i, :, j] = lam * B[i][j] + mu * B[j][i] + (mu * laplacian if i == j else 0)
+
+        self.Ke = Ke.reshape(24, 24)
+
+
+    def solve_fem(self, penalty: int, cg_max_iters: int=10 ** 4, cg_tolerance: float=1e-4,
+                  solver: str='mgcg', warm_start: bool=True) -> array:
+        '''
+        Solve the FEM problem and compute sensitivities.
+
+        Params:
+            * `penalty: int`        - the penalty exponent
+            * `cg_max_iters: int`   - Max. iterations of the Conjugate Gradient solver
+                                      (default to 10^4)
+            * `cg_tolerance: float` - Relative error tolerance of the CG solver (default to 1e-4).
+                                      The single-precision kernel limits the attainable
+                                      tolerance to about 1e-6
+            * `solver: str`         - linear solver: 'cg' for matrix-free Conjugate Gradient;
+                                      'mgcg' for matrix-free Conjugate Gradient preconditioned by
+                                      geometric multigrid. Plain CG needs thousands of iterations
+                                      on large grids (default to 'mgcg')
+            * `warm_start: bool`    - start CG from the current displacement field rather than
+                                      zero (default to True)
+
+        Return value:
+            * `s: array` - (N, M, L), sentivity values
+        '''
+        # Save class members as local variables
+        density = self.density      # Density field
+        x = self.x                  # Displacement field
+        f = self.f                  # Force field
+
+        # Check input validity
+        if solver not in SOLVERS_3D:
+            raise ValueError(f"Unknown solver '{solver}', should be one of {list(SOLVERS_3D)}")
+
+        # Number of CG iterations of this solve
+        self.cg_iterations = 0
+
+        # The stiffness kernel keeps its element buffers in single precision, while the CG
+        # vectors stay in double precision for accurate dot products
+        kernel = StiffnessKernel(self.Ke, density ** penalty)
+        bc = np.nonzero(self.fixed)
+
+        # Multigrid runs in the precision of the kernel and is copied into a double-precision
+        # preconditioned residual z. Plain CG is the special case z = r
+        if solver == 'mgcg':
+            multigrid = GeometricMultigrid(kernel, bc)
+            z_buffer = np.empty_like(x)
+
+            def precondition(r: array) -> array:
+                np.copyto(z_buffer, multigrid.cycle(r))
+                return z_buffer
+        else:
+            precondition = lambda r: r
+
+        # Error tolerance value
+        f_tol = np.abs(f).max() * cg_tolerance
+
+        # Start from zero unless warm-starting
+        if not warm_start:
+            x[:] = 0
+
+        # Compute initial residual forces r = f - Kx and the conjugate vector p = z
+        Kp = kernel.apply(x)
+        r = f - Kp
+        r[bc] = 0
+        z = precondition(r)
+        p = z.copy()
+        work = np.empty_like(x)
+
+        # Flattened views for dot products
+        rr, pp, Kpp = r.ravel(), p.ravel(), Kp.ravel()
+
+        # Conjugate gradient loop
+        print('CG solver start')
+
+        for it in range(cg_max_iters):
+            # Compute Kp
+            kernel.apply(p, out=Kp)
+            Kp[bc] = 0
+
+            # Compute the step size
+            r_dot = rr @ z.ravel()
+            alpha = r_dot / (pp @ Kpp + 1e-100)
+
+            # Update x and r
+            np.multiply(p, alpha, out=work)
+            x += work
+            np.multiply(Kp, alpha, out=work)
+            r -= work
+
+            # Exit the loop if the error tolerance is met
+            r_max = np.abs(r, out=work).max()
+            if not it % 100:
+                print(f'  iter {it}, r = {r_max:.6g}')
+            if r_max < f_tol:
+                break
+
+            # Compute the step size
+            z = precondition(r)
+            beta = (rr @ z.ravel()) / (r_dot + 1e-100)
+
+            # Update p
+            p *= beta
+            p += z
+
+        # Check CG success
+        self.cg_iterations = it + 1
+        if r_max < f_tol:
+            print(f'CG converged in {it + 1} iterations')
+        else:
+            print(f'Warning - CG did not converge')
+
+        # Compute the compliance and sensitivities s = p * d^(p-1) * (xe^T * Ke * xe)
+        self.compliance = float(f.ravel() @ x.ravel())
+        s = kernel.element_energies(x)
+        s *= (density ** (penalty - 1)) * penalty
+        s = np.maximum(s, 0)
+
+        return s
+
+
+    def optimality_criteria(self, s: array, fraction: float, change_limit: float):
+        '''
+        Apply optimality criteria to update the density field.
+
+        Params:
+            * `s: array`            - (N, M, L), the sensitivity values
+            * `fraction: float`     - the target volume fraction
+            * `change_limit: float` - maximum density change in each step
+        '''
+        # Save class members as local variables
+        d = self.density        # Density field
+
+        # Bounds of new densities within the change limit and the valid density range
+        lb = np.maximum(d - change_limit, 1e-2)
+        ub = np.minimum(d + change_limit, 1.0)
+        target_volume = fraction * d.size
+
+        def update(l: float) -> array:
+            # d' = d * sqrt(sensitivity / lambda), clamped within the bounds
+            return np.clip(d * np.sqrt(s / l), lb, ub)
+
+        # Find lambda using binary search. The total volume decreases as lambda increases
+        l, r = 0.0, 1e15
+
+        while l * (1 + 1e-15) < r:
+            # Stop when the interval cannot be halved in floating point
+            m = (l + r) * 0.5
+            if m <= l or m >= r:
+                break
+            if update(m).sum() > target_volume:
+                l = m
+            else:
+                r = m
+
+        # Update the density field using the new-found lambda (`l` rather than `m`). If no lambda
+        # exceeds the target volume, densities take their upper bounds
+        self.density[:] = update(l) if l > 0 else ub
+
+
+    def sensitivity_filtering(self, s: array, radius: float) -> array:
+        '''
+        Apply filtering to the sensitivity values. This is the 3D version of
+            s'_i = SUM_j w_ij * s_j * nu_j / SUM_j w_ij * nu_j
+        with w_ij = max(r - euclidean_dist(i, j), 0) (see `TopologyOptimization`), where both
+        convolutions are computed by FFT with zero padding.
+
+        Params:
+            * `s: array`      - (N, M, L), the sensitivity values
+            * `radius: float` - the filter radius
+        '''
+        # Save class members as local variables
+        d = self.density        # Density field
+
+        # Construct the convolution kernel (the w matrix)
+        w_size = int(np.ceil(radius)) * 2 - 1
+        offsets = np.arange(w_size) - w_size // 2
+        dist = np.sqrt(offsets[:, None, None] ** 2 + offsets[:, None] ** 2 + offsets ** 2)
+        w = np.maximum(radius - dist, 0.0)
+
+        # Compute convolutions for the denominator and the numerator. FFT round-off may leave
+        # tiny negative values, which are clamped
+        d_conv = fftconvolve(d, w, mode='same')
+        ds_conv = np.maximum(fftconvolve(d * s, w, mode='same'), 0.0)
+
+        # Compute filtered sensitivities
+        s_filtered = ds_conv / d_conv
+
+        return s_filtered
+
+
+    def run(self, fraction: float, penalty: int=3, radius: float=1.5, threshold: float=0.01,
+            change_limit: float=0.2, max_iters: int=200, solver: str='mgcg',
+            warm_start: bool=True, cg_tolerance: float=1e-4, max_cg_tolerance: float=1e-2,
+            adaptive_tolerance: bool=True):
+        '''
+        Run 3D topology optimization.
+
+        Params:
+            * `fraction: float`     - target volume fraction
+            * `penalty: int`        - penalty exponent (default to 3)
+            * `radius: float`       - radius for sensitivity filtering (default to 1.5)
+            * `threshold: float`    - termination threshold for density changes (default to 0.01)
+            * `change_limit: float` - maximum density change in each OC step (default to 0.2)
+            * `max_iters: int`      - max. number of design iterations (default to 200)
+            * `solver: str`         - linear solver of the FEM problem (default to 'mgcg', see
+                                      `solve_fem`)
+            * `warm_start: bool`    - start each CG solve from the displacements of the last
+                                      design iteration (default to True)
+            * `cg_tolerance: float` - relative error tolerance of CG near convergence (default to
+                                      1e-4)
+            * `max_cg_tolerance: float` - the loosest relative error tolerance of CG (default to
+                                          1e-2)
+            * `adaptive_tolerance: bool` - adapt the CG tolerance to the last density change
+                                           (default to True, see `TopologyOptimization.run`)
+        '''
+        # Check input validity
+        assert fraction > 0 and fraction < 1, 'target fraction must be between 0 and 1'
+        assert penalty > 0, 'penalty exponent must be positive'
+        assert radius >= 1, 'sensitivity filtering radius must be at least 1'
+        assert 0 < cg_tolerance <= max_cg_tolerance, \
+            'CG tolerances must satisfy 0 < cg_tolerance <= max_cg_tolerance'
+        assert self.f.any(), 'no forces are applied'
+
+        # Save class members as local variables
+        d = self.density        # Density field
+        x = self.x              # Displacement field
+
+        # Initialization
+        d[:] = fraction
+        x[:] = 0
+
+        # Main loop
+        d_last = d.copy()       # density from the last iteration
+        tolerance = max_cg_tolerance if adaptive_tolerance else cg_tolerance
+        self.total_cg_iterations = 0
+
+        for it in range(1, max_iters + 1):
+            # Get sensitivities from the FEM solver
+            s = self.solve_fem(penalty, cg_tolerance=tolerance, solver=solver,
+                               warm_start=warm_start)
+            self.total_cg_iterations += self.cg_iterations
+
+            # Perform sensitivity filtering
+            s_filtered = self.sensitivity_filtering(s, radius)
+
+            # Update the density field by optimality criteria
+            self.optimality_criteria(s_filtered, fraction, change_limit)
+
+            # Calculate the change in density
+            d_change = abs(d_last - d).max()
+            print(f'Iter {it}: compliance = {self.compliance:.6g}, density change = '
+                  f'{d_change:.6g}, CG tolerance = {tolerance:.3g}, '
+                  f'CG iterations = {self.cg_iterations}')
+
+            # Exit the loop if it is sufficiently small
+            if d_change < threshold:
+                print(f'Topology optimization finished in {it} iterations '
+                      f'({self.total_cg_iterations} CG iterations in total)')
+                break
+
+            # Scale the CG tolerance with the density change
+            if adaptive_tolerance:
+                tolerance = float(np.clip(cg_tolerance * d_change / threshold, cg_tolerance,
+                                          max_cg_tolerance))
+
+            # Update density from the last iteration
+            d_last[:] = d
+        else:
+            print(f'Warning - topology optimization did not converge in {max_iters} iterations')
+
+
+    def save_density(self, file_name: str):
+        '''
+        Save the current density grid to a NumPy file (N, M, L).
+
+        Params:
+            * `file_name: str` - file name of the density grid
+        '''
+        np.save(file_name, self.density.astype(np.float32))
+
+
+def main():
+    '''
+    Main routine.
+    '''
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='3D topology optimization on hex grids')
+    parser.add_argument('bc_type', metavar='TYPE', choices=['mbb', 'cantilever'],
+                        help='Boundary condition type')
+    parser.add_argument('-s', '--size', default='40x20x20',
+                        help='Grid size (e.g., 40x20x20)')
+    parser.add_argument('-f', '--fraction', metavar='FRAC', type=float, default=0.3,
+                        help='Target volume fraction')
+    parser.add_argument('-p', '--penalty', metavar='NUM', type=int, default=3,
+                        help='SIMP penalty exponent')
+    parser.add_argument('-r', '--radius', metavar='RAD', type=float, default=1.5,
+                        help='Sensitivity filtering radius')
+    parser.add_argument('-m', '--change-limit', metavar='LIM', type=float, default=0.2,
+                        help='Max. change limit per OC step')
+    parser.add_argument('-n', '--max-iters', type=int, default=200,
+                        help='Max. number of design iterations')
+    parser.add_argument('--solver', default='mgcg', choices=list(SOLVERS_3D),
+                        help='Linear solver of the FEM problem (default to mgcg)')
+
+    args = parser.parse_args()
+
+    # Run topology optimization
+    nx, ny, nz = (int(s) for s in args.size.split('x'))
+    opt = TopologyOptimization3D(nx, ny, nz, args.bc_type)
+    opt.run(args.fraction, args.penalty, args.radius, change_limit=args.change_limit,
+            max_iters=args.max_iters, solver=args.solver)
+
+    # Create the result folder
+    ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    result_dir = os.path.join(ROOT_DIR, 'data', 'assignment5', 'results', 'part1')
+    os.makedirs(result_dir, mode=0o775, exist_ok=True)
+
+    # Save the final density field to the result folder
+    file_name = os.path.join(result_dir, f'topo3d_{args.bc_type}.npy')
+    opt.save_density(file_name)
+    print(f"Density grid saved to '{file_name}'")
+
+
+if __name__ == '__main__':
+    main()
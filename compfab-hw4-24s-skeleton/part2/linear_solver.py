@@ -0,0 +1,269 @@
+from abc import ABC, abstractmethod
+from numpy import ndarray as array
+from scipy.sparse import diags, spmatrix
+from scipy.sparse.linalg import cg, splu, LinearOperator
+from inspect import signature
+from typing import Dict, Optional, Tuple, Type, Union
+
+import time
+import numpy as np
+
+# Algebraic multigrid is an optional dependency
+try:
+    import pyamg
+except ImportError:
+    pyamg = None
+
+# SciPy 1.12 renamed the `tol` argument of its iterative solvers to `rtol`
+CG_TOL_ARG = 'rtol' if 'rtol' in signature(cg).parameters else 'tol'
+
+
+class LinearSolver(ABC):
+    '''
+    Abstract class for solvers of sparse symmetric positive definite linear systems A * x = b.
+    '''
+    name = 'unknown'
+
+    # Whether the solver needs the entries of A. Solvers that do not can take a `LinearOperator`
+    # (with a `diagonal` method if preconditioned by Jacobi) in place of a sparse matrix
+    requires_matrix = True
+
+    def __init__(self):
+        # The matrix that the solver is currently set up for
+        self.A = None
+
+    def setup(self, A: spmatrix):
+        '''
+        Prepare the solver for matrix `A`, e.g., by computing a factorization or a
+        preconditioner. Subclasses should call this method first when overriding it.
+        '''
+        self.A = A
+
+    @abstractmethod
+    def run(self, b: array, x0: Optional[array],
+            tol: Optional[float]) -> Tuple[array, int, bool]:
+        '''
+        Solve A * x = b for the matrix from the last `setup` call. Iterative solvers stop at the
+        relative residual tolerance `tol` if specified, or their default tolerance otherwise.
+        `b` and `x0` may also be (MxL) arrays that stack L right hand sides as columns.
+
+        Return value:
+            * `x: array`        - the solution
+            * `iterations: int` - the number of iterations (0 for direct solvers)
+            * `converged: bool` - whether the solver succeeded
+        '''
+        ...
+
+    def solve(self, A: spmatrix, b: array, x0: Optional[array]=None,
+              tol: Optional[float]=None) -> Tuple[array, Dict]:
+        '''
+        Solve the linear system A * x = b. The solver is only set up again if `A` is a different
+        object from the last call, so factorizations and preconditioners are reused when the same
+        matrix is passed in repeatedly.
+
+        Params:
+            * `A: spmatrix` - (MxM) the system matrix
+            * `b: array`    - (M) the right hand side, or (MxL) for L right hand sides
+            * `x0: array`   - (M) or (MxL) optional initial guess for iterative solvers
+            * `tol: float`  - optional relative residual tolerance for iterative solvers
+
+        Return value:
+            * `x: array`    - (M) or (MxL) the solution
+            * `info: Dict`  - solver statistics, including the solver name, the number of
+                iterations, the relative residual |b - Ax| / |b| (the largest one among all right
+                hand sides), convergence status, and the wall time of setup and solve in seconds
+        '''
+        # Set up the solver for a new matrix
+        setup_time = 0.0
+        if A is not self.A:
+            start = time.perf_counter()
+            self.setup(A)
+            setup_time = time.perf_counter() - start
+
+        # Solve the linear system
+        start = time.perf_counter()
+        x, iterations, converged = self.run(b, x0, tol)
+        solve_time = time.perf_counter() - start
+
+        # Compute the relative residual
+        b_norm = np.linalg.norm(b, axis=0)
+        residual = np.max(np.linalg.norm(b - A @ x, axis=0) / np.where(b_norm > 0, b_norm, 1.0))
+
+        info = {
+            'solver': self.name,
+            'iterations': iterations,
+            'residual': float(residual),
+            'converged': converged,
+            'setup_time': setup_time,
+            'solve_time': solve_time,
+        }
+        return x, info
+
+
+class ConjugateGradient(LinearSolver):
+    '''
+    The conjugate gradient (CG) method without preconditioning.
+    '''
+    name = 'cg'
+    requires_matrix = False
+
+    def __init__(self, tol: float=1e-5, max_iters: Optional[int]=None):
+        '''
+        `tol` - relative residual tolerance, `max_iters` - max. number of CG iterations.
+        '''
+        super().__init__()
+
+        self.tol = tol
+        self.max_iters = max_iters
+        self.M = None
+
+    def preconditioner(self, A: spmatrix) -> Optional[LinearOperator]:
+        '''
+        Build a preconditioner that approximates A^(-1). Subclasses override this method.
+        '''
+        return None
+
+    def setup(self, A: spmatrix):
+        super().setup(A)
+        self.M = self.preconditioner(A)
+
+    def run(self, b: array, x0: Optional[array],
+            tol: Optional[float]) -> Tuple[array, int, bool]:
+        # Solve multiple right hand sides together
+        if b.ndim == 2:
+            return self.run_multiple(b, x0, self.tol if tol is None else tol)
+
+        # Count the number of iterations using a callback function
+        iterations = 0
+
+        def callback(_):
+            nonlocal iterations
+            iterations += 1
+
+        x, stat = cg(self.A, b, x0=x0, M=self.M, maxiter=self.max_iters, callback=callback,
+                     **{CG_TOL_ARG: self.tol if tol is None else tol})
+        return x, iterations, stat == 0
+
+    def run_multiple(self, B: array, X0: Optional[array], tol: float) -> Tuple[array, int, bool]:
+        '''
+        Run independent (preconditioned) CG iterations for all columns of B at once. Each
+        iteration then performs one sparse matrix-matrix product instead of L matrix-vector
+        products. Columns stop updating once they meet the tolerance.
+        '''
+        # Store class member data into local variables
+        A, M = self.A, self.M
+        max_iters = self.max_iters if self.max_iters is not None else B.shape[0] * 10
+
+        # Initialize the solution, the residual, and the conjugate vectors
+        X = np.zeros_like(B) if X0 is None else X0.astype(B.dtype, copy=True)
+        R = B - A @ X
+        Z = R if M is None else M @ R
+        P = Z.copy()
+        rz = np.einsum('ij,ij->j', R, Z)
+
+        # Columns that have not converged yet
+        threshold = tol * np.linalg.norm(B, axis=0)
+        active = np.linalg.norm(R, axis=0) > threshold
+
+        it = 0
+        while active.any() and it < max_iters:
+            # Compute the step sizes (zero for converged columns)
+            AP = A @ P
+            pAp = np.einsum('ij,ij->j', P, AP)
+            alpha = np.where(active, rz / np.where(pAp != 0, pAp, 1.0), 0.0)
+
+            # Update X and R
+            X += alpha * P
+            R -= alpha * AP
+            active &= np.linalg.norm(R, axis=0) > threshold
+            it += 1
+
+            # Update the conjugate vectors
+            Z = R if M is None else M @ R
+            rz_new = np.einsum('ij,ij->j', R, Z)
+            P = Z + rz_new / np.where(rz != 0, rz, 1.0) * P
+            rz = rz_new
+
+        return X, it, not active.any()
+
+
+class JacobiCG(ConjugateGradient):
+    '''
+    CG preconditioned by the inverse diagonal of A.
+    '''
+    name = 'jacobi'
+
+    def preconditioner(self, A: spmatrix) -> LinearOperator:
+        diagonal = A.diagonal()
+        return diags(1.0 / np.where(diagonal != 0, diagonal, 1.0))
+
+
+class AlgebraicMultigridCG(ConjugateGradient):
+    '''
+    CG preconditioned by a smoothed aggregation algebraic multigrid V-cycle (requires PyAMG).
+    '''
+    name = 'amg'
+    requires_matrix = True
+
+    def __init__(self, tol: float=1e-5, max_iters: Optional[int]=None,
+                 near_nullspace: Optional[array]=None):
+        '''
+        `near_nullspace` optionally specifies the (n x k) near-nullspace vectors of A used to
+        build the coarse levels, e.g., the rigid body modes of an elastic solid (see
+        `StaticFEM.rigid_body_modes`), which reduces the number of CG iterations several times.
+        '''
+        if pyamg is None:
+            raise ImportError("The 'amg' solver requires PyAMG (pip install pyamg)")
+
+        super().__init__(tol, max_iters)
+        self.near_nullspace = near_nullspace
+
+    def preconditioner(self, A: spmatrix) -> LinearOperator:
+        ml = pyamg.smoothed_aggregation_solver(A.tocsr(), B=self.near_nullspace,
+                                               symmetry='symmetric')
+        return ml.aspreconditioner(cycle='V')
+
+
+class DirectSolver(LinearSolver):
+    '''
+    Sparse direct solver using the LU factorization of A. The factorization is reused as long as
+    the same matrix is passed in.
+    '''
+    name = 'direct'
+
+    def __init__(self):
+        super().__init__()
+        self.factor = None
+
+    def setup(self, A: spmatrix):
+        super().setup(A)
+        self.factor = splu(A.tocsc(), permc_spec='MMD_AT_PLUS_A')
+
+    def run(self, b: array, x0: Optional[array],
+            tol: Optional[float]) -> Tuple[array, int, bool]:
+        x = self.factor.solve(b)
+        return x, 0, bool(np.isfinite(x).all())
+
+
+# Registry of linear solvers. An incomplete Cholesky preconditioned CG is intentionally absent:
+# SciPy has no incomplete Cholesky factorization, and its incomplete LU (`spilu`) does not
+# yield a usable CG preconditioner for these elasticity matrices
+LINEAR_SOLVERS: Dict[str, Type[LinearSolver]] = {
+    ConjugateGradient.name: ConjugateGradient,
+    JacobiCG.name: JacobiCG,
+    AlgebraicMultigridCG.name: AlgebraicMultigridCG,
+    DirectSolver.name: DirectSolver,
+}
+
+
+def create_linear_solver(solver: Union[str, LinearSolver], **kwargs) -> LinearSolver:
+    '''
+    Create a linear solver by its name in `LINEAR_SOLVERS`. Solver instances are returned as is.
+    '''
+    if isinstance(solver, LinearSolver):
+        return solver
+    if solver not in LINEAR_SOLVERS:
+        raise ValueError(f"Unknown linear solver '{solver}', should be one of "
+                         f"{list(LINEAR_SOLVERS)}")
+
+    return LINEAR_SOLVERS[solver](**kwargs)
@@ -107,7 +107,8 @@ def solve_performance(stl_file: str, save_tet_mesh: str='') -> Tuple[float, floa
     # Run static FEM analysis and compute compliance
     # --------
     # TODO: Your code here. Complete the process by filling in the following lines:
-    #   1. Create the FEM solver by instantiating a StaticFEM object
+    #   1. Create the FEM solver by instantiating a StaticFEM object (or a VoxelFEM object, which
+    #      runs much faster on voxelized meshes, see `voxel_fem.py`)
     fem = ...               # <--
 
     #   2. Specify boundary conditions using the `set_bounadry_conditions` function
@@ -128,7 +129,7 @@ def solve_performance(stl_file: str, save_tet_mesh: str='') -> Tuple[float, floa
 
     # Optionally save the tetrahedral mesh
     if tet_mesh and save_tet_mesh:
-        tet_mesh.write_to_file(save_tet_mesh)
+        tet_mesh.write_to_file(save_tet_mesh, surface_only=True)
 
     return compliance, mass
 
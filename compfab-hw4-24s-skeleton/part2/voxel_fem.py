@@ -0,0 +1,289 @@
+from tet_mesh import TetMesh, tet_mesh_cuboid
+from material import Material
+from fem import StaticFEM, check_element_geometry
+from linear_solver import LinearSolver
+
+from numpy import ndarray as array
+from scipy.sparse.linalg import LinearOperator
+from typing import Optional, Tuple, Type, Union
+
+import numpy as np
+
+
+# Vertex indices of the five tets in a voxel (same as `Voxelizer.convert_to_tet_mesh` and
+# `tet_mesh_cuboid`). The i-th voxel corner sits at the offset (i >> 2, (i >> 1) & 1, i & 1)
+VOXEL_TET_INDICES = np.array([
+    [0, 6, 4, 5],
+    [0, 1, 3, 5],
+    [0, 6, 5, 3],
+    [6, 7, 5, 3],
+    [0, 3, 2, 6],
+])
+
+# Grid offsets of the eight voxel corners
+VOXEL_CORNER_OFFSETS = (np.arange(8)[:, None] >> np.arange(3)[::-1]) & 1
+
+# (tet, vertex) positions in `VOXEL_TET_INDICES` where each voxel corner first appears
+VOXEL_CORNER_TETS = np.array([0, 1, 4, 1, 0, 0, 0, 3]), np.array([0, 1, 2, 2, 2, 3, 1, 1])
+
+
+def voxel_lattice(mesh: TetMesh, tolerance: float=1e-6) -> Optional[Tuple[array, array, float]]:
+    '''
+    Detect whether a tet mesh is a uniform voxel lattice, i.e., consecutive groups of five tets
+    decompose axis-aligned cubes of the same size in the same way.
+
+    Params:
+        * `mesh: TetMesh`     - the tet mesh to check
+        * `tolerance: float`  - tolerance of vertex positions relative to the voxel size
+
+    Return value:
+        `None` if the mesh is not a voxel lattice, or a tuple of
+            * `voxels: array`        - (H x 8), the vertex indices of the corners of all voxels
+            * `vertex_coords: array` - (N x 3), integer grid coordinates of vertices
+            * `voxel_size: float`    - the edge length of voxels
+    '''
+    V, T = mesh.vertices, mesh.elements
+    if T.shape[0] == 0 or T.shape[0] % len(VOXEL_TET_INDICES):
+        return None
+
+    # Recover the voxel corners from the first tet that contains each corner, then verify that
+    # all tets follow the same decomposition
+    tets = T.reshape(-1, *VOXEL_TET_INDICES.shape)
+    voxels = tets[:, VOXEL_CORNER_TETS[0], VOXEL_CORNER_TETS[1]]
+    if not np.array_equal(voxels[:, VOXEL_TET_INDICES], tets):
+        return None
+
+    # Get the voxel size from the diagonal of the first voxel
+    diagonal = V[voxels[0, 7]] - V[voxels[0, 0]]
+    voxel_size = float(diagonal[0])
+    if voxel_size <= 0 or not np.allclose(diagonal, voxel_size, rtol=0,
+                                          atol=voxel_size * tolerance):
+        return None
+
+    # Snap vertices to the grid
+    origin = V.min(axis=0)
+    vertex_coords = np.rint((V - origin) / voxel_size).astype(np.int64)
+    if not np.allclose(vertex_coords * voxel_size + origin, V, rtol=0,
+                       atol=voxel_size * tolerance):
+        return None
+
+    # The corners of every voxel must be placed at the right offsets
+    if not np.array_equal(vertex_coords[voxels] - vertex_coords[voxels[:, [0]]],
+                          np.broadcast_to(VOXEL_CORNER_OFFSETS, voxels.shape + (3,))):
+        return None
+
+    return voxels, vertex_coords, voxel_size
+
+
+def voxel_stiffness(material: Type[Material], voxel_size: float) -> array:
+    '''
+    Compute the (24 x 24) stiffness matrix of a single voxel at rest, i.e., the sum of its five
+    tet element stiffness matrices. Row/column `3 * i + j` refers to coordinate j of corner i.
+    '''
+    # The vertices of a 2x2x2 cuboid are ordered the same way as voxel corners
+    mesh = tet_mesh_cuboid(2, 2, 2, voxel_size)
+    return StaticFEM(mesh, material).stiffness_matrix(mesh.vertices).toarray()
+
+
+class VoxelStiffnessOperator(LinearOperator):
+    '''
+    Matrix-free stiffness operator of a voxel lattice. Since all voxels share the same stiffness
+    matrix Ke up to a scaling factor, K * u is computed by strided operations over a dense vertex
+    grid: the displacements at the eight corners of all voxels are gathered by slicing, multiplied
+    by Ke, and added back to the grid by slicing.
+    '''
+    def __init__(self, Ke: array, voxel_factors: array, vertex_grid_ids: array,
+                 active_mask: Optional[array]=None):
+        '''
+        Params:
+            * `Ke: array`              - (24 x 24), the stiffness matrix of a single voxel
+            * `voxel_factors: array`   - (X x Y x Z), the scaling factor of each voxel (zero for
+                empty voxels)
+            * `vertex_grid_ids: array` - (N), flattened indices of vertices on the
+                (X+1 x Y+1 x Z+1) vertex grid
+            * `active_mask: array`     - (3N), optional mask of unconstrained coordinates. If
+                specified, the operator acts on the unconstrained coordinates only.
+        '''
+        # Determine the operator size
+        num_dofs = vertex_grid_ids.size * 3
+        size = num_dofs if active_mask is None else int(np.count_nonzero(active_mask))
+        super().__init__(np.float64, (size, size))
+
+        self.Ke = Ke
+        self.voxel_factors = voxel_factors
+        self.vertex_grid_ids = vertex_grid_ids
+        self.num_dofs = num_dofs
+        self.active_mask = active_mask
+
+        # Slices of the vertex grid at each voxel corner
+        self.grid_shape = tuple(n + 1 for n in voxel_factors.shape)
+        self.corner_slices = [(Ellipsis,) + tuple(slice(o, o + n) for o, n in
+                                                  zip(offset, voxel_factors.shape))
+                              for offset in VOXEL_CORNER_OFFSETS]
+
+    def scatter(self, voxel_values: array) -> array:
+        '''
+        Add up the (24 x L x X x Y x Z) voxel corner values into the (3N x L) vertex values.
+        '''
+        grid = np.zeros((3,) + voxel_values.shape[1:2] + self.grid_shape)
+        for i, s in enumerate(self.corner_slices):
+            grid[s] += voxel_values[i * 3:(i + 1) * 3]
+
+        # Read off the values at the vertices
+        Y = grid.reshape(grid.shape[0] * grid.shape[1], -1)[:, self.vertex_grid_ids]
+        Y = Y.reshape(3, -1, Y.shape[-1]).transpose(2, 0, 1).reshape(self.num_dofs, -1)
+        return Y if self.active_mask is None else Y[self.active_mask]
+
+    def _matmat(self, X: array) -> array:
+        num_cols = X.shape[1]
+
+        # Expand X to all coordinates
+        if self.active_mask is not None:
+            X_full = np.zeros((self.num_dofs, num_cols))
+            X_full[self.active_mask] = X
+            X = X_full
+
+        # Place the vertex displacements on the vertex grid (3 x L x X+1 x Y+1 x Z+1). The grid
+        # is laid out coordinate-major so that Ke can be applied to all voxels by a single
+        # matrix product
+        grid = np.zeros((3 * num_cols, np.prod(self.grid_shape)))
+        grid[:, self.vertex_grid_ids] = X.reshape(-1, 3 * num_cols).T
+        grid = grid.reshape(3, num_cols, *self.grid_shape)
+
+        # Gather the voxel corner displacements (24 x L x X x Y x Z), apply Ke, and scatter
+        U = np.concatenate([grid[s] for s in self.corner_slices])
+        F = (self.Ke @ U.reshape(24, -1)).reshape(U.shape)
+        F *= self.voxel_factors
+        return self.scatter(F)
+
+    def _matvec(self, x: array) -> array:
+        return self._matmat(x.reshape(-1, 1)).reshape(-1)
+
+    def _adjoint(self) -> LinearOperator:
+        # The stiffness matrix is symmetric
+        return self
+
+    def diagonal(self) -> array:
+        '''
+        Compute the diagonal of the stiffness matrix (used by the Jacobi preconditioner).
+        '''
+        diag = np.diag(self.Ke).reshape(-1, 1, 1, 1, 1) * self.voxel_factors
+        return self.scatter(diag).ravel()
+
+
+class VoxelFEM(StaticFEM):
+    '''
+    Static FEM analysis on a uniform voxel lattice (see `voxel_lattice`) for the linear elastic
+    material. All voxels share a single precomputed 24x24 stiffness matrix, so no per-element
+    stiffness matrices are stored. By default, the stiffness matrix is applied on the voxel grid
+    without assembly (see `VoxelStiffnessOperator`).
+    '''
+    def __init__(self, mesh: TetMesh, material: Type[Material],
+                 solver: Union[str, LinearSolver]='cg', matrix_free: bool=True,
+                 densities: Optional[array]=None, stats_file: Optional[str]=None):
+        '''
+        The constructor takes as input a voxel tet mesh (`mesh`) and a linear elastic material
+        model (`material`). `solver`, `matrix_free` and `stats_file` are the same as
+        `StaticFEM`. Optionally, `densities` (H) scales the stiffness of each voxel, listed in
+        the order of tet groups in the mesh.
+        '''
+        # Check input validity
+        assert material.type == 'linear', 'VoxelFEM only supports the linear elastic material'
+
+        # The shared precomputation calls `init_geometry` to set up the voxel lattice. The linear
+        # elastic stiffness is always positive semi-definite, so SPD projection is disabled
+        super().__init__(mesh, material, solver=solver, matrix_free=matrix_free, compact=True,
+                         stats_file=stats_file)
+
+        # Voxel densities
+        num_voxels = self.dof_map.shape[0]
+        if densities is None:
+            densities = np.ones(num_voxels)
+        assert densities.shape == (num_voxels,), \
+            f'Expected {num_voxels} voxel densities but got {densities.shape} instead'
+        self.densities = densities
+
+        # Compute the scaling factors of all voxels on the grid
+        voxel_factors = np.zeros(tuple(n - 1 for n in self.grid_shape))
+        np.add.at(voxel_factors, tuple(self.voxel_coords.T), densities)
+        self.voxel_factors = voxel_factors
+
+    def init_geometry(self, compact: bool, dtype: np.dtype, degenerate_tol: float):
+        '''
+        Precompute the voxel lattice and the element geometry. Elements are voxels, so the i-th
+        row/column of `Ke` maps to the `dof_map[i]`-th row/column of K. Dm^(-1) and the volumes
+        of the five tets in the first voxel are tiled over all voxels, which are translated
+        copies, for the per-tet methods inherited from `StaticFEM` (e.g.,
+        `deformation_gradient` and `lumped_masses`). dF/dx is always computed on the fly.
+        '''
+        mesh = self.mesh
+
+        lattice = voxel_lattice(mesh)
+        if lattice is None:
+            raise ValueError('The tet mesh is not a uniform voxel lattice')
+        voxels, vertex_coords, voxel_size = lattice
+
+        # Compute the vertex grid indices and the grid coordinates of all voxels
+        self.grid_shape = tuple(vertex_coords.max(axis=0) + 1)
+        self.vertex_grid_ids = np.ravel_multi_index(tuple(vertex_coords.T), self.grid_shape)
+        self.voxel_coords = vertex_coords[voxels[:, 0]]
+
+        # Stiffness matrix shared by all voxels
+        self.Ke = voxel_stiffness(self.material, voxel_size)
+
+        # Per-tet geometry of the first voxel, tiled over the lattice
+        tet_vertices = mesh.vertices[mesh.elements[:len(VOXEL_TET_INDICES)]]
+        Dm = (tet_vertices[:, 1:] - tet_vertices[:, [0]]).transpose(0, 2, 1)
+        det_Dm = check_element_geometry(Dm, degenerate_tol)
+        self.Dm_inv = np.tile(np.linalg.inv(Dm), (voxels.shape[0], 1, 1)).astype(dtype)
+        self.volumes = np.tile(np.abs(det_Dm) * (1 / 6), voxels.shape[0]).astype(dtype)
+        self.dF_dx = None
+
+        self.dof_map = (voxels[:, :, None] * 3 + np.arange(3)).reshape(voxels.shape[0], -1)
+
+    @classmethod
+    def from_voxelizer(cls, voxelizer, material: Type[Material], **kwargs) -> 'VoxelFEM':
+        '''
+        Create a voxel FEM solver from the tet mesh of a `Voxelizer`. Keyword arguments are
+        passed to the constructor.
+        '''
+        return cls(voxelizer.convert_to_tet_mesh(), material, **kwargs)
+
+    def element_stiffness(self, vertices: array) -> array:
+        '''
+        Compute the stiffness matrices of all voxels (H x 24 x 24). The linear elastic stiffness
+        does not depend on the vertex positions.
+        '''
+        return self.densities.reshape(-1, 1, 1) * self.Ke
+
+    def stiffness_operator(self, vertices: array,
+                           boundary_conditions: array=None) -> VoxelStiffnessOperator:
+        '''
+        Compute the matrix-free stiffness operator on the voxel grid. See
+        `StaticFEM.stiffness_operator` for the parameters.
+        '''
+        V = self.mesh.vertices
+        assert vertices.shape == V.shape, \
+            f'The passed-in vertices must match the shape of tet vertices. Expected {V.shape} ' \
+            f'but got {vertices.shape} instead'
+
+        active_mask = None
+        if boundary_conditions is not None:
+            active_mask = (~boundary_conditions).repeat(V.shape[1])
+
+        return VoxelStiffnessOperator(self.Ke, self.voxel_factors, self.vertex_grid_ids,
+                                      active_mask)
+
+    def elastic_force(self, vertices: array,
+                      return_energy: bool=False) -> Union[array, Tuple[array, float]]:
+        '''
+        Compute the internal elastic force at current vertex positions, which is -K * u for the
+        linear elastic material, and optionally the elastic energy 0.5 * u^T * K * u.
+        '''
+        V = self.mesh.vertices
+        K = self.stiffness_operator(vertices)
+        u = (vertices - V).ravel()
+        Ku = K @ u
+
+        f = -Ku.reshape(V.shape)
+        return (f, 0.5 * float(u @ Ku)) if return_energy else f